@@ -0,0 +1 @@
+"""Benchmark scripts for dns_exporter, they are not part of the package."""
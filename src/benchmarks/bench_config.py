@@ -0,0 +1,64 @@
+"""Measure the per-scrape CPU time spent building the effective scrape config.
+
+``build_final_config()`` is called in a loop for a module scrape and a querystring-only scrape,
+with the config cache enabled and with the cache cleared before every call. The server is an IP
+address so no time is spent resolving hostnames.
+
+Run from the ``src`` directory::
+
+    python benchmarks/bench_config.py --iterations 20000
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+
+from dns_exporter.config import RRValidator
+from dns_exporter.exporter import DNSExporter
+
+
+def run(qs: dict[str, str], iterations: int, *, cached: bool) -> float:
+    """Build the config for the querystring and return the average CPU time per call in microseconds."""
+    handler = DNSExporter.__new__(DNSExporter)
+    DNSExporter.config_cache.clear()
+    start = time.process_time()
+    for _ in range(iterations):
+        if not cached:
+            DNSExporter.config_cache.clear()
+        handler.build_final_config(qs=dict(qs))
+    return (time.process_time() - start) / iterations * 1_000_000
+
+
+def main() -> None:
+    """Parse arguments, configure a module and run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=10000, help="Number of configs to build. Default: 10000")
+    args = parser.parse_args()
+
+    DNSExporter.configure(
+        modules={
+            "bench": {
+                "protocol": "tcp",
+                "family": "ipv4",
+                "query_type": "MX",
+                "valid_rcodes": ["NOERROR", "NXDOMAIN"],
+                "validate_answer_rrs": RRValidator.create(fail_if_none_matches_regexp=[".*mail.example.com"]),
+            },
+        },
+    )
+    scrapes = {
+        "module": {"module": "bench", "server": "192.0.2.53", "query_name": "example.com"},
+        "querystring": {"server": "192.0.2.53", "query_name": "example.com", "protocol": "udp", "family": "ipv4"},
+    }
+    for name, qs in scrapes.items():
+        uncached = run(qs=qs, iterations=args.iterations, cached=False)
+        cached = run(qs=qs, iterations=args.iterations, cached=True)
+        print(  # noqa: T201
+            f"{name:>12}: uncached {uncached:7.1f} us  cached {cached:7.1f} us  "
+            f"saved {uncached - cached:7.1f} us/scrape"
+        )
+
+
+if __name__ == "__main__":
+    main()
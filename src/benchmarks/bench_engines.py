@@ -0,0 +1,126 @@
+"""Compare the throughput of the threading and asyncio scrape engines.
+
+Both engines are started in-process and scraped with the same number of concurrent
+clients. The scrapes go to a local UDP DNS server which answers every query after a
+configurable delay, to simulate the network latency of a real DNS server.
+
+Run from the ``src`` directory::
+
+    python benchmarks/bench_engines.py --scrapes 2000 --concurrency 100 --delay 0.05
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import statistics
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+from threading import Thread
+
+import dns.message
+from dns_exporter.exporter import DNSExporter
+from dns_exporter.server import start_server
+
+
+class DelayedDNSProtocol(asyncio.DatagramProtocol):
+    """UDP DNS server protocol which answers all queries with an empty NOERROR response after a delay."""
+
+    def __init__(self, delay: float) -> None:
+        """Save the delay."""
+        self.delay = delay
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        """Save the transport."""
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]) -> None:
+        """Answer the query after the delay without blocking other queries."""
+        response = dns.message.make_response(dns.message.from_wire(data)).to_wire()
+        asyncio.get_running_loop().call_later(self.delay, self.transport.sendto, response, addr)  # type: ignore[attr-defined]
+
+
+def run_in_loop(coro_factory: object) -> object:
+    """Start an event loop in a daemon thread, run the coroutine in it and return the result."""
+    loop = asyncio.new_event_loop()
+    Thread(target=loop.run_forever, daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coro_factory(), loop).result()  # type: ignore[operator]
+
+
+def start_dns_server(delay: float) -> int:
+    """Start the delayed DNS server and return the port."""
+
+    async def start() -> int:
+        transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: DelayedDNSProtocol(delay=delay), local_addr=("127.0.0.1", 0)
+        )
+        return int(transport.get_extra_info("sockname")[1])
+
+    return run_in_loop(start)  # type: ignore[return-value]
+
+
+def start_threading_engine() -> int:
+    """Start the threading engine and return the port."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), DNSExporter)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return int(server.server_address[1])
+
+
+def start_asyncio_engine() -> int:
+    """Start the asyncio engine and return the port."""
+
+    async def start() -> int:
+        server = await start_server(listen_ip="127.0.0.1", port=0)
+        return int(server.sockets[0].getsockname()[1])
+
+    return run_in_loop(start)  # type: ignore[return-value]
+
+
+def scrape(url: str) -> float:
+    """Do a single scrape and return the time it took."""
+    start = time.perf_counter()
+    with urllib.request.urlopen(url) as response:  # noqa: S310
+        body = response.read()
+    if b"dnsexp_dns_query_success 1.0" not in body:
+        msg = f"Scrape failed: {body.decode()}"
+        raise RuntimeError(msg)
+    return time.perf_counter() - start
+
+
+def benchmark(name: str, url: str, scrapes: int, concurrency: int) -> None:
+    """Scrape the url with the given concurrency and print the results."""
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # warm up
+        list(executor.map(scrape, [url] * concurrency))
+        start = time.perf_counter()
+        latencies = sorted(executor.map(scrape, [url] * scrapes))
+        elapsed = time.perf_counter() - start
+    print(  # noqa: T201
+        f"{name:>10}: {scrapes / elapsed:8.1f} scrapes/s  "
+        f"p50 {statistics.median(latencies) * 1000:7.1f} ms  "
+        f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:7.1f} ms"
+    )
+
+
+def main() -> None:
+    """Parse arguments, start the servers and run the benchmark for both engines."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scrapes", type=int, default=1000, help="Number of scrapes per engine. Default: 1000")
+    parser.add_argument("--concurrency", type=int, default=50, help="Number of concurrent scrapes. Default: 50")
+    parser.add_argument("--delay", type=float, default=0.05, help="DNS server response delay in seconds. Default: 0.05")
+    args = parser.parse_args()
+
+    dns_port = start_dns_server(delay=args.delay)
+    query = f"/query?server=127.0.0.1:{dns_port}&query_name=example.com&protocol=udp&family=ipv4&collect_ttl=false"
+    print(  # noqa: T201
+        f"{args.scrapes} scrapes, {args.concurrency} concurrent, DNS server delay {args.delay * 1000:.0f} ms"
+    )
+    for name, port in [("threading", start_threading_engine()), ("asyncio", start_asyncio_engine())]:
+        benchmark(name=name, url=f"http://127.0.0.1:{port}{query}", scrapes=args.scrapes, concurrency=args.concurrency)
+
+
+if __name__ == "__main__":
+    main()
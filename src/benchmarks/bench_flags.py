@@ -0,0 +1,73 @@
+"""Measure the CPU time spent on response flags, for the flags label and for flag validation.
+
+The old way (rendering the flags to text, splitting, sorting and scanning lists) is compared with the
+precomputed ``FLAGS_LABELS`` table and the compiled ``RFMatcher`` masks, for synthetic responses with
+random flags.
+
+Run from the ``src`` directory::
+
+    python benchmarks/bench_flags.py --responses 10000
+"""
+
+from __future__ import annotations
+
+import argparse
+import random
+import time
+
+import dns.flags
+from dns_exporter.collector import FLAGS_LABELS, FLAGS_MASK
+from dns_exporter.config import RFValidator
+
+
+def flags_as_text(flags: int, validator: RFValidator) -> tuple[str, str | None]:
+    """Return the flags label and the failed rule by comparing the flags as text."""
+    present = dns.flags.to_text(flags).split(" ")
+    label = " ".join(sorted(present))
+    if any(flag in present for flag in validator.fail_if_any_present):
+        return label, "fail_if_any_present"
+    if validator.fail_if_all_present and all(flag in present for flag in validator.fail_if_all_present):
+        return label, "fail_if_all_present"
+    if any(flag not in present for flag in validator.fail_if_any_absent):
+        return label, "fail_if_any_absent"
+    if validator.fail_if_all_absent and all(flag not in present for flag in validator.fail_if_all_absent):
+        return label, "fail_if_all_absent"
+    return label, None
+
+
+def flags_as_masks(flags: int, validator: RFValidator) -> tuple[str, str | None]:
+    """Return the flags label and the failed rule using the lookup table and the compiled matcher."""
+    return FLAGS_LABELS[flags & FLAGS_MASK], validator.matcher().check(flags)
+
+
+def main() -> None:
+    """Parse arguments, create the responses and time both ways."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--responses", type=int, default=10000, help="Number of responses. Default: 10000")
+    args = parser.parse_args()
+
+    validator = RFValidator.create(
+        fail_if_any_present=["TC"],
+        fail_if_all_present=["QR", "RA", "RD"],
+        fail_if_any_absent=["QR"],
+        fail_if_all_absent=["AA", "AD"],
+    )
+    # random header flags, including opcode and rcode bits
+    responses = [random.getrandbits(16) for _ in range(args.responses)]
+
+    results = {}
+    for name, func in [("text", flags_as_text), ("masks", flags_as_masks)]:
+        start = time.process_time()
+        results[name] = [func(flags, validator) for flags in responses]
+        elapsed = time.process_time() - start
+        print(  # noqa: T201
+            f"{name:>6}: {elapsed * 1000:7.1f} ms for {args.responses} responses, "
+            f"{elapsed / args.responses * 1_000_000:5.2f} us/response"
+        )
+    if results["text"] != results["masks"]:
+        msg = "Results differ"
+        raise RuntimeError(msg)
+
+
+if __name__ == "__main__":
+    main()
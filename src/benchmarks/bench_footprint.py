@@ -0,0 +1,115 @@
+"""Measure the startup time and memory use of the dns_exporter process.
+
+Runs ``dns_exporter --version``, and starts the exporter with a config file with a single UDP module and scrapes it
+once. The scrape goes to a local UDP DNS server. The peak RSS of each process is reported, note that the units of
+``ru_maxrss`` assumed here are only correct on Linux and macOS.
+
+Run from the ``src`` directory::
+
+    python benchmarks/bench_footprint.py --runs 10
+"""
+
+from __future__ import annotations
+
+import argparse
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+from threading import Thread
+
+import dns.message
+import yaml
+
+COMMAND = [sys.executable, "-m", "dns_exporter.entrypoint"]
+
+
+def peak_rss_mib() -> float:
+    """Return the peak RSS of the largest child process which has exited, in MiB."""
+    maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    return maxrss / 1024 / 1024 if sys.platform == "darwin" else maxrss / 1024
+
+
+def start_dns_server() -> int:
+    """Start a UDP DNS server which answers all queries with an empty NOERROR response and return the port."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+
+    def serve() -> None:
+        while True:
+            data, addr = sock.recvfrom(65535)
+            sock.sendto(dns.message.make_response(dns.message.from_wire(data)).to_wire(), addr)
+
+    Thread(target=serve, daemon=True).start()
+    return int(sock.getsockname()[1])
+
+
+def get_free_port() -> int:
+    """Return a TCP port which is free right now."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return int(sock.getsockname()[1])
+
+
+def bench_version(runs: int) -> None:
+    """Run dns_exporter --version and print the median time and the peak RSS."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([*COMMAND, "--version"], check=True, capture_output=True)  # noqa: S603
+        times.append(time.perf_counter() - start)
+    print(f"{'--version':>12}: {statistics.median(times) * 1000:7.1f} ms  peak RSS {peak_rss_mib():6.1f} MiB")  # noqa: T201
+
+
+def bench_udp(runs: int, dns_port: int) -> None:
+    """Start dns_exporter with a UDP-only config, scrape it once and print the median times and the peak RSS."""
+    ready_times = []
+    scrape_times = []
+    with tempfile.TemporaryDirectory() as tmp:
+        config = Path(tmp) / "dns_exporter.yml"
+        config.write_text(yaml.dump({"modules": {"udp": {"protocol": "udp", "collect_ttl": False}}}))
+        for _ in range(runs):
+            port = get_free_port()
+            start = time.perf_counter()
+            process = subprocess.Popen([*COMMAND, "-c", str(config), "-p", str(port), "-q"])  # noqa: S603
+            try:
+                while True:
+                    try:
+                        urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics").read()  # noqa: S310
+                        break
+                    except OSError:
+                        time.sleep(0.005)
+                ready = time.perf_counter()
+                url = f"http://127.0.0.1:{port}/query?module=udp&server=127.0.0.1:{dns_port}&query_name=example.com"
+                body = urllib.request.urlopen(url).read()  # noqa: S310
+                if b"dnsexp_dns_query_success 1.0" not in body:
+                    msg = f"Scrape failed: {body.decode()}"
+                    raise RuntimeError(msg)
+                scrape_times.append(time.perf_counter() - ready)
+                ready_times.append(ready - start)
+            finally:
+                process.terminate()
+                process.wait()
+    print(  # noqa: T201
+        f"{'udp config':>12}: {statistics.median(ready_times) * 1000:7.1f} ms to ready  "
+        f"first scrape {statistics.median(scrape_times) * 1000:6.1f} ms  peak RSS {peak_rss_mib():6.1f} MiB"
+    )
+
+
+def main() -> None:
+    """Parse arguments and run the benchmarks."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="Number of times to start each process. Default: 5")
+    args = parser.parse_args()
+    bench_version(runs=args.runs)
+    bench_udp(runs=args.runs, dns_port=start_dns_server())
+
+
+if __name__ == "__main__":
+    main()
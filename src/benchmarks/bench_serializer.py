@@ -0,0 +1,90 @@
+"""Measure the CPU time spent rendering the metrics of a ``/query`` request.
+
+``generate_latest()`` from ``prometheus_client`` is compared with ``generate_text()`` from
+``dns_exporter.serializer`` for the output of a scrape with a number of RRs in the answer, built like the
+``tests/prometheus`` fixtures. The time includes collecting the metrics, which is the same for both.
+
+Run from the ``src`` directory::
+
+    python benchmarks/bench_serializer.py --rrs 5 --renders 10000
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+from typing import TYPE_CHECKING
+
+from dns_exporter.metrics import QTIME_LABELS, TTL_LABELS
+from dns_exporter.serializer import generate_text
+from prometheus_client import CollectorRegistry, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+if TYPE_CHECKING:  # pragma: no cover
+    from collections.abc import Iterator
+
+
+class ScrapeCollector:
+    """Collector returning the metrics of a successful scrape with the given number of RRs."""
+
+    def __init__(self, rrs: int) -> None:
+        """Build the labels for the scrape."""
+        self.labels = dict.fromkeys(QTIME_LABELS, "none")
+        self.labels.update(
+            {
+                "server": "udp://dns.quad9.net:53",
+                "ip": "149.112.112.112",
+                "query_name": "gmail.com",
+                "flags": "QR RA RD",
+            },
+        )
+        self.rrs = [
+            {"rr_name": "gmail.com.", "rr_section": "answer", "rr_type": "MX", "rr_value": f"{i} mx{i}.example.com."}
+            for i in range(rrs)
+        ]
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        """Yield the metrics like DNSCollector does."""
+        qtime = GaugeMetricFamily("dnsexp_dns_query_time_seconds", "DNS query time in seconds.", labels=QTIME_LABELS)
+        qtime.add_metric(list(self.labels.values()), 0.03361630439758301)
+        yield qtime
+        ttl = GaugeMetricFamily(
+            "dnsexp_dns_response_rr_ttl_seconds", "DNS response RR TTL in seconds.", labels=QTIME_LABELS + TTL_LABELS
+        )
+        for rr in self.rrs:
+            ttl.add_metric(list(self.labels.values()) + [rr[key] for key in TTL_LABELS], 300)
+        yield ttl
+        success = GaugeMetricFamily(
+            "dnsexp_dns_query_success", "Was this DNS query successful or not, 1 for success or 0 for failure."
+        )
+        success.add_metric([], 1)
+        yield success
+
+
+def main() -> None:
+    """Parse arguments, build the registry and time both serializers."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rrs", type=int, default=5, help="Number of RRs in the answer. Default: 5")
+    parser.add_argument("--renders", type=int, default=10000, help="Number of renders. Default: 10000")
+    args = parser.parse_args()
+
+    registry = CollectorRegistry()
+    registry.register(ScrapeCollector(rrs=args.rrs))
+
+    results = {}
+    for name, func in [("generate_latest", generate_latest), ("generate_text", generate_text)]:
+        start = time.process_time()
+        for _ in range(args.renders):
+            results[name] = func(registry)
+        elapsed = time.process_time() - start
+        print(  # noqa: T201
+            f"{name:>15}: {elapsed * 1000:7.1f} ms for {args.renders} renders, "
+            f"{elapsed / args.renders * 1_000_000:6.1f} us/render"
+        )
+    if results["generate_latest"] != results["generate_text"]:
+        msg = "Results differ"
+        raise RuntimeError(msg)
+
+
+if __name__ == "__main__":
+    main()
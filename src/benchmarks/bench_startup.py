@@ -0,0 +1,71 @@
+"""Measure how long it takes to load a config file with many modules.
+
+A config file with the requested number of modules is generated in a temporary directory and loaded with the
+module compilation done at startup, deferred to first use, and loaded from the module cache.
+
+Run from the ``src`` directory::
+
+    python benchmarks/bench_startup.py --modules 20000
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import tempfile
+import time
+from pathlib import Path
+
+import yaml
+from dns_exporter.exporter import YAML_LOADER, DNSExporter
+
+
+def write_config_file(path: Path, modules: int) -> None:
+    """Write a config file with the number of modules to the path."""
+    config = {
+        "modules": {
+            f"module{i}": {
+                "protocol": ["udp", "tcp", "dot", "doh"][i % 4],
+                "query_type": ["A", "AAAA", "MX", "NS"][i % 4],
+                "valid_rcodes": ["NOERROR", "NXDOMAIN"],
+                "validate_answer_rrs": {"fail_if_none_matches_regexp": [f".*192\\.0\\.2\\.{i % 256}.*"]},
+                "validate_response_flags": {"fail_if_any_absent": ["QR"]},
+            }
+            for i in range(modules)
+        },
+    }
+    path.write_text(yaml.dump(config))
+
+
+def load(name: str, path: Path, lazy: bool, cache_dir: str | None) -> None:  # noqa: FBT001
+    """Load the config file with the settings and print the time it took."""
+    DNSExporter.lazy_modules = lazy
+    DNSExporter.module_cache_dir = cache_dir
+    start = time.perf_counter()
+    modules = DNSExporter.load_config_file(str(path))
+    elapsed = time.perf_counter() - start
+    if modules is None:
+        msg = "Loading the config file failed"
+        raise RuntimeError(msg)
+    print(f"{name:>12}: {elapsed:8.3f} s")  # noqa: T201
+
+
+def main() -> None:
+    """Parse arguments, write the config file and load it in each mode."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modules", type=int, default=5000, help="Number of modules in the config file. Default: 5000")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "dns_exporter.yml"
+        write_config_file(path=path, modules=args.modules)
+        print(f"{args.modules} modules, YAML loader {YAML_LOADER.__name__}")  # noqa: T201
+        load(name="compile", path=path, lazy=False, cache_dir=None)
+        load(name="lazy", path=path, lazy=True, cache_dir=None)
+        load(name="cache miss", path=path, lazy=False, cache_dir=str(Path(tmp) / "cache"))
+        load(name="cache hit", path=path, lazy=False, cache_dir=str(Path(tmp) / "cache"))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,39 @@
 """pytest fixtures file for the dns_exporter project."""
 
+import asyncio
+import contextlib
+import datetime as dt
+import functools
+import ipaddress
+import socket
+import ssl
 import subprocess
 import time
-from http.server import HTTPServer
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
 from pathlib import Path
+from socketserver import BaseRequestHandler, StreamRequestHandler, ThreadingTCPServer, UDPServer
 from threading import Thread
-
+from typing import ClassVar
+
+import dns.edns
+import dns.message
+import dns.rdatatype
+import dns.rrset
+import h2.config
+import h2.connection
+import h2.events
 import httpx
 import pytest
 import yaml
+from aioquic.asyncio import QuicConnectionProtocol, serve
+from aioquic.h3.connection import H3_ALPN, H3Connection
+from aioquic.h3.events import DataReceived, HeadersReceived
+from aioquic.quic.configuration import QuicConfiguration
+from aioquic.quic.events import StreamDataReceived
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
 from dns_exporter.entrypoint import main
 from dns_exporter.exporter import DNSExporter
 
@@ -73,6 +98,23 @@ def dns_exporter_main_no_config_no_debug():
     print("Beginning teardown")
 
 
+@pytest.fixture(scope="session")
+def dns_exporter_asyncio_engine():
+    """Run a server with main() using the asyncio engine and with the example config."""
+    print("Running asyncio engine server with example config on 127.0.0.1:26353 ...")
+    thread = Thread(
+        target=main,
+        args=(["-c", "dns_exporter/dns_exporter_example.yml", "-p", "26353", "--engine", "asyncio", "-d"],),
+    )
+    thread.daemon = True
+    thread.start()
+    time.sleep(1)
+    if not thread.is_alive():
+        pytest.fail("Unable to create test instance on 127.0.0.1:26353")
+    yield
+    print("Beginning teardown")
+
+
 @pytest.fixture()
 def dns_exporter_param_config(request):
     """Run a server in a subprocess with the config from request.param."""
@@ -225,3 +267,374 @@ def mock_dns_query_httpx_connecttimeout(mocker):
         "dns.query.https",
         side_effect=httpx.ConnectTimeout("mocked"),
     )
+
+
+def make_dns_response(wire, keepalive=None):
+    """Parse the DNS query in wire and return a response to it with a single A or AAAA record as wire.
+
+    If keepalive is set and the query has an edns-tcp-keepalive option the response includes the option with
+    keepalive as the idle timeout (in units of 100ms).
+    """
+    query = dns.message.from_wire(wire)
+    response = dns.message.make_response(query)
+    if keepalive is not None and any(option.otype == dns.edns.KEEPALIVE for option in query.options):
+        response.use_edns(edns=0, options=[dns.edns.GenericOption(dns.edns.KEEPALIVE, keepalive.to_bytes(2, "big"))])
+    question = query.question[0]
+    rdata = "::1" if question.rdtype == dns.rdatatype.AAAA else "127.0.0.1"
+    rdtype = "AAAA" if question.rdtype == dns.rdatatype.AAAA else "A"
+    response.answer.append(dns.rrset.from_text(question.name, 300, "IN", rdtype, rdata))
+    return response.to_wire()
+
+
+@pytest.fixture(scope="session")
+def selfsigned_certificate(tmp_path_factory):
+    """Create a selfsigned certificate and key for localhost and 127.0.0.1 and return the paths to them."""
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = dt.datetime.now(dt.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - dt.timedelta(days=1))
+        .not_valid_after(now + dt.timedelta(days=1))
+        .add_extension(
+            x509.SubjectAlternativeName(
+                [x509.DNSName("localhost"), x509.IPAddress(ipaddress.ip_address("127.0.0.1"))],
+            ),
+            critical=False,
+        )
+        .sign(key, hashes.SHA256())
+    )
+    path = tmp_path_factory.mktemp("certificate")
+    certpath = path / "localhost.crt"
+    keypath = path / "localhost.key"
+    certpath.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+    keypath.write_bytes(
+        key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption(),
+        ),
+    )
+    return certpath, keypath
+
+
+class DoHHandler(BaseHTTPRequestHandler):
+    """Minimal DoH request handler which answers all queries with make_dns_response()."""
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        """Count connections."""
+        self.server.connections += 1
+        super().setup()
+
+    def do_POST(self):  # noqa: N802
+        """Answer the DNS query in the request body, after waiting for the server delay."""
+        wire = make_dns_response(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(self.server.delay)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/dns-message")
+        self.send_header("Content-Length", str(len(wire)))
+        self.end_headers()
+        self.wfile.write(wire)
+
+    def log_message(self, *args: object) -> None:
+        """Be quiet."""
+
+
+@pytest.fixture()
+def doh_server(selfsigned_certificate):
+    """Run a local DoH server on a random port, the server object has a connections counter and a response delay."""
+    certpath, keypath = selfsigned_certificate
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certpath, keypath)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), DoHHandler)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    server.connections = 0
+    server.delay = 0
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def serve_h2_connection(sock):
+    """Answer DoH requests on a single HTTP/2 connection until the client goes away."""
+    conn = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False))
+    conn.initiate_connection()
+    sock.sendall(conn.data_to_send())
+    bodies = {}
+    with sock:
+        while data := sock.recv(65535):
+            for event in conn.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    bodies[event.stream_id] = b""
+                elif isinstance(event, h2.events.DataReceived):
+                    bodies[event.stream_id] += event.data
+                    conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                elif isinstance(event, h2.events.StreamEnded):
+                    wire = make_dns_response(bodies.pop(event.stream_id))
+                    headers = [(":status", "200"), ("content-type", "application/dns-message")]
+                    conn.send_headers(event.stream_id, [*headers, ("content-length", str(len(wire)))])
+                    conn.send_data(event.stream_id, wire, end_stream=True)
+            sock.sendall(conn.data_to_send())
+
+
+@pytest.fixture()
+def doh2_server(selfsigned_certificate):
+    """Run a local HTTP/2-only DoH server on a random port, the server object has a connections counter."""
+    certpath, keypath = selfsigned_certificate
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certpath, keypath)
+    context.set_alpn_protocols(["h2"])
+    listener = context.wrap_socket(socket.create_server(("127.0.0.1", 0)), server_side=True)
+
+    class Server:
+        connections = 0
+        server_port = listener.getsockname()[1]
+
+    def accept() -> None:
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except OSError:
+                return
+            Server.connections += 1
+            Thread(target=serve_h2_connection, args=(sock,), daemon=True).start()
+
+    thread = Thread(target=accept)
+    thread.daemon = True
+    thread.start()
+    yield Server
+    listener.close()
+
+
+class DoH3Protocol(QuicConnectionProtocol):
+    """Minimal aioquic DoH3 server protocol which answers all queries with make_dns_response()."""
+
+    def __init__(self, *args: object, server: type, **kwargs: object) -> None:
+        """Register the connection and prepare the H3 layer."""
+        super().__init__(*args, **kwargs)
+        server.protocols.append(self)
+        self._h3 = H3Connection(self._quic)
+        self._bodies = {}
+
+    def quic_event_received(self, event):
+        """Pass QUIC events to the H3 layer and answer complete requests."""
+        for h3_event in self._h3.handle_event(event):
+            if isinstance(h3_event, HeadersReceived):
+                self._bodies[h3_event.stream_id] = b""
+            elif isinstance(h3_event, DataReceived):
+                self._bodies[h3_event.stream_id] += h3_event.data
+                if h3_event.stream_ended:
+                    wire = make_dns_response(self._bodies.pop(h3_event.stream_id))
+                    headers = [(b":status", b"200"), (b"content-type", b"application/dns-message")]
+                    self._h3.send_headers(h3_event.stream_id, [*headers, (b"content-length", str(len(wire)).encode())])
+                    self._h3.send_data(h3_event.stream_id, wire, end_stream=True)
+        self.transmit()
+
+
+class DoQProtocol(QuicConnectionProtocol):
+    """Minimal aioquic DoQ server protocol which answers all queries with make_dns_response()."""
+
+    def __init__(self, *args: object, server: type, **kwargs: object) -> None:
+        """Register the connection."""
+        super().__init__(*args, **kwargs)
+        server.protocols.append(self)
+        self._buffers = {}
+
+    def quic_event_received(self, event):
+        """Answer the length-prefixed DNS query on each stream once the client has sent all of it."""
+        if isinstance(event, StreamDataReceived):
+            self._buffers[event.stream_id] = self._buffers.get(event.stream_id, b"") + event.data
+            if event.end_stream:
+                wire = make_dns_response(self._buffers.pop(event.stream_id)[2:])
+                self._quic.send_stream_data(event.stream_id, len(wire).to_bytes(2, "big") + wire, end_stream=True)
+                self.transmit()
+
+
+def run_quic_server(certificate, alpn_protocols, protocol):
+    """Run an aioquic server on a random UDP port in a thread and yield an object with the port and connections."""
+    certpath, keypath = certificate
+
+    class Server:
+        protocols: ClassVar[list] = []
+        server_port = None
+
+        @classmethod
+        def connections(cls) -> int:
+            return len(cls.protocols)
+
+        @classmethod
+        def close_connections(cls) -> None:
+            for connection in cls.protocols:
+                loop.call_soon_threadsafe(connection.close)
+
+    configuration = QuicConfiguration(alpn_protocols=alpn_protocols, is_client=False)
+    configuration.load_cert_chain(certpath, keypath)
+    loop = asyncio.new_event_loop()
+    create_protocol = functools.partial(protocol, server=Server)
+    quic_server = loop.run_until_complete(
+        serve("127.0.0.1", 0, configuration=configuration, create_protocol=create_protocol),
+    )
+    Server.server_port = quic_server._transport.get_extra_info("sockname")[1]  # noqa: SLF001
+    thread = Thread(target=loop.run_forever)
+    thread.daemon = True
+    thread.start()
+    yield Server
+    loop.call_soon_threadsafe(quic_server.close)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+@pytest.fixture()
+def doh3_server(selfsigned_certificate):
+    """Run a local DoH3 server on a random UDP port."""
+    yield from run_quic_server(certificate=selfsigned_certificate, alpn_protocols=H3_ALPN, protocol=DoH3Protocol)
+
+
+@pytest.fixture()
+def doq_server(selfsigned_certificate):
+    """Run a local DoQ server on a random UDP port."""
+    yield from run_quic_server(certificate=selfsigned_certificate, alpn_protocols=["doq"], protocol=DoQProtocol)
+
+
+class DNSStreamHandler(StreamRequestHandler):
+    """Minimal TCP/DoT request handler which answers all queries on the connection with make_dns_response()."""
+
+    def handle(self):
+        """Count the connection and answer length-prefixed DNS queries until the client goes away."""
+        self.server.connections += 1
+        self.server.resumed += getattr(self.request, "session_reused", False)
+        while length := self.rfile.read(2):
+            wire = make_dns_response(self.rfile.read(int.from_bytes(length, "big")), keepalive=self.server.keepalive)
+            self.wfile.write(len(wire).to_bytes(2, "big") + wire)
+            self.server.queries += 1
+            if self.server.queries_per_connection and self.server.queries % self.server.queries_per_connection == 0:
+                # close the connection like a server with a limit on queries per connection
+                return
+
+
+def run_stream_server(context=None):
+    """Run a local TCP (or DoT if an SSLContext is provided) DNS server on a random port and return it.
+
+    The server object counts connections, queries, and resumed TLS sessions. Set ``keepalive`` to answer with an
+    edns-tcp-keepalive option and ``queries_per_connection`` to close connections after that many queries.
+    """
+    server = ThreadingTCPServer(("127.0.0.1", 0), DNSStreamHandler)
+    if context:
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    server.daemon_threads = True
+    server.connections = 0
+    server.queries = 0
+    server.resumed = 0
+    server.keepalive = None
+    server.queries_per_connection = None
+    server.server_port = server.server_address[1]
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+@pytest.fixture()
+def dot_server(selfsigned_certificate):
+    """Run a local DoT server on a random port."""
+    certpath, keypath = selfsigned_certificate
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certpath, keypath)
+    server = run_stream_server(context=context)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture()
+def tcp_server():
+    """Run a local plain TCP DNS server on a random port."""
+    server = run_stream_server()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class DNSDatagramHandler(BaseRequestHandler):
+    """Answer a DNS query received over UDP, the server object saves the received wire format queries."""
+
+    def handle(self):
+        """Parse the query and send the response."""
+        data, sock = self.request
+        self.server.queries.append(data)
+        sock.sendto(make_dns_response(data), self.client_address)
+
+
+@pytest.fixture()
+def udp_server():
+    """Run a local UDP DNS server on a random port."""
+    server = UDPServer(("127.0.0.1", 0), DNSDatagramHandler)
+    server.queries = []
+    server.server_port = server.server_address[1]
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class Socks5Handler(StreamRequestHandler):
+    """Minimal SOCKS5 proxy request handler, it supports the CONNECT command without authentication."""
+
+    def handle(self):
+        """Do the SOCKS5 handshake, connect to the destination and relay data until either side closes."""
+        # greeting, always pick "no authentication"
+        _, nmethods = self.rfile.read(2)
+        self.rfile.read(nmethods)
+        self.wfile.write(b"\x05\x00")
+        # connect request with an IPv4 address
+        _, command, _, atyp = self.rfile.read(4)
+        if command != 1 or atyp != 1:
+            self.wfile.write(b"\x05\x07\x00\x01" + bytes(6))
+            return
+        host = socket.inet_ntoa(self.rfile.read(4))
+        port = int.from_bytes(self.rfile.read(2), "big")
+        self.server.connections += 1
+        with socket.create_connection((host, port)) as upstream:
+            self.wfile.write(b"\x05\x00\x00\x01" + bytes(6))
+            Thread(target=self.relay, args=(upstream, self.connection), daemon=True).start()
+            self.relay(self.connection, upstream)
+
+    @staticmethod
+    def relay(source, destination) -> None:
+        """Copy data from source to destination until source is closed."""
+        with contextlib.suppress(OSError):
+            while data := source.recv(65535):
+                destination.sendall(data)
+            destination.shutdown(socket.SHUT_WR)
+
+
+def run_socks_server():
+    """Run a local SOCKS5 proxy on a random port and return it, the server object counts proxied connections."""
+    server = ThreadingTCPServer(("127.0.0.1", 0), Socks5Handler)
+    server.daemon_threads = True
+    server.connections = 0
+    server.server_port = server.server_address[1]
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture()
+def socks_servers():
+    """Run two local SOCKS5 proxies on random ports."""
+    servers = [run_socks_server(), run_socks_server()]
+    yield servers
+    for server in servers:
+        server.shutdown()
+        server.server_close()
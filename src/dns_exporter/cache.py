@@ -0,0 +1,345 @@
+"""``dns_exporter.cache`` contains the caches used to avoid repeating work for identical scrapes.
+
+Scrapes with a hostname ``server`` and no ``ip`` need the IP of the server before the DNS query can be sent.
+Resolving it with a blocking ``socket.getaddrinfo()`` for every scrape makes the system resolver a bottleneck
+on busy exporters, so the addresses are kept in a process-wide cache for ``--resolve-cache-ttl`` seconds.
+Failed lookups are cached too, for ``--resolve-cache-negative-ttl`` seconds.
+
+Building the effective config for a scrape from the defaults, the module and the querystring is also repeated for
+every identical scrape, so the built ``Config`` objects are kept in a ``ConfigCache``.
+
+Config files with many modules take a long time to compile, so the compiled modules can be saved in a file in the
+``--module-cache-dir`` directory. The file name has a hash of the config file and the dns_exporter version, so a
+changed config file or a new version of dns_exporter never uses an old cache file.
+
+Rendering the ``/metrics`` output can take a long time when ``dnsexp_dns_responsetime_seconds`` has many series, so
+the rendered output is kept in a ``MetricsCache`` for ``--metrics-cache-max-age`` seconds, and concurrent requests
+share one render.
+"""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+import logging
+import os
+import pickle
+import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from dns_exporter.config import Modules
+from dns_exporter.defaults import (
+    DEFAULT_METRICS_CACHE_MAX_AGE,
+    DEFAULT_RESOLVE_CACHE_MAXSIZE,
+    DEFAULT_RESOLVE_CACHE_NEGATIVE_TTL,
+    DEFAULT_RESOLVE_CACHE_TTL,
+)
+from dns_exporter.metrics import dnsexp_resolve_cache_entries, dnsexp_resolve_cache_lookups_total
+from dns_exporter.version import __version__
+
+if TYPE_CHECKING:  # pragma: no cover
+    from collections.abc import Callable, Hashable
+
+    from dns_exporter.config import Config
+
+logger = logging.getLogger(f"dns_exporter.{__name__}")
+
+# the default maximum number of cached configs
+DEFAULT_CONFIG_CACHE_MAXSIZE = 1024
+
+
+class CacheEntry:
+    """The result of a single ``getaddrinfo()`` lookup, a list of addresses or the error, and the expiry time."""
+
+    __slots__ = ("addresses", "error", "expires")
+
+    def __init__(self, addresses: list[str], error: socket.gaierror | None, expires: float) -> None:
+        """Save the lookup result and expiry time."""
+        self.addresses = addresses
+        self.error = error
+        self.expires = expires
+
+
+class ResolveCache:
+    """Thread-safe LRU cache of ``getaddrinfo()`` results keyed by ``(hostname, family)``.
+
+    ``getaddrinfo()`` does not return the TTL of the records, so entries are kept for a fixed number of seconds.
+    Set ``ttl`` to 0 to disable the cache.
+    """
+
+    def __init__(
+        self,
+        ttl: float = DEFAULT_RESOLVE_CACHE_TTL,
+        negative_ttl: float = DEFAULT_RESOLVE_CACHE_NEGATIVE_TTL,
+        maxsize: int = DEFAULT_RESOLVE_CACHE_MAXSIZE,
+    ) -> None:
+        """Save settings and initialise the cache."""
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self._entries: OrderedDict[tuple[str, int], CacheEntry] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """Return the number of cached hostnames."""
+        return len(self._entries)
+
+    def resolve(self, hostname: str, family: int) -> list[str]:
+        """Return the addresses of the hostname in the address family, from the cache if possible.
+
+        Raises socket.gaierror if the lookup failed, also when the failure is cached.
+        """
+        key = (hostname, family)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires > now:
+                self._entries.move_to_end(key)
+            elif entry is not None:
+                del self._entries[key]
+                dnsexp_resolve_cache_entries.set(len(self._entries))
+        if entry is not None and entry.expires > now:
+            dnsexp_resolve_cache_lookups_total.labels(result="hit").inc()
+            if entry.error:
+                # raise a new exception, the cached one might be raised in other threads at the same time
+                raise socket.gaierror(*entry.error.args)
+            return entry.addresses
+
+        dnsexp_resolve_cache_lookups_total.labels(result="miss" if entry is None else "expired").inc()
+        logger.debug(f"doing getaddrinfo for hostname {hostname} for family {family}")
+        try:
+            addresses = [str(result[4][0]) for result in socket.getaddrinfo(hostname, 0, family=family)]
+        except socket.gaierror as e:
+            self.store(key=key, entry=CacheEntry(addresses=[], error=e, expires=now + self.negative_ttl))
+            raise
+        self.store(key=key, entry=CacheEntry(addresses=addresses, error=None, expires=now + self.ttl))
+        return addresses
+
+    def store(self, key: tuple[str, int], entry: CacheEntry) -> None:
+        """Add the entry to the cache, evicting the least recently used entries if the cache is full."""
+        if self.ttl <= 0:
+            # the cache is disabled
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            dnsexp_resolve_cache_entries.set(len(self._entries))
+
+    def clear(self) -> None:
+        """Remove all entries from the cache."""
+        with self._lock:
+            self._entries.clear()
+            dnsexp_resolve_cache_entries.set(0)
+
+
+resolve_cache = ResolveCache()
+"""``resolve_cache`` is the process-wide cache of resolved DNS server hostnames."""
+
+
+def configure_resolve_cache(ttl: float, negative_ttl: float, maxsize: int) -> None:
+    """Set the TTL, negative TTL and maximum size of the resolve cache."""
+    resolve_cache.ttl = ttl
+    resolve_cache.negative_ttl = negative_ttl
+    resolve_cache.maxsize = maxsize
+    resolve_cache.clear()
+    logger.debug(f"Resolve cache configured with ttl {ttl}, negative_ttl {negative_ttl} and maxsize {maxsize}")
+
+
+class ConfigCache:
+    """Thread-safe LRU cache of built ``Config`` objects.
+
+    The cached configs are shared between scrapes, so callers must copy a config before changing it.
+
+    The ``generation`` is increased every time configs are removed. A config built from modules which were
+    replaced while it was being built is not added to the cache, if the caller passes the generation from before
+    the build to ``put()``.
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_CONFIG_CACHE_MAXSIZE) -> None:
+        """Save settings and initialise the cache."""
+        self.maxsize = maxsize
+        self.generation = 0
+        self._entries: OrderedDict[Hashable, Config] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """Return the number of cached configs."""
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Config | None:
+        """Return the cached config for the key, or None."""
+        with self._lock:
+            config = self._entries.get(key)
+            if config is not None:
+                self._entries.move_to_end(key)
+            return config
+
+    def put(self, key: Hashable, config: Config, generation: int | None = None) -> None:
+        """Add the config to the cache, evicting the least recently used configs if the cache is full.
+
+        If generation is given and configs were removed since then the config is not added.
+        """
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = config
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, match: Callable[[Hashable], bool]) -> int:
+        """Remove the configs with keys for which match() returns True and return the number removed."""
+        with self._lock:
+            self.generation += 1
+            keys = [key for key in self._entries if match(key)]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def clear(self) -> None:
+        """Remove all configs from the cache."""
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+
+def get_module_cache_path(directory: str, config_file: str, data: bytes) -> Path:
+    """Return the path of the module cache file for the config file and its contents in the cache directory.
+
+    The name starts with a hash of the config file path, so exporters with different config files can share the
+    cache directory without removing each others cache files.
+    """
+    prefix = hashlib.sha256(str(Path(config_file).resolve()).encode()).hexdigest()[:16]
+    digest = hashlib.sha256(f"{__version__}\n".encode() + data).hexdigest()
+    return Path(directory) / f"modules-{prefix}-{digest}.pickle"
+
+
+def load_module_cache(path: Path) -> Modules | None:
+    """Return the compiled modules from the module cache file, or None if there is no usable cache file.
+
+    The cache file is unpickled, so the cache directory must not be writable by anyone who should not be able to
+    run code as the exporter.
+    """
+    try:
+        with path.open("rb") as f:
+            modules = pickle.load(f)  # noqa: S301
+    except FileNotFoundError:
+        logger.debug(f"Module cache file {path} not found")
+        return None
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+        logger.warning(f"Unable to read module cache file {path}, ignoring it", exc_info=True)
+        return None
+    if not isinstance(modules, Modules):
+        logger.warning(f"Module cache file {path} does not contain modules, ignoring it")
+        return None
+    logger.debug(f"Loaded {len(modules)} compiled module(s) from module cache file {path}")
+    return modules
+
+
+def save_module_cache(path: Path, modules: Modules) -> None:
+    """Save the compiled modules to the module cache file and remove older cache files for the same config file.
+
+    The file is written to a temporary file first, so other processes never read a partially written file.
+    """
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tmp.open("wb") as f:
+            pickle.dump(modules, f, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp.replace(path)
+        prefix = path.name.rsplit("-", 1)[0]
+        for old in path.parent.glob(f"{prefix}-*.pickle"):
+            if old != path:
+                old.unlink(missing_ok=True)
+    except OSError:
+        logger.warning(f"Unable to write module cache file {path}", exc_info=True)
+        tmp.unlink(missing_ok=True)
+        return
+    logger.debug(f"Saved {len(modules)} compiled module(s) to module cache file {path}")
+
+
+class RenderedMetrics:
+    """The rendered output of the ``/metrics`` endpoint in one format, and the time it was rendered."""
+
+    __slots__ = ("_gzipped", "created", "plain")
+
+    def __init__(self, plain: bytes, created: float) -> None:
+        """Save the output and the time it was rendered."""
+        self.plain = plain
+        self.created = created
+        self._gzipped: bytes | None = None
+
+    def gzipped(self) -> bytes:
+        """Return the gzip compressed output, it is only compressed the first time."""
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.plain)
+        return self._gzipped
+
+
+class MetricsCache:
+    """Thread-safe cache of the rendered output of the ``/metrics`` endpoint, keyed by the content type.
+
+    The output is reused for ``max_age`` seconds. Requests which arrive while the output is being rendered wait for
+    that render instead of starting their own, also when ``max_age`` is 0.
+    """
+
+    def __init__(self, max_age: float = DEFAULT_METRICS_CACHE_MAX_AGE) -> None:
+        """Save settings and initialise the cache."""
+        self.max_age = max_age
+        self._entries: dict[str, RenderedMetrics] = {}
+        self._renders: dict[str, Future[RenderedMetrics]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str, render: Callable[[], bytes]) -> RenderedMetrics:
+        """Return the cached output for the key, or the output of a render started now or by another thread.
+
+        Exceptions raised by render() are raised in all the threads waiting for the render.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry.created < self.max_age:
+                return entry
+            future = self._renders.get(key)
+            owner = future is None
+            if future is None:
+                future = self._renders[key] = Future()
+        if not owner:
+            logger.debug(f"Waiting for the render of the {key} metrics output started by another request")
+            return future.result()
+
+        try:
+            entry = RenderedMetrics(plain=render(), created=time.monotonic())
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(entry)
+        finally:
+            with self._lock:
+                del self._renders[key]
+                if future.exception() is None:
+                    self._entries[key] = future.result()
+        return entry
+
+    def clear(self) -> None:
+        """Remove all rendered output from the cache."""
+        with self._lock:
+            self._entries.clear()
+
+
+metrics_cache = MetricsCache()
+"""``metrics_cache`` is the process-wide cache of the rendered ``/metrics`` output."""
+
+
+def configure_metrics_cache(max_age: float) -> None:
+    """Set the maximum age of the rendered ``/metrics`` output."""
+    metrics_cache.max_age = max_age
+    metrics_cache.clear()
+    logger.debug(f"Metrics cache configured with max_age {max_age}")
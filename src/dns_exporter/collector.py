@@ -3,8 +3,10 @@
 from __future__ import annotations
 
 import contextlib
+import functools
+import itertools
 import logging
-import re
+import operator
 import socket
 import ssl
 import time
@@ -13,6 +15,7 @@ from typing import TYPE_CHECKING
 import dns.edns
 import dns.exception
 import dns.flags
+import dns.inet
 import dns.opcode
 import dns.query
 import dns.quic
@@ -20,21 +23,43 @@ import dns.rcode
 import dns.rdatatype
 import dns.resolver
 import httpx  # type: ignore[import]
-import socks  # type: ignore[import]
 from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 from prometheus_client.registry import Collector
 
+from dns_exporter.connections import (
+    PipelinedTCPConnection,
+    create_doh_client,
+    create_quic_manager,
+    doh_clients,
+    dot_sockets,
+    get_quic_connection,
+    get_ssl_context,
+    open_tls_connection,
+    quic_managers,
+    tcp_connections,
+    tls_sessions,
+    use_proxy,
+)
 from dns_exporter.exceptions import ProtocolSpecificError, UnknownFailureReasonError, ValidationError
 from dns_exporter.metrics import (
     FAILURE_REASONS,
     TTL_LABELS,
+    dnsexp_dns_phase_duration_seconds,
     dnsexp_dns_queries_total,
     dnsexp_dns_responsetime_seconds,
     dnsexp_scrape_failures_total,
+    dnsexp_tls_handshakes_total,
+    get_dns_connection_reused_metric,
+    get_dns_phase_metric,
     get_dns_qtime_metric,
+    get_dns_rr_count_metric,
     get_dns_success_metric,
+    get_dns_ttl_max_metric,
     get_dns_ttl_metric,
+    get_dns_ttl_min_metric,
+    get_dns_ttl_truncated_metric,
 )
+from dns_exporter.phases import PhaseTimer
 from dns_exporter.version import __version__
 
 if TYPE_CHECKING:  # pragma: no cover
@@ -43,40 +68,118 @@ if TYPE_CHECKING:  # pragma: no cover
     from ipaddress import IPv4Address, IPv6Address
 
     from dns.message import Message, QueryMessage
+    from dns.rdata import Rdata
+    from dns.rrset import RRset
 
     from dns_exporter.config import Config, RRValidator
+    from dns_exporter.connections import DoHClient
 
 logger = logging.getLogger(f"dns_exporter.{__name__}")
 
 
+@contextlib.contextmanager
+def dot_exceptions() -> Iterator[None]:
+    """Translate the protocol specific exceptions raised by DoT queries to ProtocolSpecificError."""
+    try:
+        yield
+    except ssl.SSLCertVerificationError as e:
+        # raised by dot on certificate verification error
+        logger.debug(
+            "Protocol dot raised ssl.SSLCertVerificationError, returning certificate_error",
+        )
+        raise ProtocolSpecificError("certificate_error") from e
+    except ValueError as e:
+        # raised by dot when ca path is not found
+        logger.debug("Protocol dot raised ValueError, is verify_certificate_path wrong?")
+        raise ProtocolSpecificError("invalid_request_config") from e
+
+
+@contextlib.contextmanager
+def doh_exceptions() -> Iterator[None]:
+    """Translate the protocol specific exceptions raised by DoH queries to ProtocolSpecificError."""
+    try:
+        yield
+    except httpx.ConnectError as e:
+        # raised by doh on both certificate errors and other connection issues
+        reason = "certificate_error" if "CERTIFICATE_VERIFY_FAILED" in str(e) else "connection_error"
+        logger.debug(f"Protocol doh raised exception, returning {reason}")
+        raise ProtocolSpecificError(reason) from e
+    except httpx.ConnectTimeout as e:
+        # raised by doh on timeouts
+        reason = "timeout"
+        logger.debug(f"Protocol doh raised exception, returning {reason}")
+        raise ProtocolSpecificError(reason) from e
+    except OSError as e:
+        # raised by doh when ca path is not found
+        logger.debug("Protocol doh unable to find CA path, returning invalid_request_config")
+        raise ProtocolSpecificError("invalid_request_config") from e
+    except ValueError as e:
+        # raised by doh when the server response with a non-2XX HTTP status code
+        logger.debug(
+            "Protocol doh raised ValueErrror due to non-2XX status_code - returning invalid_response_statuscode"
+        )
+        raise ProtocolSpecificError("invalid_response_statuscode") from e
+
+
+@contextlib.contextmanager
+def quic_exceptions(protocol: str) -> Iterator[None]:
+    """Translate the protocol specific exceptions raised by DoQ and DoH3 queries to ProtocolSpecificError."""
+    try:
+        yield
+    except dns.quic._common.UnexpectedEOF as e:  # noqa: SLF001
+        # raised by doq and doh3 when an invalid CA path is passed,
+        # and a bunch of other error cases
+        logger.debug(
+            f"Protocol {protocol} raised dns.quic._common.UnexpectedEOF",
+            exc_info=True,
+        )
+        raise ProtocolSpecificError("connection_error") from e
+    except ValueError as e:
+        # raised by doh3 when the server response with a non-2XX HTTP status code
+        logger.debug(
+            f"Protocol {protocol} raised ValueErrror due to non-2XX status_code - returning invalid_response_statuscode"
+        )
+        raise ProtocolSpecificError("invalid_response_statuscode") from e
+
+
+# all the DNS header flags as a mask, the rest of the header flags field is the opcode and rcode
+FLAGS_MASK = int(functools.reduce(operator.or_, dns.flags.Flag, 0))
+
+# the flags label value (the flags as sorted text) for every combination of header flags
+FLAGS_LABELS = {
+    flags: " ".join(sorted(dns.flags.to_text(flags).split(" ")))
+    for flags in range(FLAGS_MASK + 1)
+    if flags & FLAGS_MASK == flags
+}
+
+
 class DNSCollector(Collector):
     """Custom collector class which does DNS lookups and returns metrics."""
 
     # set the version on the class
     __version__: str = __version__
 
-    def __init__(
+    def __init__(  # noqa: PLR0913
         self,
         config: Config,
         query: QueryMessage,
         labels: dict[str, str],
+        wire: bytes | None = None,
+        timer: PhaseTimer | None = None,
     ) -> None:
-        """Save config and q object as class attributes for use later."""
+        """Save config and q object as class attributes for use later.
+
+        ``wire`` is the prebuilt wire format of the query, when given it is sent as-is for protocols ``udp`` and
+        ``tcp`` instead of rendering the query again. ``timer`` is the PhaseTimer of the scrape, which might
+        already have the time spent resolving the server hostname.
+        """
         self.config = config
         self.query = query
         self.labels = labels
-        # set proxy?
-        if self.config.proxy:
-            socks.set_default_proxy(
-                proxy_type=getattr(socks, self.config.proxy.scheme.upper()),
-                addr=self.config.proxy.hostname,
-                port=self.config.proxy.port,
-            )
-            dns.query.socket_factory = socks.socksocket
-            logger.debug(f"Using proxy {self.config.proxy.geturl()}")
-        else:
-            dns.query.socket_factory = socket.socket
-            logger.debug("Not using a proxy for this request")
+        self.wire = wire
+        self.timer = PhaseTimer() if timer is None else timer
+        # did the query use an existing pooled connection? None when pools are not used
+        self.connection_reused: bool | None = None
 
     def describe(self) -> Iterator[CounterMetricFamily | GaugeMetricFamily]:
         """Describe the metrics that are to be returned by this collector."""
@@ -111,86 +214,101 @@ class DNSCollector(Collector):
 
         r = None
         transport = "NONE"
+        reason = ""
         # mark the start time and do the request
         start = time.time()
         try:
-            r, transport = self.get_dns_response(
-                protocol=str(self.config.protocol),
-                server=self.config.server,
-                ip=self.config.ip,
-                port=self.config.server.port,
-                query=self.query,
-                timeout=float(str(self.config.timeout)),
-            )
+            # the proxy (if any) is only used for sockets created by this thread
+            with use_proxy(self.config.proxy), self.timer.measure("query"):
+                r, transport = self.get_dns_response(
+                    protocol=str(self.config.protocol),
+                    server=self.config.server,
+                    ip=self.config.ip,
+                    port=self.config.server.port,
+                    query=self.query,
+                    timeout=float(str(self.config.timeout)),
+                )
             logger.debug(
                 f"Protocol {self.config.protocol} got a DNS query response over {transport}",
             )
-        except dns.exception.Timeout:
+        except Exception as e:  # noqa: BLE001
+            reason = self.get_failure_reason(e)
+
+        # clock it
+        qtime = time.time() - start
+        if r is not None:
+            self.timer.split_response(response=r)
+
+        yield from self.collect_result(response=r, transport=transport, qtime=qtime, reason=reason)
+
+    def get_failure_reason(self, e: Exception) -> str:
+        """Return the failure reason for an exception raised by the DNS query and increase the failure metric."""
+        if isinstance(e, dns.exception.Timeout):
             # configured timeout was reached before a response arrived
             reason = "timeout"
-            self.increase_failure_reason_metric(failure_reason=reason, labels=self.labels)
-        except ConnectionRefusedError:
+        elif isinstance(e, ConnectionRefusedError):
             # server actively refused the connection
             reason = "connection_error"
-            self.increase_failure_reason_metric(
-                failure_reason=reason,
-                labels=self.labels,
-            )
-        except OSError as e:
+        elif isinstance(e, OSError):
             # raised by multiple protocols on ICMP unreach
-            logger.debug(f"Protocol {self.config.protocol} got OSError '{e}', exception follows", exc_info=True)
+            logger.debug(f"Protocol {self.config.protocol} got OSError '{e}', exception follows", exc_info=e)
             reason = "connection_error"
-            self.increase_failure_reason_metric(
-                failure_reason=reason,
-                labels=self.labels,
-            )
-        except ProtocolSpecificError as e:
+        elif isinstance(e, ProtocolSpecificError):
             # a protocol specific exception was raised, log and re-raise
             logger.debug(
                 f"Protocol {self.config.protocol} raised exception, returning failure reason {e}",
-                exc_info=True,
+                exc_info=e,
             )
             reason = str(e)
-            self.increase_failure_reason_metric(failure_reason=reason, labels=self.labels)
-        except Exception:  # noqa: BLE001
+        else:
             logger.warning(
                 f"""Caught an unknown exception while looking up qname {self.config.query_name} using server
-                {self.config.server.geturl()} and proxy {self.config.proxy.geturl() if self.config.proxy else 'none'}
+                {self.config.server.geturl() if self.config.server else 'none'} and proxy
+                {self.config.proxy.geturl() if self.config.proxy else 'none'}
                 - exception details follow, returning other_failure""",
-                exc_info=True,
+                exc_info=e,
             )
             reason = "other_failure"
-            self.increase_failure_reason_metric(failure_reason=reason, labels=self.labels)
-
-        # clock it
-        qtime = time.time() - start
+        self.increase_failure_reason_metric(failure_reason=reason, labels=self.labels)
+        return reason
 
+    def collect_result(
+        self, response: Message | None, transport: str, qtime: float, reason: str
+    ) -> Iterator[CounterMetricFamily | GaugeMetricFamily]:
+        """Yield the metrics for the result of the DNS query, the response is None if the query failed."""
         # did we get a response?
-        if r is None:
+        if response is None:
             logger.warning(
-                f"No DNS response received from server {self.config.server.geturl()} - failure reason is '{reason}'..."
+                f"No DNS response received from server {self.config.server.geturl()} - failure reason is '{reason}'..."  # type: ignore[union-attr]
             )
             yield from (get_dns_qtime_metric(), get_dns_ttl_metric(), get_dns_success_metric(value=0))
-            return None
+            yield from self.yield_phase_metrics()
+            return
 
         # parse response (if any) and yield metrics
-        yield from self.handle_response(response=r, transport=transport, qtime=qtime)
+        yield from self.handle_response(response=response, transport=transport, qtime=qtime)
+        yield from self.yield_phase_metrics()
+
+    def yield_phase_metrics(self) -> Iterator[GaugeMetricFamily]:
+        """Yield the time spent in each phase of the scrape and update the internal phase histogram."""
+        phase_metric = get_dns_phase_metric()
+        for phase, seconds in self.timer.seconds().items():
+            phase_metric.add_metric(labels=[phase], value=seconds)
+            dnsexp_dns_phase_duration_seconds.labels(protocol=self.config.protocol, phase=phase).observe(seconds)
+        yield phase_metric
 
     def handle_response(
         self, response: Message, transport: str, qtime: float
     ) -> Iterator[CounterMetricFamily | GaugeMetricFamily]:
         """Do response processing and yield metrics."""
-        # convert response flags to sorted text
-        flags = dns.flags.to_text(response.flags).split(" ")
-        flags.sort()
-
         # update labels with data from the response
         self.labels.update(
             {
                 "transport": transport,
                 "opcode": dns.opcode.to_text(response.opcode()),
                 "rcode": dns.rcode.to_text(response.rcode()),
-                "flags": " ".join(flags),
+                # the flags as sorted text, from the precomputed table
+                "flags": FLAGS_LABELS[response.flags & FLAGS_MASK],
                 "answer": str(sum([len(rrset) for rrset in response.answer])),
                 "authority": str(len(response.authority)),
                 "additional": str(len(response.additional)),
@@ -206,15 +324,19 @@ class DNSCollector(Collector):
         qtime_metric.add_metric(labels=list(self.labels.values()), value=qtime)
         yield qtime_metric
 
+        if self.connection_reused is not None:
+            yield get_dns_connection_reused_metric(value=int(self.connection_reused))
+
         # update internal exporter metric
-        dnsexp_dns_responsetime_seconds.labels(**self.labels).observe(qtime)
+        dnsexp_dns_responsetime_seconds.observe(labels=self.labels, value=qtime)
 
         yield from self.yield_ttl_metrics(response=response)
 
         # validate response and yield remaining metrics
         logger.debug("Validating response and yielding remaining metrics")
         try:
-            self.validate_response(response=response)
+            with self.timer.measure("validate"):
+                self.validate_response(response=response)
             self.increase_failure_reason_metric(failure_reason="", labels=self.labels)
             yield get_dns_success_metric(1)
         except ValidationError as E:
@@ -240,29 +362,67 @@ class DNSCollector(Collector):
                     self.labels.update({"nsid": nsid})
                 break
 
+    @staticmethod
+    def iter_rrsets(response: Message) -> Iterator[tuple[str, str, str, RRset]]:
+        """Yield the section, RR name and RR type as text and the RRset for each RRset in the response."""
+        for section in ["answer", "authority", "additional"]:
+            for rrset in getattr(response, section):
+                yield section, str(rrset.name), dns.rdatatype.to_text(rrset.rdtype), rrset
+
+    def iter_rrs(self, response: Message) -> Iterator[tuple[str, str, str, int, Rdata]]:
+        """Yield the section, RR name and RR type as text, the TTL and the RR for each RR in the response."""
+        for section, name, rdtype, rrset in self.iter_rrsets(response=response):
+            for rr in rrset:
+                yield section, name, rdtype, rrset.ttl, rr
+
     def yield_ttl_metrics(self, response: Message) -> Iterator[GaugeMetricFamily]:
-        """Register TTL of response RRs and yield ttl metric."""
+        """Register TTL of response RRs and yield ttl metrics.
+
+        At most ``collect_ttl_max_rrs`` RRs are included if it is set. The RRs are only rendered as text for the
+        ``rr_value`` label when ``collect_ttl_rr_value_length`` is not 0.
+        """
         ttl = get_dns_ttl_metric()
-        if self.config.collect_ttl:
-            for section in ["answer", "authority", "additional"]:
-                logger.debug(f"processing section {section}")
-                rrsets = getattr(response, section)
-                for rrset in rrsets:
-                    logger.debug(f"processing rrset {rrset}...")
-                    for rr in rrset:
-                        logger.debug(f"processing rr {rr}")
-                        self.labels.update(
-                            {
-                                "rr_section": section,
-                                "rr_name": str(rrset.name),
-                                "rr_type": dns.rdatatype.to_text(rr.rdtype),
-                                "rr_value": rr.to_text()[: self.config.collect_ttl_rr_value_length],
-                            },
-                        )
-                        ttl.add_metric(list(self.labels.values()), rrset.ttl)
+        if not self.config.collect_ttl:
+            yield ttl
+            return
+        if self.config.collect_ttl_aggregate:
+            yield ttl
+            yield from self.yield_ttl_aggregate_metrics(response=response)
+            return
+        labels = list(self.labels.values())
+        length = self.config.collect_ttl_rr_value_length
+        rrs = self.iter_rrs(response=response)
+        for section, name, rdtype, rrttl, rr in itertools.islice(rrs, self.config.collect_ttl_max_rrs or None):
+            value = rr.to_text()[:length] if length else ""
+            ttl.add_metric([*labels, section, name, rdtype, value], rrttl)
         # yield all the ttl metrics
-        logger.debug("yielding ttl metrics")
+        logger.debug(f"yielding {len(ttl.samples)} ttl metrics")
         yield ttl
+        if self.config.collect_ttl_max_rrs:
+            truncated = next(rrs, None) is not None
+            if truncated:
+                logger.debug(f"Response has more than {self.config.collect_ttl_max_rrs} RRs, ttl metrics truncated")
+            yield get_dns_ttl_truncated_metric(value=int(truncated))
+
+    def yield_ttl_aggregate_metrics(self, response: Message) -> Iterator[GaugeMetricFamily]:
+        """Yield the lowest and highest TTL and the number of RRs for each section, RR name and RR type."""
+        # the lowest TTL, highest TTL and number of RRs, keyed by section, RR name and RR type
+        aggregated: dict[tuple[str, str, str], tuple[int, int, int]] = {}
+        for section, name, rdtype, rrset in self.iter_rrsets(response=response):
+            key = (section, name, rdtype)
+            if key in aggregated:
+                low, high, count = aggregated[key]
+                aggregated[key] = (min(low, rrset.ttl), max(high, rrset.ttl), count + len(rrset))
+            else:
+                aggregated[key] = (rrset.ttl, rrset.ttl, len(rrset))
+        labels = list(self.labels.values())
+        ttl_min, ttl_max, rr_count = get_dns_ttl_min_metric(), get_dns_ttl_max_metric(), get_dns_rr_count_metric()
+        for key, (low, high, count) in aggregated.items():
+            ttl_min.add_metric([*labels, *key], low)
+            ttl_max.add_metric([*labels, *key], high)
+            rr_count.add_metric([*labels, *key], count)
+        logger.debug(f"yielding aggregated ttl metrics for {len(aggregated)} rrsets")
+        yield from (ttl_min, ttl_max, rr_count)
 
     def get_dns_response(  # noqa: PLR0913
         self,
@@ -286,16 +446,7 @@ class DNSCollector(Collector):
         proxy = self.config.proxy.geturl() if self.config.proxy else "is not active"
 
         # verify certificate?
-        verify: bool | str
-        if self.config.verify_certificate_path and self.config.verify_certificate:
-            # verify with custom CA path
-            verify = self.config.verify_certificate_path
-        elif self.config.verify_certificate:
-            # verify with default system CA
-            verify = True
-        else:
-            # do not verify
-            verify = False
+        verify = self.get_verify()
         logger.debug(
             f"Doing DNS query {query.question} with server {server.geturl()} (using IP {ip}) and proxy {proxy}",
         )
@@ -351,6 +502,17 @@ class DNSCollector(Collector):
             )
             transport = "TCP"
 
+        elif protocol == "doh3":
+            r = self.get_dns_response_doh3(
+                query=query,
+                ip=str(ip),
+                port=port,
+                timeout=timeout,
+                server=server,
+                verify=verify,
+            )
+            transport = "QUIC"
+
         elif protocol == "doq":
             r = self.get_dns_response_doq(
                 query=query,
@@ -364,25 +526,127 @@ class DNSCollector(Collector):
 
         return r, transport
 
+    def get_verify(self) -> bool | str:
+        """Return the verify argument for encrypted protocols, a CA path or a bool to enable/disable verification."""
+        if self.config.verify_certificate_path and self.config.verify_certificate:
+            # verify with custom CA path
+            return self.config.verify_certificate_path
+        # verify with default system CA, or do not verify
+        return bool(self.config.verify_certificate)
+
     def get_dns_response_udp(self, query: Message, ip: str, port: int, timeout: float) -> Message | None:
         """Perform a DNS query with the udp protocol."""
-        return dns.query.udp(
-            q=query,
-            where=ip,
-            port=port,
-            timeout=timeout,
-            one_rr_per_rrset=True,
-        )
+        if self.wire is None:
+            return dns.query.udp(
+                q=query,
+                where=ip,
+                port=port,
+                timeout=timeout,
+                one_rr_per_rrset=True,
+            )
+        # send the prebuilt wire format
+        af = dns.inet.af_for_address(ip)
+        destination = dns.inet.low_level_address_tuple((ip, port), af)
+        expiration = time.time() + timeout
+        r: Message
+        with dns.query.make_socket(af, socket.SOCK_DGRAM) as sock:
+            _, begin_time = dns.query.send_udp(sock, self.wire, destination, expiration)
+            r, received_time = dns.query.receive_udp(sock, destination, expiration, one_rr_per_rrset=True, query=query)
+        # like dns.query.udp() does, so the timer can tell the query and parse phases apart
+        r.time = received_time - begin_time
+        if not query.is_response(r):
+            raise dns.query.BadResponse
+        return r
 
     def get_dns_response_tcp(self, query: Message, ip: str, port: int, timeout: float) -> Message | None:
-        """Perform a DNS query with the tcp protocol."""
-        return dns.query.tcp(
-            q=query,
-            where=ip,
-            port=port,
-            timeout=timeout,
-            one_rr_per_rrset=True,
+        """Perform a DNS query with the tcp protocol.
+
+        With ``reuse_connections`` enabled the query is pipelined over a pooled connection shared with other scrapes.
+        If the server closed the pooled connection the query is retried once on a new connection.
+        """
+        if not self.config.reuse_connections and self.wire is None:
+            return dns.query.tcp(
+                q=query,
+                where=ip,
+                port=port,
+                timeout=timeout,
+                one_rr_per_rrset=True,
+            )
+        if not self.config.reuse_connections:
+            return self.get_dns_response_tcp_wire(query=query, ip=ip, port=port, timeout=timeout)
+        key = (ip, port, self.config.proxy.geturl() if self.config.proxy else None)
+        connection = self.get_tcp_connection(key=key, ip=ip, port=port, timeout=timeout)
+        try:
+            return self.query_tcp_connection(key=key, connection=connection, query=query, timeout=timeout)
+        except EOFError as e:
+            if not self.connection_reused:
+                raise ProtocolSpecificError("connection_error") from e
+        # the server closed the pooled connection, try again with a new connection
+        logger.debug(f"Pooled TCP connection to {ip}:{port} was closed by the server, reconnecting")
+        connection = self.get_tcp_connection(key=key, ip=ip, port=port, timeout=timeout)
+        try:
+            return self.query_tcp_connection(key=key, connection=connection, query=query, timeout=timeout)
+        except EOFError as e:
+            raise ProtocolSpecificError("connection_error") from e
+
+    def query_tcp_connection(
+        self, key: tuple[str, int, str | None], connection: PipelinedTCPConnection, query: Message, timeout: float
+    ) -> Message:
+        """Send the query on the pooled TCP connection, the connection is removed from the pool if the query fails.
+
+        A server which silently went away never closes the connection, so it is also removed on a timeout. Otherwise
+        every later scrape would use it and time out, and the next scrape opens a new connection instead.
+        """
+        try:
+            return connection.query(q=query, timeout=timeout, wire=self.wire)
+        except (EOFError, dns.exception.Timeout):
+            tcp_connections.discard(key=key, connection=connection)
+            raise
+
+    def get_dns_response_tcp_wire(self, query: Message, ip: str, port: int, timeout: float) -> Message:
+        """Send the prebuilt wire format of the query on a new TCP connection and return the response."""
+        if TYPE_CHECKING:  # pragma: no cover
+            assert self.wire is not None
+        expiration = time.time() + timeout
+        with dns.query.make_socket(dns.inet.af_for_address(ip), socket.SOCK_STREAM) as sock:
+            try:
+                sock.settimeout(timeout)
+                with self.timer.measure("connect"):
+                    sock.connect((ip, port))
+            except socket.timeout as e:
+                raise dns.exception.Timeout from e
+            sock.setblocking(False)  # noqa: FBT003
+            _, begin_time = dns.query.send_tcp(sock, self.wire, expiration)
+            r, received_time = dns.query.receive_tcp(sock, expiration, one_rr_per_rrset=True)
+        r.time = received_time - begin_time
+        if not query.is_response(r):
+            raise dns.query.BadResponse
+        return r
+
+    def get_tcp_connection(
+        self, key: tuple[str, int, str | None], ip: str, port: int, timeout: float
+    ) -> PipelinedTCPConnection:
+        """Return a usable pooled PipelinedTCPConnection to ip and port, opening a new one if needed."""
+        connection: PipelinedTCPConnection
+        connection, reused = tcp_connections.get(
+            key=key,
+            factory=lambda: self.open_tcp_connection(ip=ip, port=port, timeout=timeout),
         )
+        if not connection.usable():
+            # closed by the server, or idle for longer than the edns-tcp-keepalive timeout
+            tcp_connections.discard(key=key, connection=connection)
+            connection, reused = tcp_connections.get(
+                key=key,
+                factory=lambda: self.open_tcp_connection(ip=ip, port=port, timeout=timeout),
+            )
+        logger.debug(f"Using {'existing' if reused else 'new'} pooled TCP connection to {ip}:{port}")
+        self.connection_reused = reused
+        return connection
+
+    def open_tcp_connection(self, ip: str, port: int, timeout: float) -> PipelinedTCPConnection:
+        """Open a new PipelinedTCPConnection to ip and port, the time is measured as the ``connect`` phase."""
+        with self.timer.measure("connect"):
+            return PipelinedTCPConnection(ip=ip, port=port, timeout=timeout)
 
     def get_dns_response_udptcp(self, query: Message, ip: str, port: int, timeout: float) -> tuple[Message | None, str]:
         """Perform a DNS query with the udptcp protocol (with fallback to TCP)."""
@@ -399,71 +663,233 @@ class DNSCollector(Collector):
         self, query: Message, ip: str, port: int, timeout: float, server: urllib.parse.SplitResult, verify: str | bool
     ) -> Message | None:
         """Perform a DNS query with the dot protocol and catch protocol specific exceptions."""
-        try:
+        with dot_exceptions():
+            # the SSLContext is cached, no need to load the CA bundle for every scrape
+            ssl_context = get_ssl_context(verify=verify, check_hostname=bool(verify))
+            if self.config.reuse_connections or self.config.tls_session_resumption:
+                return self.get_dns_response_dot_pooled(
+                    query=query,
+                    ip=ip,
+                    port=port,
+                    timeout=timeout,
+                    server=server,
+                    verify=verify,
+                    ssl_context=ssl_context,
+                )
             # DoT query, use the ip for where= and set tls hostname with server_hostname=
-            return dns.query.tls(
+            r = dns.query.tls(
                 q=query,
                 where=ip,
                 port=port,
                 server_hostname=server.hostname if verify else None,
                 timeout=timeout,
-                verify=verify,
+                ssl_context=ssl_context,
                 one_rr_per_rrset=True,
             )
-        except ssl.SSLCertVerificationError as e:
-            # raised by dot on certificate verification error
-            logger.debug(
-                "Protocol dot raised ssl.SSLCertVerificationError, returning certificate_error",
+        dnsexp_tls_handshakes_total.labels(protocol="dot", handshake="full").inc()
+        return r
+
+    def get_dns_response_dot_pooled(  # noqa: PLR0913
+        self,
+        query: Message,
+        ip: str,
+        port: int,
+        timeout: float,
+        server: urllib.parse.SplitResult,
+        verify: str | bool,
+        ssl_context: ssl.SSLContext,
+    ) -> Message | None:
+        """Perform a DNS query with the dot protocol using a pooled connection and/or a resumed TLS session.
+
+        With ``reuse_connections`` enabled an idle pooled connection is used if there is one, if the server closed
+        the pooled connection in the meantime the query is retried on a new connection. New connections resume the
+        previous TLS session with the server if ``tls_session_resumption`` is enabled.
+        """
+        key = (server.hostname, ip, port, verify)
+        if self.config.reuse_connections:
+            self.connection_reused = False
+            sock = dot_sockets.take(key)
+            if sock is not None:
+                try:
+                    r = dns.query.tls(q=query, where=ip, timeout=timeout, sock=sock, one_rr_per_rrset=True)
+                except (EOFError, OSError):
+                    # the server closed the connection, or it broke in some other way
+                    logger.debug("Pooled DoT connection failed, opening a new connection", exc_info=True)
+                    sock.close()
+                except BaseException:
+                    # a timeout or a bad response, the connection can not be used again
+                    sock.close()
+                    raise
+                else:
+                    self.connection_reused = True
+                    dnsexp_tls_handshakes_total.labels(protocol="dot", handshake="none").inc()
+                    dot_sockets.put(key, sock)
+                    return r
+
+        # open a new connection, resuming the previous TLS session if possible
+        start = time.monotonic()
+        session = tls_sessions.take(key) if self.config.tls_session_resumption else None
+        sock = open_tls_connection(
+            ip=ip,
+            port=port,
+            server_hostname=server.hostname if ssl_context.check_hostname else None,
+            ssl_context=ssl_context,
+            session=session,
+            timeout=timeout,
+            timer=self.timer,
+        )
+        handshake = "resumed" if sock.session_reused else "full"
+        dnsexp_tls_handshakes_total.labels(protocol="dot", handshake=handshake).inc()
+        logger.debug(f"Opened new DoT connection to {server.geturl()} with {handshake} TLS handshake")
+        try:
+            r = dns.query.tls(
+                q=query,
+                where=ip,
+                timeout=max(timeout - (time.monotonic() - start), 0),
+                sock=sock,
+                one_rr_per_rrset=True,
             )
-            raise ProtocolSpecificError("certificate_error") from e
-        except ValueError as e:
-            # raised by dot when ca path is not found
-            logger.debug("Protocol dot raised ValueError, is verify_certificate_path wrong?")
-            raise ProtocolSpecificError("invalid_request_config") from e
+        except BaseException:
+            sock.close()
+            raise
+        if self.config.tls_session_resumption and sock.session is not None:
+            # TLS 1.3 session tickets arrive after the handshake so get the session after the query
+            tls_sessions.put(key, sock.session)
+        if self.config.reuse_connections:
+            dot_sockets.put(key, sock)
+        else:
+            sock.close()
+        return r
 
     def get_dns_response_doh(  # noqa: PLR0913
         self, query: Message, ip: str, port: int, timeout: float, server: urllib.parse.SplitResult, verify: str | bool
     ) -> Message | None:
         """Perform a DNS query with the doh protocol and catch protocol specific exceptions."""
-        try:
+        with doh_exceptions():
+            # get a pooled client if connection reuse is enabled
+            session = self.get_doh_session(ip=ip, port=port, server=server, verify=verify)
             # DoH query, use the url for where= and use bootstrap_address= for the ip
-            url = f"https://{server.hostname}{server.path}"
             return dns.query.https(
                 q=query,
-                where=url,
+                where=self.get_doh_url(server=server, port=port),
                 bootstrap_address=ip,
                 port=port,
                 timeout=timeout,
                 verify=verify,
                 one_rr_per_rrset=True,
+                session=session,
             )
-        except httpx.ConnectError as e:
-            # raised by doh on both certificate errors and other connection issues
-            reason = "certificate_error" if "CERTIFICATE_VERIFY_FAILED" in str(e) else "connection_error"
-            logger.debug(f"Protocol doh raised exception, returning {reason}")
-            raise ProtocolSpecificError(reason) from e
-        except httpx.ConnectTimeout as e:
-            # raised by doh on timeouts
-            reason = "timeout"
-            logger.debug(f"Protocol doh raised exception, returning {reason}")
-            raise ProtocolSpecificError(reason) from e
-        except OSError as e:
-            # raised by doh when ca path is not found
-            logger.debug("Protocol doh unable to find CA path, returning invalid_request_config")
-            raise ProtocolSpecificError("invalid_request_config") from e
-        except ValueError as e:
-            # raised by doh when the server response with a non-2XX HTTP status code
-            logger.debug(
-                "Protocol doh raised ValueErrror due to non-2XX status_code - returning invalid_response_statuscode"
-            )
-            raise ProtocolSpecificError("invalid_response_statuscode") from e
+
+    @staticmethod
+    def get_doh_url(server: urllib.parse.SplitResult, port: int) -> str:
+        """Return the https:// url for a DoH query to the server."""
+        if port != 443:  # noqa: PLR2004
+            # dnspython only uses port= when where= is an ip, so put non-default ports in the url
+            return f"https://{server.hostname}:{port}{server.path}"
+        return f"https://{server.hostname}{server.path}"
+
+    def get_doh_session(
+        self, ip: str, port: int, server: urllib.parse.SplitResult, verify: str | bool
+    ) -> httpx.Client | None:
+        """Return a pooled httpx.Client for the DoH server, or None if connection reuse is disabled.
+
+        HTTP/2 clients are always pooled, since sharing one multiplexed connection between scrapes is the point.
+        """
+        http2 = self.config.doh_http2
+        if not self.config.reuse_connections and not http2:
+            return None
+        key = (server.hostname, ip, port, verify, self.config.proxy.geturl() if self.config.proxy else None, http2)
+        session: DoHClient
+        session, reused = doh_clients.get(
+            key=key,
+            factory=lambda: create_doh_client(ip=ip, verify=verify, http2=http2),
+        )
+        logger.debug(f"Using {'existing' if reused else 'new'} pooled DoH client for {server.geturl()}")
+        self.connection_reused = reused and session.has_connections()
+        return session
+
+    def get_dns_response_doh3(  # noqa: PLR0913
+        self, query: Message, ip: str, port: int, timeout: float, server: urllib.parse.SplitResult, verify: str | bool
+    ) -> Message | None:
+        """Perform a DNS query with the doh3 protocol and catch protocol specific exceptions.
+
+        The QUIC connection is kept in the ``quic_managers`` pool and reused by later scrapes to the same server.
+        """
+        url = f"https://{server.hostname}:{port}{server.path}"
+        key = ("doh3", server.hostname, ip, port, verify)
+        manager, reused = quic_managers.get(
+            key=key,
+            factory=lambda: create_quic_manager(hostname=server.hostname, verify=verify, h3=True),
+        )
+        logger.debug(f"Using {'existing' if reused else 'new'} pooled QUIC manager for {server.geturl()}")
+        with quic_exceptions(protocol="doh3"):
+            try:
+                # returns the open connection if the manager has one, or connects
+                connection, self.connection_reused = get_quic_connection(manager=manager, ip=ip, port=port)
+                return dns.query.https(
+                    q=query,
+                    where=url,
+                    bootstrap_address=ip,
+                    port=port,
+                    timeout=timeout,
+                    verify=verify,
+                    one_rr_per_rrset=True,
+                    session=connection,
+                    http_version=dns.query.HTTPVersion.H3,
+                )
+            except ValueError:
+                # a non-2XX HTTP status code, the connection itself is fine
+                raise
+            except Exception:
+                # do not reuse a connection in an unknown state
+                quic_managers.discard(key=key, connection=manager)
+                raise
 
     def get_dns_response_doq(  # noqa: PLR0913
         self, query: Message, ip: str, port: int, timeout: float, server: urllib.parse.SplitResult, verify: str | bool
     ) -> Message | None:
-        """Perform a DNS query with the doh protocol and catch protocol specific exceptions."""
+        """Perform a DNS query with the doq protocol and catch protocol specific exceptions.
+
+        With ``reuse_connections`` enabled the QUIC connection is kept in the ``quic_managers`` pool. If a reused
+        connection turns out to be dead the query is retried once on a new connection.
+        """
+        with quic_exceptions(protocol="doq"):
+            if not self.config.reuse_connections:
+                # DoQ query, use the IP for where= and use server_hostname for the hostname
+                return dns.query.quic(
+                    q=query,
+                    where=ip,
+                    port=port,
+                    server_hostname=server.hostname,
+                    timeout=timeout,
+                    verify=verify,
+                    one_rr_per_rrset=True,
+                )
+            try:
+                return self.get_dns_response_doq_pooled(
+                    query=query, ip=ip, port=port, timeout=timeout, server=server, verify=verify
+                )
+            except dns.quic._common.UnexpectedEOF:  # noqa: SLF001
+                if not self.connection_reused:
+                    raise
+                # the server closed the pooled connection, try again with a new connection
+                logger.debug("Pooled DoQ connection raised dns.quic._common.UnexpectedEOF, reconnecting")
+                return self.get_dns_response_doq_pooled(
+                    query=query, ip=ip, port=port, timeout=timeout, server=server, verify=verify
+                )
+
+    def get_dns_response_doq_pooled(  # noqa: PLR0913
+        self, query: Message, ip: str, port: int, timeout: float, server: urllib.parse.SplitResult, verify: str | bool
+    ) -> Message | None:
+        """Perform a DNS query with the doq protocol using a pooled QUIC connection."""
+        key = ("doq", server.hostname, ip, port, verify)
+        manager, reused = quic_managers.get(
+            key=key,
+            factory=lambda: create_quic_manager(hostname=server.hostname, verify=verify, h3=False),
+        )
+        logger.debug(f"Using {'existing' if reused else 'new'} pooled QUIC manager for {server.geturl()}")
         try:
-            # DoQ query, use the IP for where= and use server_hostname for the hostname
+            connection, self.connection_reused = get_quic_connection(manager=manager, ip=ip, port=port)
             return dns.query.quic(
                 q=query,
                 where=ip,
@@ -472,15 +898,12 @@ class DNSCollector(Collector):
                 timeout=timeout,
                 verify=verify,
                 one_rr_per_rrset=True,
+                connection=connection,
             )
-        except dns.quic._common.UnexpectedEOF as e:  # noqa: SLF001
-            # raised by doq when an invalid CA path is passed,
-            # and a bunch of other error cases
-            logger.debug(
-                "Protocol doq raised dns.quic._common.UnexpectedEOF",
-                exc_info=True,
-            )
-            raise ProtocolSpecificError("connection_error") from e
+        except Exception:
+            # do not reuse a connection in an unknown state
+            quic_managers.discard(key=key, connection=manager)
+            raise
 
     def validate_response_rcode(self, response: Message) -> None:
         """Validate response RCODE."""
@@ -492,131 +915,23 @@ class DNSCollector(Collector):
                 "invalid_response_rcode",
             )
 
-    def validate_response_flags(self, response: Message) -> None:  # noqa: PLR0912 C901
-        """Validate response flags."""
-        # create a list of flags as text like ["QR", "AD"]
-        flags = dns.flags.to_text(response.flags).split(" ")
-
-        if self.config.validate_response_flags.fail_if_any_present:
-            for flag in self.config.validate_response_flags.fail_if_any_present:
-                # if any of these flags are found in the response validation fails
-                if flag in flags:
-                    raise ValidationError(
-                        "fail_if_any_present",
-                        "invalid_response_flags",
-                    )
-
-        if self.config.validate_response_flags.fail_if_all_present:
-            for flag in self.config.validate_response_flags.fail_if_all_present:
-                # if all these flags are found in the response then fail
-                if flag not in flags:
-                    break
-            else:
-                # all the flags are present
-                raise ValidationError(
-                    "fail_if_all_present",
-                    "invalid_response_flags",
-                )
-
-        if self.config.validate_response_flags.fail_if_any_absent:
-            for flag in self.config.validate_response_flags.fail_if_any_absent:
-                # if any of these flags is missing from the response then fail
-                if flag not in flags:
-                    raise ValidationError(
-                        "fail_if_any_absent",
-                        "invalid_response_flags",
-                    )
-
-        if self.config.validate_response_flags.fail_if_all_absent:
-            for flag in self.config.validate_response_flags.fail_if_all_absent:
-                # if all these flags are missing from the response then fail
-                if flag in flags:
-                    break
-            else:
-                # all the flags are missing
-                raise ValidationError(
-                    "fail_if_all_absent",
-                    "invalid_response_flags",
-                )
-
-    def check_regexes(  # noqa: PLR0913
-        self,
-        *,
-        validators: RRValidator,
-        validator: str,
-        rrs: str,
-        section: str,
-        fail_on_match: bool = False,
-        invert: bool = False,
-    ) -> None:
-        """Loop over response RRs and check for regex matches."""
-        for regex in getattr(validators, validator):
-            p = re.compile(regex)
-            for rr in rrs:
-                m = p.match(str(rr))
-                if m and fail_on_match or not m and not fail_on_match:
-                    raise ValidationError(validator, f"invalid_response_{section}_rrs")
-            if invert:
-                raise ValidationError(validator, f"invalid_response_{section}_rrs")
+    def validate_response_flags(self, response: Message) -> None:
+        """Validate response flags using the compiled RFMatcher."""
+        failed = self.config.validate_response_flags.matcher().check(response.flags)
+        if failed:
+            raise ValidationError(failed, "invalid_response_flags")
 
     def validate_response_rrs(self, response: Message) -> None:
-        """Validate response RRs."""
+        """Validate response RRs using the compiled RRMatcher for each section."""
         for section in ["answer", "authority", "additional"]:
-            key = f"validate_{section}_rrs"
+            validators: RRValidator = getattr(self.config, f"validate_{section}_rrs")
+            if not validators:
+                continue
             rrs = getattr(response, section)
-            if getattr(self.config, key):
-                validators: RRValidator = getattr(self.config, key)
-                if rrs and validators.fail_if_matches_regexp:
-                    logger.debug(
-                        f"fail_if_matches_regexp validating {len(rrs)} rrs from {section} section...",
-                    )
-                    self.check_regexes(
-                        validators=validators,
-                        validator="fail_if_matches_regexp",
-                        rrs=rrs,
-                        section=section,
-                        fail_on_match=True,
-                        invert=False,
-                    )
-
-                if rrs and validators.fail_if_all_match_regexp:
-                    logger.debug(
-                        f"fail_if_all_match_regexp validating {len(rrs)} rrs from {section} section...",
-                    )
-                    self.check_regexes(
-                        validators=validators,
-                        validator="fail_if_all_match_regexp",
-                        rrs=rrs,
-                        section=section,
-                        fail_on_match=False,
-                        invert=True,
-                    )
-
-                if validators.fail_if_not_matches_regexp:
-                    logger.debug(
-                        f"fail_if_not_matches_regexp validating {len(rrs)} rrs from {section} section...",
-                    )
-                    self.check_regexes(
-                        validators=validators,
-                        validator="fail_if_not_matches_regexp",
-                        rrs=rrs,
-                        section=section,
-                        fail_on_match=False,
-                        invert=False,
-                    )
-
-                if validators.fail_if_none_matches_regexp:
-                    logger.debug(
-                        f"fail_if_none_matches_regexp validating {len(rrs)} rrs from {section} section...",
-                    )
-                    self.check_regexes(
-                        validators=validators,
-                        validator="fail_if_none_matches_regexp",
-                        rrs=rrs,
-                        section=section,
-                        fail_on_match=False,
-                        invert=True,
-                    )
+            logger.debug(f"validating {len(rrs)} rrs from {section} section...")
+            failed = validators.matcher().check(rrs)
+            if failed:
+                raise ValidationError(failed, f"invalid_response_{section}_rrs")
 
     def validate_response(self, response: Message) -> None:
         """Validate the DNS response using the validation config in the config."""
@@ -1,13 +1,19 @@
 """``dns_exporter.config`` contains all the configuration related code for dns_exporter.
 
 The primary class is the Config object and the two RRValidator and RFValidator objects.
+
+All three are frozen and slotted dataclasses, so they are small, hashable and can be shared between modules,
+cached configs and scrapes without copying. Identical validators are interned so modules with the same validation
+rules share the same validator objects, also when they are loaded from the module cache.
 """
 from __future__ import annotations
 
 import json
 import logging
+import re
 import typing as t
-from dataclasses import asdict, dataclass, field
+from dataclasses import asdict, dataclass
+from functools import lru_cache
 
 import dns.edns
 import dns.exception
@@ -17,11 +23,13 @@ import dns.query
 import dns.rcode
 import dns.rdatatype
 import dns.resolver
+import dns.rrset
 
 from dns_exporter.exceptions import ConfigError
 
 if t.TYPE_CHECKING:  # pragma: no cover
     import urllib.parse
+    from collections.abc import Iterable
     from ipaddress import IPv4Address, IPv6Address
 
 
@@ -35,12 +43,53 @@ valid_protocols = [
     "udptcp",
     "dot",
     "doh",
+    "doh3",
     "doq",
 ]
 
+# the maximum number of unique validators shared between configs
+VALIDATOR_CACHE_SIZE = 1024
+
+Validator = t.TypeVar("Validator", "RRValidator", "RFValidator")
+
+
+@lru_cache(maxsize=VALIDATOR_CACHE_SIZE)
+def intern_validator(validator: Validator) -> Validator:
+    """Return the first validator seen which is equal to this one, so identical validators share one object."""
+    return validator
+
+
+def restore_validator(cls: type[Validator], state: dict[str, t.Any]) -> Validator:
+    """Return a validator of the class with the pickled state, interned like the validators returned by create()."""
+    validator = object.__new__(cls)
+    validator.__setstate__(state)
+    return t.cast("Validator", intern_validator(validator))
+
+
+class Frozen:
+    """Base class for the frozen and slotted dataclasses in this module.
+
+    Frozen dataclasses refuse ``setattr()``, which is what ``copy`` and ``pickle`` use to restore slots, so the
+    state is saved as a dict of field names and values and restored with ``object.__setattr__()`` instead.
+    """
 
-@dataclass
-class RRValidator:
+    __slots__: tuple[str, ...] = ()
+
+    def __getstate__(self) -> dict[str, t.Any]:
+        """Return the values of the fields by name."""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state: dict[str, t.Any]) -> None:
+        """Restore the values of the fields, refusing state pickled when the class had other fields."""
+        if not isinstance(state, dict) or set(state) != set(self.__slots__):
+            msg = f"Pickled {type(self).__name__} has other fields than {', '.join(self.__slots__)}"
+            raise ValueError(msg)
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
+
+@dataclass(frozen=True)
+class RRValidator(Frozen):
     """``dns_exporter.config.RRValidator`` defines the structure used in ``Config`` objects to validate response RRs.
 
     It is used in the ``validate_(answer|authority|additional)_rrs`` settings in the config.
@@ -56,20 +105,31 @@ class RRValidator:
         - ``additional``
     """
 
-    fail_if_matches_regexp: list[str]
-    """``fail_if_matches_regexp`` is a list of regular expressions, fail the query if one of them matches
+    __slots__ = (
+        "fail_if_all_match_regexp",
+        "fail_if_count_eq",
+        "fail_if_count_gt",
+        "fail_if_count_lt",
+        "fail_if_count_ne",
+        "fail_if_matches_regexp",
+        "fail_if_none_matches_regexp",
+        "fail_if_not_matches_regexp",
+    )
+
+    fail_if_matches_regexp: tuple[str, ...]
+    """``fail_if_matches_regexp`` is a tuple of regular expressions, fail the query if one of them matches
     an RR."""
 
-    fail_if_all_match_regexp: list[str]
-    """``fail_if_all_match_regexp`` is a list of regular expressions, fail the query if all of them matches
+    fail_if_all_match_regexp: tuple[str, ...]
+    """``fail_if_all_match_regexp`` is a tuple of regular expressions, fail the query if all of them matches
     an RR."""
 
-    fail_if_not_matches_regexp: list[str]
-    """``fail_if_not_matches_regexp`` is a list of regular expressions, fail the query if one of them does not match
+    fail_if_not_matches_regexp: tuple[str, ...]
+    """``fail_if_not_matches_regexp`` is a tuple of regular expressions, fail the query if one of them does not match
     an RR."""
 
-    fail_if_none_matches_regexp: list[str]
-    """``fail_if_none_matches_regexp`` is a list of regular expressions, fail the query if all of them does not match
+    fail_if_none_matches_regexp: tuple[str, ...]
+    """``fail_if_none_matches_regexp`` is a tuple of regular expressions, fail the query if all of them does not match
     an RR."""
 
     fail_if_count_eq: int | None
@@ -84,13 +144,17 @@ class RRValidator:
     fail_if_count_gt: int | None
     """``fail_if_count_gt`` is an integer, fail the query if the number of RRs is larger than this number."""
 
+    def __reduce__(self) -> tuple[t.Any, ...]:
+        """Unpickle with restore_validator(), so validators loaded from the module cache are shared too."""
+        return (restore_validator, (type(self), self.__getstate__()))
+
     @classmethod
     def create(  # noqa: PLR0913
         cls: type[RRValidator],
-        fail_if_matches_regexp: list[str] | None = None,
-        fail_if_all_match_regexp: list[str] | None = None,
-        fail_if_not_matches_regexp: list[str] | None = None,
-        fail_if_none_matches_regexp: list[str] | None = None,
+        fail_if_matches_regexp: Iterable[str] = (),
+        fail_if_all_match_regexp: Iterable[str] = (),
+        fail_if_not_matches_regexp: Iterable[str] = (),
+        fail_if_none_matches_regexp: Iterable[str] = (),
         fail_if_count_eq: int | None = None,
         fail_if_count_ne: int | None = None,
         fail_if_count_lt: int | None = None,
@@ -98,31 +162,146 @@ class RRValidator:
     ) -> RRValidator:
         """Return an instance of the RRValidator class with values from the provided parameters.
 
-        The values are used as-is.
+        The lists of regexes are stored as tuples, and an existing identical RRValidator is returned if there is one.
         """
-        # immutable defaults
-        if fail_if_matches_regexp is None:
-            fail_if_matches_regexp = []
-        if fail_if_all_match_regexp is None:
-            fail_if_all_match_regexp = []
-        if fail_if_not_matches_regexp is None:
-            fail_if_not_matches_regexp = []
-        if fail_if_none_matches_regexp is None:
-            fail_if_none_matches_regexp = []
-        return cls(
-            fail_if_matches_regexp=fail_if_matches_regexp,
-            fail_if_all_match_regexp=fail_if_all_match_regexp,
-            fail_if_not_matches_regexp=fail_if_not_matches_regexp,
-            fail_if_none_matches_regexp=fail_if_none_matches_regexp,
-            fail_if_count_eq=fail_if_count_eq,
-            fail_if_count_ne=fail_if_count_ne,
-            fail_if_count_lt=fail_if_count_lt,
-            fail_if_count_gt=fail_if_count_gt,
+        return t.cast(
+            "RRValidator",
+            intern_validator(
+                cls(
+                    fail_if_matches_regexp=tuple(fail_if_matches_regexp),
+                    fail_if_all_match_regexp=tuple(fail_if_all_match_regexp),
+                    fail_if_not_matches_regexp=tuple(fail_if_not_matches_regexp),
+                    fail_if_none_matches_regexp=tuple(fail_if_none_matches_regexp),
+                    fail_if_count_eq=fail_if_count_eq,
+                    fail_if_count_ne=fail_if_count_ne,
+                    fail_if_count_lt=fail_if_count_lt,
+                    fail_if_count_gt=fail_if_count_gt,
+                ),
+            ),
         )
 
+    def matcher(self) -> RRMatcher:
+        """Return the compiled RRMatcher for this validator.
 
-@dataclass
-class RFValidator:
+        Matchers are cached, so validators with the same rules share the same RRMatcher.
+        Raises ``re.error`` if one of the regular expressions is invalid.
+        """
+        return get_rr_matcher(
+            fail_if_matches_regexp=self.fail_if_matches_regexp,
+            fail_if_all_match_regexp=self.fail_if_all_match_regexp,
+            fail_if_not_matches_regexp=self.fail_if_not_matches_regexp,
+            fail_if_none_matches_regexp=self.fail_if_none_matches_regexp,
+            fail_if_count_eq=self.fail_if_count_eq,
+            fail_if_count_ne=self.fail_if_count_ne,
+            fail_if_count_lt=self.fail_if_count_lt,
+            fail_if_count_gt=self.fail_if_count_gt,
+        )
+
+
+class RRMatcher:
+    """``dns_exporter.config.RRMatcher`` is the compiled and immutable form of an ``RRValidator``.
+
+    The regular expressions are compiled once, and ``check()`` renders the text of each RR only once no matter how
+    many rules there are. Use ``RRValidator.matcher()`` to get the (cached) matcher for a validator.
+    """
+
+    __slots__ = ("count_rules", "regex_rules")
+
+    def __init__(  # noqa: PLR0913
+        self,
+        *,
+        fail_if_matches_regexp: Iterable[str],
+        fail_if_all_match_regexp: Iterable[str],
+        fail_if_not_matches_regexp: Iterable[str],
+        fail_if_none_matches_regexp: Iterable[str],
+        fail_if_count_eq: int | None,
+        fail_if_count_ne: int | None,
+        fail_if_count_lt: int | None,
+        fail_if_count_gt: int | None,
+    ) -> None:
+        """Compile the regular expressions and save the rules."""
+        # each regex rule is (name, patterns, fail_on_match, invert, skip_if_empty), checked in this order
+        self.regex_rules: tuple[tuple[str, tuple[re.Pattern[str], ...], bool, bool, bool], ...] = tuple(
+            (name, tuple(re.compile(regex) for regex in regexes), fail_on_match, invert, skip_if_empty)
+            for name, regexes, fail_on_match, invert, skip_if_empty in (
+                ("fail_if_matches_regexp", fail_if_matches_regexp, True, False, True),
+                ("fail_if_all_match_regexp", fail_if_all_match_regexp, False, True, True),
+                ("fail_if_not_matches_regexp", fail_if_not_matches_regexp, False, False, False),
+                ("fail_if_none_matches_regexp", fail_if_none_matches_regexp, False, True, False),
+            )
+            if regexes
+        )
+        # each count rule is (name, number, fails), where fails() is called with the RR count and the number
+        self.count_rules: tuple[tuple[str, int, t.Callable[[int, int], bool]], ...] = tuple(
+            (name, int(number), fails)
+            for name, number, fails in (
+                ("fail_if_count_eq", fail_if_count_eq, int.__eq__),
+                ("fail_if_count_ne", fail_if_count_ne, int.__ne__),
+                ("fail_if_count_lt", fail_if_count_lt, int.__lt__),
+                ("fail_if_count_gt", fail_if_count_gt, int.__gt__),
+            )
+            if number is not None
+        )
+
+    def check(self, rrs: list[dns.rrset.RRset]) -> str | None:
+        """Check the RRs from a response section and return the name of the first failed rule, or None."""
+        return self.check_regexes(rrs=rrs) or self.check_counts(rrs=rrs)
+
+    def check_regexes(self, rrs: list[dns.rrset.RRset]) -> str | None:
+        """Check the regex rules and return the name of the first failed rule, or None."""
+        if not self.regex_rules:
+            return None
+        # render each RR once for all the regexes
+        texts = [str(rr) for rr in rrs]
+        for name, patterns, fail_on_match, invert, skip_if_empty in self.regex_rules:
+            if skip_if_empty and not texts:
+                continue
+            for pattern in patterns:
+                for text in texts:
+                    if bool(pattern.match(text)) is fail_on_match:
+                        return name
+                if invert:
+                    return name
+        return None
+
+    def check_counts(self, rrs: list[dns.rrset.RRset]) -> str | None:
+        """Check the RR count rules and return the name of the first failed rule, or None."""
+        if not self.count_rules:
+            return None
+        count = sum(len(rrset) for rrset in rrs)
+        for name, number, fails in self.count_rules:
+            if fails(count, number):
+                return name
+        return None
+
+
+@lru_cache(maxsize=1024)
+def get_rr_matcher(  # noqa: PLR0913
+    *,
+    fail_if_matches_regexp: tuple[str, ...],
+    fail_if_all_match_regexp: tuple[str, ...],
+    fail_if_not_matches_regexp: tuple[str, ...],
+    fail_if_none_matches_regexp: tuple[str, ...],
+    fail_if_count_eq: int | None,
+    fail_if_count_ne: int | None,
+    fail_if_count_lt: int | None,
+    fail_if_count_gt: int | None,
+) -> RRMatcher:
+    """Return a cached RRMatcher for the rules."""
+    return RRMatcher(
+        fail_if_matches_regexp=fail_if_matches_regexp,
+        fail_if_all_match_regexp=fail_if_all_match_regexp,
+        fail_if_not_matches_regexp=fail_if_not_matches_regexp,
+        fail_if_none_matches_regexp=fail_if_none_matches_regexp,
+        fail_if_count_eq=fail_if_count_eq,
+        fail_if_count_ne=fail_if_count_ne,
+        fail_if_count_lt=fail_if_count_lt,
+        fail_if_count_gt=fail_if_count_gt,
+    )
+
+
+@dataclass(frozen=True)
+class RFValidator(Frozen):
     """``dns_exporter.config.RFValidator`` defines the structure used in ``Config`` objects to validate response flags.
 
     It is used in the ``validate_response_flags`` setting in the config.
@@ -131,57 +310,181 @@ class RFValidator:
     ``dns_exporter.config.RFValidator.create()`` method which returns an instance of this class.
     """
 
-    fail_if_any_present: list[str]
-    """``fail_if_any_present`` is a list of flags as strings, fail if any of them are present in the response."""
+    __slots__ = ("fail_if_all_absent", "fail_if_all_present", "fail_if_any_absent", "fail_if_any_present")
+
+    fail_if_any_present: tuple[str, ...]
+    """``fail_if_any_present`` is a tuple of flags as strings, fail if any of them are present in the response."""
 
-    fail_if_all_present: list[str]
-    """``fail_if_all_present`` is a list of flags as strings, fail if all of them are present in the response."""
+    fail_if_all_present: tuple[str, ...]
+    """``fail_if_all_present`` is a tuple of flags as strings, fail if all of them are present in the response."""
 
-    fail_if_any_absent: list[str]
-    """``fail_if_any_absent`` is a list of flags as strings, fail if any of them are absent from the response."""
+    fail_if_any_absent: tuple[str, ...]
+    """``fail_if_any_absent`` is a tuple of flags as strings, fail if any of them are absent from the response."""
 
-    fail_if_all_absent: list[str]
-    """``fail_if_all_present`` is a list of flags as strings, fail if all of them are absent from the response."""
+    fail_if_all_absent: tuple[str, ...]
+    """``fail_if_all_present`` is a tuple of flags as strings, fail if all of them are absent from the response."""
+
+    def __reduce__(self) -> tuple[t.Any, ...]:
+        """Unpickle with restore_validator(), so validators loaded from the module cache are shared too."""
+        return (restore_validator, (type(self), self.__getstate__()))
 
     @classmethod
     def create(
         cls: type[RFValidator],
-        fail_if_any_present: list[str] | None = None,
-        fail_if_all_present: list[str] | None = None,
-        fail_if_any_absent: list[str] | None = None,
-        fail_if_all_absent: list[str] | None = None,
+        fail_if_any_present: Iterable[str] = (),
+        fail_if_all_present: Iterable[str] = (),
+        fail_if_any_absent: Iterable[str] = (),
+        fail_if_all_absent: Iterable[str] = (),
     ) -> RFValidator:
         """Return an instance of the RFValidator class with values from the provided parameters.
 
-        The values are used as-is.
+        The lists of flags are stored as tuples, and an existing identical RFValidator is returned if there is one.
         """
-        # immutable defaults
-        if fail_if_any_present is None:
-            fail_if_any_present = []
-        if fail_if_all_present is None:
-            fail_if_all_present = []
-        if fail_if_any_absent is None:
-            fail_if_any_absent = []
-        if fail_if_all_absent is None:
-            fail_if_all_absent = []
-        return cls(
-            fail_if_any_present=fail_if_any_present,
-            fail_if_all_present=fail_if_all_present,
-            fail_if_any_absent=fail_if_any_absent,
-            fail_if_all_absent=fail_if_all_absent,
+        return t.cast(
+            "RFValidator",
+            intern_validator(
+                cls(
+                    fail_if_any_present=tuple(fail_if_any_present),
+                    fail_if_all_present=tuple(fail_if_all_present),
+                    fail_if_any_absent=tuple(fail_if_any_absent),
+                    fail_if_all_absent=tuple(fail_if_all_absent),
+                ),
+            ),
+        )
+
+    def matcher(self) -> RFMatcher:
+        """Return the compiled RFMatcher for this validator.
+
+        Matchers are cached, so validators with the same rules share the same RFMatcher.
+        """
+        return get_rf_matcher(
+            fail_if_any_present=self.fail_if_any_present,
+            fail_if_all_present=self.fail_if_all_present,
+            fail_if_any_absent=self.fail_if_any_absent,
+            fail_if_all_absent=self.fail_if_all_absent,
         )
 
 
-@dataclass
-class Config:
+class RFMatcher:
+    """``dns_exporter.config.RFMatcher`` is the compiled and immutable form of an ``RFValidator``.
+
+    Each list of flags is compiled to an integer mask, so ``check()`` only does a few integer operations. Flag
+    names which are not DNS header flags are never present in a response, like before.
+    Use ``RFValidator.matcher()`` to get the (cached) matcher for a validator.
+    """
+
+    __slots__ = ("all_absent", "all_present", "any_absent", "any_present")
+
+    def __init__(
+        self,
+        *,
+        fail_if_any_present: Iterable[str],
+        fail_if_all_present: Iterable[str],
+        fail_if_any_absent: Iterable[str],
+        fail_if_all_absent: Iterable[str],
+    ) -> None:
+        """Compile the lists of flags to masks."""
+        # each rule is None if the list is empty, or a tuple of (mask, unknown) where unknown is True if the list
+        # has one or more flag names which can never be present in a response
+        self.any_present = self.compile(fail_if_any_present)
+        self.all_present = self.compile(fail_if_all_present)
+        self.any_absent = self.compile(fail_if_any_absent)
+        self.all_absent = self.compile(fail_if_all_absent)
+
+    @staticmethod
+    def compile(flags: Iterable[str]) -> tuple[int, bool] | None:
+        """Return the mask of the flags and whether any of them are unknown, or None if there are no flags."""
+        flags = list(flags)
+        if not flags:
+            return None
+        mask = 0
+        unknown = False
+        for flag in flags:
+            if flag in dns.flags.Flag.__members__:
+                mask |= int(dns.flags.Flag[flag])
+            else:
+                unknown = True
+        return mask, unknown
+
+    def check(self, flags: int) -> str | None:
+        """Check the header flags of a response and return the name of the first failed rule, or None."""
+        # if any of these flags are found in the response validation fails
+        if self.any_present and flags & self.any_present[0]:
+            return "fail_if_any_present"
+        # if all these flags are found in the response then fail
+        if self.all_present and not self.all_present[1] and flags & self.all_present[0] == self.all_present[0]:
+            return "fail_if_all_present"
+        # if any of these flags is missing from the response then fail
+        if self.any_absent and (self.any_absent[1] or flags & self.any_absent[0] != self.any_absent[0]):
+            return "fail_if_any_absent"
+        # if all these flags are missing from the response then fail
+        if self.all_absent and not flags & self.all_absent[0]:
+            return "fail_if_all_absent"
+        return None
+
+
+@lru_cache(maxsize=1024)
+def get_rf_matcher(
+    *,
+    fail_if_any_present: tuple[str, ...],
+    fail_if_all_present: tuple[str, ...],
+    fail_if_any_absent: tuple[str, ...],
+    fail_if_all_absent: tuple[str, ...],
+) -> RFMatcher:
+    """Return a cached RFMatcher for the rules."""
+    return RFMatcher(
+        fail_if_any_present=fail_if_any_present,
+        fail_if_all_present=fail_if_all_present,
+        fail_if_any_absent=fail_if_any_absent,
+        fail_if_all_absent=fail_if_all_absent,
+    )
+
+
+@dataclass(frozen=True)
+class Config(Frozen):
     """``dns_exporter.config.Config`` defines the primary config structure used in dns_exporter.
 
     The defaults for each config key are defined in the ``dns_exporter.config.Config.create()`` method.
 
     The ``dns_exporter.exporter.DNSExporter.modules`` dict consists of string keys and instances of this class as
     values.
+
+    Config objects can not be changed, use ``dns_exporter.config.Config.evolve()`` to get a changed copy.
     """
 
+    __slots__ = (
+        "collect_ttl",
+        "collect_ttl_aggregate",
+        "collect_ttl_max_rrs",
+        "collect_ttl_rr_value_length",
+        "doh_http2",
+        "edns",
+        "edns_bufsize",
+        "edns_do",
+        "edns_nsid",
+        "edns_pad",
+        "family",
+        "ip",
+        "name",
+        "protocol",
+        "proxy",
+        "query_class",
+        "query_name",
+        "query_type",
+        "recursion_desired",
+        "reuse_connections",
+        "server",
+        "timeout",
+        "tls_session_resumption",
+        "valid_rcodes",
+        "validate_additional_rrs",
+        "validate_answer_rrs",
+        "validate_authority_rrs",
+        "validate_response_flags",
+        "verify_certificate",
+        "verify_certificate_path",
+    )
+
     name: str
     """str: The name of this config. It is mostly included in the class for convenience."""
 
@@ -190,9 +493,20 @@ class Config:
     """bool: Set this bool to ``True`` to enable collection of per-RR TTL metrics for the DNS query, ``False`` to not
     collect per-RR TTL metrics. Default is ``True``"""
 
+    collect_ttl_aggregate: bool
+    """bool: Set this bool to ``True`` to collect the lowest and highest TTL and the number of RRs for each section,
+    RR name and RR type instead of per-RR TTL metrics. Default is ``False``"""
+
+    collect_ttl_max_rrs: int
+    """int: Limits the number of RRs with a per-RR TTL metric, ``0`` means no limit. Default is ``0``"""
+
     collect_ttl_rr_value_length: int
     """int: Limits the length of the ``rr_value`` label when collecing per-RR TTL metrics. Default is ``50``"""
 
+    doh_http2: bool
+    """bool: Set this bool to ``True`` to only use HTTP/2 for ``doh`` queries and multiplex concurrent scrapes to the
+    same server over a single pooled connection. Default is ``False``"""
+
     edns: bool
     """bool: Set this bool to ``True`` to enable ``EDNS0`` for the DNS query, ``False`` to not use ``EDNS0``.
     Default is ``True``"""
@@ -214,8 +528,8 @@ class Config:
     DNS query. Default is ``ipv6``"""
 
     protocol: str
-    """str: This key must be set to one of ``udp``, ``tcp``, ``udptcp``, ``dot``, ``doh``, or ``doq``. It determines
-    the protocol used for the DNS query. Default is ``udp``"""
+    """str: This key must be set to one of ``udp``, ``tcp``, ``udptcp``, ``dot``, ``doh``, ``doh3``, or ``doq``. It
+    determines the protocol used for the DNS query. Default is ``udp``"""
 
     query_class: str
     """str: The query class used for this DNS query, typically ``IN`` but can also be ``CHAOS``. Default is ``IN``"""
@@ -230,10 +544,19 @@ class Config:
     recursion_desired: bool
     """bool: Set this bool to ``True`` to set the ``RD`` flag in the DNS query. Default is ``True``"""
 
+    reuse_connections: bool
+    """bool: Set this bool to ``True`` to keep connections to the DNS server open and reuse them in later scrapes,
+    ``False`` to open a new connection for every scrape. When enabled the query time no longer includes connection
+    setup like the TLS handshake. Default is ``False``"""
+
     timeout: float
     """float: This float determines how long the exporter will wait for a response before declaring the DNS query
     failed. Unit is seconds. Default is 5.0."""
 
+    tls_session_resumption: bool
+    """bool: Set this bool to ``True`` to keep the TLS session of ``dot`` connections and resume it when opening a new
+    connection to the same server, which makes the TLS handshake cheaper. Default is ``False``"""
+
     validate_answer_rrs: RRValidator
     """RRValidator: This object contains the validation config for the ``answer`` section of the response. Default
     is an empty ``RRValidator()``"""
@@ -250,8 +573,8 @@ class Config:
     """RFValidator: This object contains the validation config for the response flags. Default is an empty
     ``RFValidator()``"""
 
-    valid_rcodes: list[str]
-    """list[str]: A list of acceptable rcodes when validating the DNS response. Default is ``["NOERROR"]``."""
+    valid_rcodes: tuple[str, ...]
+    """tuple[str, ...]: A tuple of acceptable rcodes when validating the DNS response. Default is ``("NOERROR",)``."""
 
     verify_certificate: bool
     """bool: Set this bool to ``True`` to verify the certificate of the DNS server, set it to ``False`` to disable
@@ -264,21 +587,30 @@ class Config:
 
     # optional settings (but required in final config)
 
-    ip: IPv4Address | IPv6Address | None = field(
-        default_factory=lambda: None,
-    )
+    ip: IPv4Address | IPv6Address | None
     """IPv4Address | IPv6Address | None: The IP to use instead of using IP or hostname from server. Default
     is ``None``"""
 
-    server: urllib.parse.SplitResult | None = field(default_factory=lambda: None)
+    server: urllib.parse.SplitResult | None
     """urllib.parse.SplitResult | None: The DNS server to use in parsed form. Default is ``None``"""
 
-    query_name: str | None = field(default_factory=lambda: None)
+    query_name: str | None
     """str | None: The name to ask for in the DNS query. Default is ``None``"""
 
     def validate_bools(self) -> None:
         """Validate bools."""
-        for key in ["collect_ttl", "edns", "edns_do", "edns_nsid", "recursion_desired", "verify_certificate"]:
+        for key in [
+            "collect_ttl",
+            "collect_ttl_aggregate",
+            "doh_http2",
+            "edns",
+            "edns_do",
+            "edns_nsid",
+            "recursion_desired",
+            "reuse_connections",
+            "tls_session_resumption",
+            "verify_certificate",
+        ]:
             # validate bools
             if not isinstance(getattr(self, key), bool):
                 logger.error(f"Not a bool: {key}")
@@ -286,7 +618,7 @@ class Config:
 
     def validate_integers(self) -> None:
         """Validate integers."""
-        for key in ["collect_ttl_rr_value_length", "edns_bufsize", "edns_pad"]:
+        for key in ["collect_ttl_max_rrs", "collect_ttl_rr_value_length", "edns_bufsize", "edns_pad"]:
             if not getattr(self, key) >= 0:
                 logger.error("Invalid integer")
                 raise ConfigError("invalid_request_config")
@@ -318,11 +650,12 @@ class Config:
 
     def validate_proxy(self) -> None:
         """Validate proxy."""
-        if self.proxy and self.protocol in ["dot", "doq"]:
+        if self.proxy and self.protocol in ["dot", "doh3", "doq"]:
             # proxy support doesn't work for DoT for now
             # https://github.com/tykling/dns_exporter/issues/76
             # and doesn't work for DoQ until next dnspython release
             # https://github.com/tykling/dns_exporter/issues/96
+            # and socks proxies can't carry the UDP based QUIC used by DoH3
             logger.error(f"proxy not valid for protocol {self.protocol}")
             raise ConfigError(
                 "invalid_request_config",
@@ -366,7 +699,10 @@ class Config:
         *,
         name: str,
         collect_ttl: bool = True,
+        collect_ttl_aggregate: bool = False,
+        collect_ttl_max_rrs: int = 0,
         collect_ttl_rr_value_length: int = 50,
+        doh_http2: bool = False,
         edns: bool = True,
         edns_do: bool = False,
         edns_nsid: bool = True,
@@ -377,13 +713,15 @@ class Config:
         query_class: str = "IN",
         query_type: str = "A",
         recursion_desired: bool = True,
+        reuse_connections: bool = False,
         proxy: urllib.parse.SplitResult | None = None,
         timeout: float = 5.0,
+        tls_session_resumption: bool = False,
         validate_answer_rrs: RRValidator | None = None,
         validate_authority_rrs: RRValidator | None = None,
         validate_additional_rrs: RRValidator | None = None,
         validate_response_flags: RFValidator | None = None,
-        valid_rcodes: list[str] | None = None,
+        valid_rcodes: Iterable[str] = ("NOERROR",),
         verify_certificate: bool = True,
         verify_certificate_path: str = "",
         ip: IPv4Address | IPv6Address | None = None,
@@ -393,9 +731,6 @@ class Config:
         """Return an instance of the Config class with values from the provided parameters overriding the defaults."""
         logger.debug(f"creating config {name}...")
         # immutable defaults
-        if valid_rcodes is None:
-            valid_rcodes = ["NOERROR"]
-
         if validate_answer_rrs is None:
             validate_answer_rrs = RRValidator.create()
 
@@ -411,7 +746,10 @@ class Config:
         return cls(
             name=name,
             collect_ttl=collect_ttl,
+            collect_ttl_aggregate=collect_ttl_aggregate,
+            collect_ttl_max_rrs=int(collect_ttl_max_rrs),
             collect_ttl_rr_value_length=collect_ttl_rr_value_length,
+            doh_http2=doh_http2,
             edns=edns,
             edns_do=edns_do,
             edns_nsid=edns_nsid,
@@ -422,13 +760,15 @@ class Config:
             query_class=query_class.upper(),
             query_type=query_type.upper(),
             recursion_desired=recursion_desired,
+            reuse_connections=reuse_connections,
             proxy=proxy,
             timeout=float(timeout),
+            tls_session_resumption=tls_session_resumption,
             validate_answer_rrs=validate_answer_rrs,
             validate_authority_rrs=validate_authority_rrs,
             validate_additional_rrs=validate_additional_rrs,
             validate_response_flags=validate_response_flags,
-            valid_rcodes=list(valid_rcodes),
+            valid_rcodes=tuple(valid_rcodes),
             verify_certificate=verify_certificate,
             verify_certificate_path=verify_certificate_path,
             # fields with no defaults below here
@@ -437,6 +777,29 @@ class Config:
             query_name=query_name,
         )
 
+    def evolve(self, **changes: t.Any) -> Config:  # noqa: ANN401
+        """Return a copy of the config with the changes applied.
+
+        The copy shares all the unchanged values with this config, and it is not validated again, so the caller must
+        make sure the new values are valid. This is used to set the server IP for each scrape without copying and
+        validating the whole config.
+        """
+        unknown = changes.keys() - set(self.__slots__)
+        if unknown:
+            msg = f"Unknown config fields: {sorted(unknown)}"
+            raise TypeError(msg)
+        config = object.__new__(type(self))
+        for name in self.__slots__:
+            object.__setattr__(config, name, changes[name] if name in changes else getattr(self, name))
+        return config
+
+    def as_config_dict(self) -> ConfigDict:
+        """Return the fields and values of the config as a dict.
+
+        Unlike ``dataclasses.asdict()`` the values are not copied, which is not needed since they are immutable.
+        """
+        return t.cast("ConfigDict", {name: getattr(self, name) for name in self.__slots__})
+
     def json(self) -> str:
         """Return a json version of the config. Mostly used in unit tests."""
         conf: dict[str, t.Any] = asdict(self)
@@ -458,7 +821,10 @@ class ConfigDict(t.TypedDict, total=False):
     """
 
     collect_ttl: bool
+    collect_ttl_aggregate: bool
+    collect_ttl_max_rrs: int
     collect_ttl_rr_value_length: bool
+    doh_http2: bool
     edns: bool
     edns_do: bool
     edns_nsid: bool
@@ -469,15 +835,40 @@ class ConfigDict(t.TypedDict, total=False):
     query_class: str
     query_type: str
     recursion_desired: bool
+    reuse_connections: bool
     timeout: float
+    tls_session_resumption: bool
     validate_answer_rrs: RRValidator
     validate_authority_rrs: RRValidator
     validate_additional_rrs: RRValidator
     validate_response_flags: RFValidator
-    valid_rcodes: list[str]
+    valid_rcodes: Iterable[str]
     verify_certificate: bool
     verify_certificate_path: str
     ip: IPv4Address | IPv6Address | None
     server: urllib.parse.SplitResult | None
     query_name: str | None
     proxy: urllib.parse.SplitResult | None
+
+
+class Modules(dict[str, Config]):
+    """The modules loaded from the config file, a dict of module names and Config objects.
+
+    ``dns_exporter.config.Modules`` also keeps the ConfigDict of each module from the config file in ``sources``.
+    The sources are used to find the modules which changed when the config file is reloaded, and when module
+    compilation is deferred the modules which have not been used yet are only found in ``sources``.
+    """
+
+    def __init__(
+        self,
+        modules: dict[str, Config] | None = None,
+        sources: dict[str, ConfigDict] | None = None,
+    ) -> None:
+        """Save the Config objects and the ConfigDict sources."""
+        super().__init__(modules or {})
+        self.sources: dict[str, ConfigDict] = dict(sources or {})
+
+    @property
+    def pending(self) -> set[str]:
+        """Return the names of the modules which have not been compiled to Config objects yet."""
+        return self.sources.keys() - self.keys()
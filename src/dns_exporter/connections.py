@@ -0,0 +1,590 @@
+"""``dns_exporter.connections`` contains the connection pools used to reuse connections between scrapes.
+
+By default every scrape opens a new connection to the DNS server, which means the measured query time includes
+the connection setup (TCP connect, TLS handshake and so on). Modules with ``reuse_connections`` enabled instead
+keep their connections in one of the process-wide pools defined in this module, so subsequent scrapes to the same
+target can skip the connection setup entirely.
+
+All pools are thread-safe, limited in size, and evict connections which have been idle for too long.
+
+This module also installs the socket factory used by dnspython to create sockets. The proxy for a scrape is set
+with ``use_proxy()``, which only affects sockets created by the current thread (or asyncio task), so proxied and
+direct scrapes can run at the same time.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import contextvars
+import functools
+import logging
+import selectors
+import socket
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Callable, cast
+
+import dns.edns
+import dns.entropy
+import dns.exception
+import dns.inet
+import dns.message
+import dns.query
+import dns.quic
+import httpx  # type: ignore[import]
+
+from dns_exporter.defaults import DEFAULT_POOL_MAX_IDLE, DEFAULT_POOL_MAXSIZE
+from dns_exporter.metrics import dnsexp_connection_pool_connections, dnsexp_doh_streams_per_connection
+
+if TYPE_CHECKING:  # pragma: no cover
+    import ssl
+    import urllib.parse
+    from collections.abc import Hashable, Iterator
+
+    from dns_exporter.phases import PhaseTimer
+
+logger = logging.getLogger(f"dns_exporter.{__name__}")
+
+current_proxy: contextvars.ContextVar[urllib.parse.SplitResult | None] = contextvars.ContextVar(
+    "current_proxy", default=None
+)
+"""``current_proxy`` is the proxy used by ``socket_factory()`` for new sockets, set it with ``use_proxy()``.
+
+Each thread (and each asyncio task) has its own value, so concurrent scrapes can not see each others proxy.
+"""
+
+
+def socket_factory(
+    family: int = socket.AF_INET,
+    type: int = socket.SOCK_STREAM,  # noqa: A002
+    proto: int = 0,
+) -> socket.socket:
+    """Return a new socket, or a socks.socksocket using the proxy if one is set with ``use_proxy()``."""
+    proxy = current_proxy.get()
+    if proxy is None:
+        return socket.socket(family, type, proto)
+    # pysocks is only needed by scrapes which use a proxy
+    import socks  # type: ignore[import-untyped]
+
+    sock = socks.socksocket(family, type, proto)
+    # the proxy is set on the socket itself, socks.set_default_proxy() would change it for all scrapes
+    sock.set_proxy(proxy_type=getattr(socks, proxy.scheme.upper()), addr=proxy.hostname, port=proxy.port)
+    return cast("socket.socket", sock)
+
+
+@contextlib.contextmanager
+def use_proxy(proxy: urllib.parse.SplitResult | None) -> Iterator[None]:
+    """Use the proxy for sockets created by dnspython in the current thread or task until the context exits."""
+    token = current_proxy.set(proxy)
+    try:
+        yield
+    finally:
+        current_proxy.reset(token)
+
+
+# installed once instead of being swapped for every scrape, so scrapes with and without proxy can run concurrently
+dns.query.socket_factory = socket_factory
+
+
+class PoolEntry:
+    """A single connection in a ``ConnectionPool`` and the time it was last used."""
+
+    __slots__ = ("connection", "last_used")
+
+    def __init__(self, connection: Any, last_used: float) -> None:  # noqa: ANN401
+        """Save connection and timestamp."""
+        self.connection = connection
+        self.last_used = last_used
+
+
+class ConnectionPool:
+    """Thread-safe pool of long-lived connection objects shared between scrapes.
+
+    Connections are keyed by a tuple describing the target (and everything else which makes one connection
+    different from another, like certificate verification settings and proxy). The pool keeps the entries in
+    least-recently-used order. When the pool is full the least recently used connection is closed to make room,
+    and connections which have not been used for ``max_idle`` seconds are closed on the next pool access.
+
+    Connections are created and closed outside of the pool lock so a slow connection setup to one target never
+    blocks scrapes to other targets.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        close: Callable[[Any], None],
+        maxsize: int = DEFAULT_POOL_MAXSIZE,
+        max_idle: float = DEFAULT_POOL_MAX_IDLE,
+    ) -> None:
+        """Create an empty pool and register the size metric for it."""
+        self.name = name
+        self.maxsize = maxsize
+        self.max_idle = max_idle
+        self._close = close
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Hashable, PoolEntry] = OrderedDict()
+        dnsexp_connection_pool_connections.labels(pool=name).set_function(self.__len__)
+
+    def __len__(self) -> int:
+        """Return the number of connections in the pool."""
+        return len(self._entries)
+
+    def get(self, key: Hashable, factory: Callable[[], Any]) -> tuple[Any, bool]:
+        """Return a tuple of (connection, reused) for the key, creating a new connection with factory() if needed.
+
+        The reused bool is ``True`` if the connection was already in the pool.
+        """
+        now = time.monotonic()
+        with self._lock:
+            expired = self._pop_idle(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.last_used = now
+                self._entries.move_to_end(key)
+        self._close_all(expired)
+        if entry is not None:
+            return entry.connection, True
+
+        # no connection in the pool, create a new one outside the lock
+        logger.debug(f"Pool {self.name} creating new connection for {key}")
+        connection = factory()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                # this is the only new connection for the key, keep it
+                self._entries[key] = PoolEntry(connection=connection, last_used=now)
+                evicted = self._pop_oldest()
+                existing = None
+            else:
+                # another scrape created a connection for the same key while we were busy, use that instead
+                entry.last_used = now
+                evicted = [connection]
+                existing = entry.connection
+        self._close_all(evicted)
+        if existing is not None:
+            return existing, True
+        return connection, False
+
+    def take(self, key: Hashable) -> Any:  # noqa: ANN401
+        """Remove and return the connection for the key, or None if the pool has no connection for the key.
+
+        This is used for connections which can only be used by one scrape at a time. The connection must be returned
+        with ``put()`` (or closed) when the scrape is done with it.
+        """
+        with self._lock:
+            expired = self._pop_idle(time.monotonic())
+            entry = self._entries.pop(key, None)
+        self._close_all(expired)
+        return entry.connection if entry is not None else None
+
+    def put(self, key: Hashable, connection: Any) -> None:  # noqa: ANN401
+        """Return a connection taken with ``take()`` to the pool.
+
+        If the pool already has a connection for the key (opened by a concurrent scrape) the connection is closed.
+        """
+        with self._lock:
+            if key in self._entries:
+                evicted = [connection]
+            else:
+                self._entries[key] = PoolEntry(connection=connection, last_used=time.monotonic())
+                evicted = self._pop_oldest()
+        self._close_all(evicted)
+
+    def discard(self, key: Hashable, connection: Any) -> None:  # noqa: ANN401
+        """Remove and close the connection if it is still the pooled connection for the key."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.connection is connection:
+                del self._entries[key]
+        logger.debug(f"Pool {self.name} discarding connection for {key}")
+        self._close_all([connection])
+
+    def clear(self) -> None:
+        """Close all connections in the pool."""
+        with self._lock:
+            connections = [entry.connection for entry in self._entries.values()]
+            self._entries.clear()
+        self._close_all(connections)
+
+    def _pop_idle(self, now: float) -> list[Any]:
+        """Remove and return connections which have been idle for too long. Must be called with the lock held."""
+        expired = []
+        # entries are kept in LRU order so the idle ones are always first
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if now - entry.last_used < self.max_idle:
+                break
+            del self._entries[key]
+            expired.append(entry.connection)
+        return expired
+
+    def _pop_oldest(self) -> list[Any]:
+        """Remove and return the least recently used connections if the pool is too big. Lock must be held."""
+        evicted = []
+        while len(self._entries) > self.maxsize:
+            _, entry = self._entries.popitem(last=False)
+            evicted.append(entry.connection)
+        return evicted
+
+    def _close_all(self, connections: list[Any]) -> None:
+        """Close connections, logging but otherwise ignoring any errors."""
+        for connection in connections:
+            try:
+                self._close(connection)
+            except (OSError, RuntimeError, ValueError, httpx.HTTPError, dns.exception.DNSException):  # noqa: PERF203
+                logger.debug(f"Pool {self.name} got an exception while closing a connection", exc_info=True)
+
+
+def configure_pools(maxsize: int, max_idle: float) -> None:
+    """Set the size limit and idle timeout for all pools."""
+    for pool in POOLS:
+        pool.maxsize = maxsize
+        pool.max_idle = max_idle
+    logger.debug(f"Connection pools configured with maxsize {maxsize} and max_idle {max_idle}")
+
+
+# the httpcore trace events after which the request headers have been sent (or failed to send)
+HEADERS_SENT_EVENTS = frozenset(
+    {
+        "http11.send_request_headers.complete",
+        "http11.send_request_headers.failed",
+        "http2.send_request_headers.complete",
+        "http2.send_request_headers.failed",
+    }
+)
+
+
+class DoHClient(httpx.Client):
+    """httpx.Client used for pooled DoH connections, it keeps track of the number of requests in flight.
+
+    Each request observes the number of concurrent requests per open connection in the
+    ``dnsexp_doh_streams_per_connection`` histogram, which shows how well HTTP/2 multiplexing is used.
+
+    httpcore allocates HTTP/2 stream IDs without holding a lock, so two threads sending requests on the same
+    connection at the same time can end up with the same stream ID. To prevent this the client only lets one
+    request at a time send its headers, the (much slower) wait for the response still happens concurrently.
+    The lock is released when the request headers are sent over HTTP/2 or HTTP/1.1, so requests over separate
+    HTTP/1.1 connections are not serialised either.
+    """
+
+    def __init__(self, transport: httpx.HTTPTransport, *, http2: bool, verify: bool | str) -> None:
+        """Create the client with the provided transport."""
+        super().__init__(http1=not http2, http2=http2, verify=verify, transport=transport)
+        self.doh_transport = transport
+        self.in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        self._headers_lock = threading.Lock()
+
+    def has_connections(self) -> bool:
+        """Return ``True`` if the client has at least one open connection to the server."""
+        return bool(self.doh_transport._pool.connections)  # noqa: SLF001
+
+    def send(self, request: httpx.Request, **kwargs: Any) -> httpx.Response:  # noqa: ANN401
+        """Count requests in flight and send the request, holding the headers lock until the headers are sent."""
+        with self._in_flight_lock:
+            self.in_flight += 1
+            in_flight = self.in_flight
+        released = threading.Event()
+
+        def release_headers_lock() -> None:
+            if not released.is_set():
+                released.set()
+                self._headers_lock.release()
+
+        def trace(event_name: str, info: dict[str, Any]) -> None:  # noqa: ARG001
+            if event_name in HEADERS_SENT_EVENTS:
+                release_headers_lock()
+
+        request.extensions["trace"] = trace
+        self._headers_lock.acquire()
+        try:
+            connections = len(self.doh_transport._pool.connections)  # noqa: SLF001
+            dnsexp_doh_streams_per_connection.observe(in_flight / max(connections, 1))
+            return super().send(request, **kwargs)
+        finally:
+            release_headers_lock()
+            with self._in_flight_lock:
+                self.in_flight -= 1
+
+
+def create_doh_client(ip: str, verify: bool | str, *, http2: bool = False) -> DoHClient:
+    """Return a new DoHClient for DoH queries to the server at the (bootstrap) ip.
+
+    The client uses the same transport as ``dns.query.https()`` does when called without a session, except the idle
+    connections are kept for as long as the pool keeps the client. If http2 is ``True`` the client only speaks
+    HTTP/2 and concurrent requests are multiplexed over a single connection, otherwise HTTP/1.1 and HTTP/2 are
+    both offered like ``dns.query.https()`` does.
+    """
+    limits = httpx.Limits(keepalive_expiry=doh_clients.max_idle)
+    transport = dns.query._HTTPTransport(  # type: ignore[no-untyped-call]  # noqa: SLF001
+        http1=not http2,
+        http2=True,
+        verify=verify,
+        bootstrap_address=ip,
+        limits=limits,
+    )
+    return DoHClient(transport=transport, http2=http2, verify=verify)
+
+
+doh_clients = ConnectionPool(name="doh", close=lambda client: client.close())
+"""``doh_clients`` is the pool of ``httpx.Client`` objects used for DoH queries.
+
+Clients are keyed by ``(hostname, bootstrap ip, port, verify, proxy, http2)``.
+"""
+
+
+def create_quic_manager(hostname: str | None, verify: bool | str, *, h3: bool) -> dns.quic.SyncQuicManager:
+    """Return a new SyncQuicManager for QUIC connections to the server with the given hostname.
+
+    The manager keeps one QUIC connection per (ip, port) open until it is closed, and transparently opens a new
+    connection (resuming the TLS session if the server sent a session ticket) if the old one was closed by the peer.
+    If h3 is ``True`` the manager is used for DoH3, otherwise for DoQ.
+    """
+    return dns.quic.SyncQuicManager(verify_mode=verify, server_name=hostname, h3=h3)  # type: ignore[no-untyped-call]
+
+
+def get_quic_connection(manager: dns.quic.SyncQuicManager, ip: str, port: int) -> tuple[Any, bool]:
+    """Return a tuple of (connection, reused) with the open QUIC connection to ip and port from the manager.
+
+    The reused bool is ``False`` if the manager had to open a new connection.
+    """
+    reused = (ip, port) in manager._connections  # noqa: SLF001
+    return manager.connect(ip, port), reused  # type: ignore[no-untyped-call]
+
+
+quic_managers = ConnectionPool(name="quic", close=lambda manager: manager.__exit__(None, None, None))
+"""``quic_managers`` is the pool of ``dns.quic.SyncQuicManager`` objects used for DoH3 and DoQ queries.
+
+Managers are keyed by ``(protocol, hostname, ip, port, verify)``.
+"""
+
+
+@functools.lru_cache(maxsize=64)
+def get_ssl_context(verify: bool | str, *, check_hostname: bool) -> ssl.SSLContext:
+    """Return a (cached) SSLContext for DoT connections.
+
+    Creating an SSLContext loads the CA bundle from disk which is expensive, so contexts are created once for each
+    combination of verify (``True``, ``False`` or a CA path) and check_hostname and reused for all later scrapes.
+    """
+    return dns.query.make_ssl_context(verify=verify, check_hostname=check_hostname, alpns=["dot"])
+
+
+def open_tls_connection(  # noqa: PLR0913
+    ip: str,
+    port: int,
+    server_hostname: str | None,
+    ssl_context: ssl.SSLContext,
+    session: ssl.SSLSession | None,
+    timeout: float,
+    timer: PhaseTimer | None = None,
+) -> ssl.SSLSocket:
+    """Connect to ip and port and do the TLS handshake, resuming the TLS session if one is provided.
+
+    Returns a connected non-blocking SSLSocket ready to be passed to ``dns.query.tls()`` as ``sock=``.
+    Raises ``dns.exception.Timeout`` if the connection and handshake takes longer than timeout seconds.
+    The time spent is added to the ``connect`` and ``handshake`` phases of the timer if one is provided.
+    """
+    sock = dns.query.make_socket(dns.inet.af_for_address(ip), socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        with timer.measure("connect") if timer else contextlib.nullcontext():
+            sock.connect((ip, port))
+        with timer.measure("handshake") if timer else contextlib.nullcontext():
+            tls = ssl_context.wrap_socket(sock, server_hostname=server_hostname, session=session)
+    except socket.timeout as e:
+        sock.close()
+        raise dns.exception.Timeout from e
+    except BaseException:
+        sock.close()
+        raise
+    tls.setblocking(False)  # noqa: FBT003
+    return tls
+
+
+class PipelinedTCPConnection:
+    """A plain DNS TCP connection which can be used by multiple scrapes at the same time (RFC 7766 pipelining).
+
+    Queries are written to the connection as soon as they are ready, without waiting for earlier responses. A
+    reader thread reads responses as they arrive (possibly out of order) and hands each one to the waiting scrape
+    based on the message ID. Every query on the connection gets a unique message ID.
+
+    If the server includes an ``edns-tcp-keepalive`` option (RFC 7828) in a response the connection is not used
+    after the idle timeout announced by the server.
+
+    The socket is non-blocking, so writing a query can not block longer than the query timeout when the server
+    stops reading. A query which could not be written in time closes the connection, since a partially written
+    query can not be recovered from. The reader thread waits for responses with a selector, which unlike
+    ``select.select()`` works for file descriptors above ``FD_SETSIZE``.
+    """
+
+    def __init__(self, ip: str, port: int, timeout: float) -> None:
+        """Connect to ip and port and start the reader thread."""
+        self.peer = f"{ip}:{port}"
+        self.closed = False
+        # the idle timeout announced by the server in edns-tcp-keepalive, None if the server never sent one
+        self.keepalive: float | None = None
+        self.last_activity = time.monotonic()
+        self._pending: dict[int, list[Any]] = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        # the reader thread checks if the connection was closed at least this often
+        self._timeout = timeout
+        self._sock = dns.query.make_socket(dns.inet.af_for_address(ip), socket.SOCK_STREAM)
+        try:
+            self._sock.settimeout(timeout)
+            self._sock.connect((ip, port))
+            self._sock.setblocking(False)  # noqa: FBT003
+        except socket.timeout as e:
+            self._sock.close()
+            raise dns.exception.Timeout from e
+        except BaseException:
+            self._sock.close()
+            raise
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._sock, selectors.EVENT_READ)
+        self._reader = threading.Thread(target=self._read_responses, name=f"dnsexp-tcp-{self.peer}", daemon=True)
+        self._reader.start()
+
+    def usable(self) -> bool:
+        """Return ``True`` if the connection is open and the server-announced keepalive timeout has not passed."""
+        if self.closed:
+            return False
+        return self.keepalive is None or time.monotonic() - self.last_activity < self.keepalive
+
+    def query(self, q: dns.message.Message, timeout: float, wire: bytes | None = None) -> dns.message.Message:
+        """Send the query and wait for the response with the same message ID.
+
+        If ``wire`` is given it is used as the prebuilt wire format of q, only the message ID is replaced.
+
+        Raises ``EOFError`` if the connection is closed before the response arrives, and ``dns.exception.Timeout``
+        if the query can not be written or no response arrives within timeout seconds. The message ID of q is
+        changed.
+        """
+        expiration = time.time() + timeout
+        done = threading.Event()
+        waiter: list[Any] = [done, None]
+        with self._lock:
+            if self.closed:
+                raise EOFError
+            # find a message ID which is not in use on this connection
+            while (qid := dns.entropy.random_16()) in self._pending:
+                pass
+            q.id = qid
+            self._pending[qid] = waiter
+        try:
+            wire = q.to_wire() if wire is None else qid.to_bytes(2, "big") + wire[2:]
+            self._write(wire=wire, expiration=expiration)
+            if not done.wait(max(expiration - time.time(), 0)):
+                raise dns.exception.Timeout
+        finally:
+            with self._lock:
+                self._pending.pop(qid, None)
+        if waiter[1] is None:
+            # the reader thread hit EOF or an error
+            raise EOFError
+        r = dns.message.from_wire(waiter[1], one_rr_per_rrset=True)
+        if not q.is_response(r):
+            raise dns.query.BadResponse
+        self.handle_keepalive(r)
+        return r
+
+    def _write(self, wire: bytes, expiration: float) -> None:
+        """Write the query to the connection before expiration, close the connection if writing fails."""
+        # other queries might be waiting for a server which stopped reading, so only wait until expiration
+        if not self._write_lock.acquire(timeout=max(expiration - time.time(), 0)):
+            raise dns.exception.Timeout
+        try:
+            dns.query.send_tcp(self._sock, wire, expiration)
+        except BaseException:
+            logger.debug(f"Writing a query to TCP connection {self.peer} failed, closing it", exc_info=True)
+            self.close()
+            raise
+        finally:
+            self._write_lock.release()
+
+    def handle_keepalive(self, response: dns.message.Message) -> None:
+        """Remember the edns-tcp-keepalive idle timeout from the response, if any."""
+        for option in response.options:
+            if option.otype == dns.edns.KEEPALIVE:
+                data = option.to_wire()
+                if data and len(data) == 2:  # noqa: PLR2004
+                    # the timeout is in units of 100 milliseconds
+                    self.keepalive = int.from_bytes(data, "big") / 10
+                break
+
+    def close(self) -> None:
+        """Close the connection, the reader thread wakes up all waiting queries."""
+        self.closed = True
+        with contextlib.suppress(OSError):
+            self._sock.shutdown(socket.SHUT_RDWR)
+        self._sock.close()
+
+    def _read_exactly(self, count: int) -> bytes:
+        """Read and return count bytes from the socket, raise EOFError if the connection was closed."""
+        data = b""
+        while len(data) < count:
+            if self.closed:
+                raise EOFError
+            if not self._selector.select(timeout=self._timeout):
+                # nothing to read yet, check again if the connection was closed in the meantime
+                continue
+            try:
+                chunk = self._sock.recv(count - len(data))
+            except BlockingIOError:
+                continue
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def _read_responses(self) -> None:
+        """Read responses and hand them to the waiting queries until the connection is closed."""
+        try:
+            while True:
+                length = int.from_bytes(self._read_exactly(2), "big")
+                wire = self._read_exactly(length)
+                self.last_activity = time.monotonic()
+                with self._lock:
+                    waiter = self._pending.pop(int.from_bytes(wire[:2], "big"), None)
+                if waiter is None:
+                    logger.debug(f"Got a response with an unknown message ID on TCP connection to {self.peer}")
+                    continue
+                waiter[1] = wire
+                waiter[0].set()
+        except (EOFError, OSError, ValueError):
+            # the selector raises ValueError when the socket was closed by close()
+            logger.debug(f"TCP connection to {self.peer} was closed")
+        finally:
+            with self._lock:
+                self.closed = True
+                waiters = list(self._pending.values())
+                self._pending.clear()
+            for waiter in waiters:
+                waiter[0].set()
+            self._selector.close()
+            self._sock.close()
+
+
+tcp_connections = ConnectionPool(name="tcp", close=lambda connection: connection.close())
+"""``tcp_connections`` is the pool of ``PipelinedTCPConnection`` objects used for plain TCP queries.
+
+Connections are shared by concurrent scrapes. Connections are keyed by ``(ip, port, proxy)``.
+"""
+
+dot_sockets = ConnectionPool(name="dot", close=lambda sock: sock.close())
+"""``dot_sockets`` is the pool of idle ``ssl.SSLSocket`` objects used for DoT queries.
+
+A socket is only used by one scrape at a time, scrapes ``take()`` the socket from the pool and ``put()`` it back
+when the query is done. Sockets are keyed by ``(hostname, ip, port, verify)``.
+"""
+
+tls_sessions = ConnectionPool(name="tls_sessions", close=lambda _session: None)
+"""``tls_sessions`` keeps the most recent ``ssl.SSLSession`` for each DoT server for TLS session resumption.
+
+Sessions are keyed by ``(hostname, ip, port, verify)``. Sessions are not connections, but the pool gives them the
+same size limit and idle expiry as everything else.
+"""
+
+# all the pools, used by configure_pools()
+POOLS = [doh_clients, quic_managers, tcp_connections, dot_sockets, tls_sessions]
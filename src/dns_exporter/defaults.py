@@ -0,0 +1,30 @@
+"""``dns_exporter.defaults`` contains the default values of the command-line options.
+
+The defaults are kept in this module without any imports so ``dns_exporter --version`` and ``dns_exporter --help``
+can build the argument parser without importing dnspython and the rest of the exporter.
+"""
+
+# the default maximum number of connections in each pool
+DEFAULT_POOL_MAXSIZE = 256
+
+# the default number of seconds a connection can be idle before it is closed
+DEFAULT_POOL_MAX_IDLE = 60.0
+
+# the default number of seconds the rendered output of /metrics is reused, 0 only shares concurrent renders
+DEFAULT_METRICS_CACHE_MAX_AGE = 0.0
+
+# the default number of seconds resolved addresses are cached
+DEFAULT_RESOLVE_CACHE_TTL = 60.0
+
+# the default number of seconds failed lookups are cached
+DEFAULT_RESOLVE_CACHE_NEGATIVE_TTL = 10.0
+
+# the default maximum number of cached hostnames
+DEFAULT_RESOLVE_CACHE_MAXSIZE = 1024
+
+# the default maximum number of label sets in the dnsexp_dns_responsetime_seconds histogram, 0 means no limit
+DEFAULT_RESPONSETIME_MAX_SERIES = 10000
+
+# the default maximum number of requests handled at the same time, and waiting for a free worker
+DEFAULT_WORKERS = 100
+DEFAULT_QUEUE_SIZE = 100
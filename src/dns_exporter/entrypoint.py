@@ -1,20 +1,37 @@
 """``dns_exporter.entrypoint`` contains argparse stuff and ``dns_exporter`` script entrypoint.
 
 This module is mostly boilerplate code for command-line argument handling and logging.
+
+The rest of the exporter is imported by ``main()`` after the command-line arguments have been parsed, so
+``dns_exporter --version`` and ``dns_exporter --help`` do not have to import dnspython.
 """
 from __future__ import annotations
 
 import argparse
 import logging
+import signal
 import sys
+import threading
 import warnings
-from http.server import ThreadingHTTPServer
-from pathlib import Path
+from typing import TYPE_CHECKING
+
+from dns_exporter.defaults import (
+    DEFAULT_METRICS_CACHE_MAX_AGE,
+    DEFAULT_POOL_MAX_IDLE,
+    DEFAULT_POOL_MAXSIZE,
+    DEFAULT_QUEUE_SIZE,
+    DEFAULT_RESOLVE_CACHE_MAXSIZE,
+    DEFAULT_RESOLVE_CACHE_NEGATIVE_TTL,
+    DEFAULT_RESOLVE_CACHE_TTL,
+    DEFAULT_RESPONSETIME_MAX_SERIES,
+    DEFAULT_WORKERS,
+)
+from dns_exporter.version import __version__
 
-import yaml
+if TYPE_CHECKING:  # pragma: no cover
+    from types import FrameType
 
-from dns_exporter.config import ConfigDict
-from dns_exporter.exporter import DNSExporter
+    from dns_exporter.exporter import DNSExporter
 
 # get logger
 logger = logging.getLogger(f"dns_exporter.{__name__}")
@@ -23,10 +40,26 @@ logger = logging.getLogger(f"dns_exporter.{__name__}")
 def get_parser() -> argparse.ArgumentParser:
     """Create and return the argparse object."""
     parser = argparse.ArgumentParser(
-        description=f"dns_exporter version {DNSExporter.__version__}. See ReadTheDocs for more info.",
+        description=f"dns_exporter version {__version__}. See ReadTheDocs for more info.",
     )
 
     # optional arguments
+    parser.add_argument(
+        "--connection-idle-timeout",
+        dest="connection_idle_timeout",
+        type=float,
+        help="The number of seconds a pooled connection can be idle before it is closed. Only used by modules with "
+        f"reuse_connections enabled. Default: {DEFAULT_POOL_MAX_IDLE}",
+        default=DEFAULT_POOL_MAX_IDLE,
+    )
+    parser.add_argument(
+        "--connection-pool-size",
+        dest="connection_pool_size",
+        type=int,
+        help="The maximum number of connections to keep in each connection pool. Only used by modules with "
+        f"reuse_connections enabled. Default: {DEFAULT_POOL_MAXSIZE}",
+        default=DEFAULT_POOL_MAXSIZE,
+    )
     parser.add_argument(
         "-c",
         "--config-file",
@@ -43,6 +76,39 @@ def get_parser() -> argparse.ArgumentParser:
         help="Debug mode. Equal to setting --log-level=DEBUG.",
         default=argparse.SUPPRESS,
     )
+    parser.add_argument(
+        "--enable-profile-endpoint",
+        dest="enable_profile_endpoint",
+        action="store_true",
+        help="Enable the sampling profiler at /debug/profile?seconds=N, which returns the stacks of all threads in the "
+        "collapsed stack format used by flame graph tools. Only enable this on trusted networks. Default: False",
+        default=False,
+    )
+    parser.add_argument(
+        "--enable-reload-endpoint",
+        dest="enable_reload_endpoint",
+        action="store_true",
+        help="Enable reloading the config file with a HTTP POST request to /-/reload. The config file can always be "
+        "reloaded by sending SIGHUP to the process. Default: False",
+        default=False,
+    )
+    parser.add_argument(
+        "--engine",
+        dest="engine",
+        choices=["threading", "asyncio"],
+        help="The scrape engine to use. 'threading' handles each scrape in a thread, 'asyncio' handles all scrapes in "
+        "an event loop using the dnspython asyncio API. Default: threading",
+        default="threading",
+    )
+    parser.add_argument(
+        "--lazy-modules",
+        dest="lazy_modules",
+        action="store_true",
+        help="Compile each module from the config file when it is first used in a scrape instead of at startup. "
+        "This makes startup faster with large config files, but invalid modules are only found when they are used. "
+        "Default: False",
+        default=False,
+    )
     parser.add_argument(
         "-L",
         "--listen-ip",
@@ -58,6 +124,23 @@ def get_parser() -> argparse.ArgumentParser:
         help="Logging level. One of DEBUG, INFO, WARNING, ERROR, CRITICAL. Defaults to INFO.",
         default="INFO",
     )
+    parser.add_argument(
+        "--metrics-cache-max-age",
+        dest="metrics_cache_max_age",
+        type=float,
+        help="Reuse the rendered output of the /metrics endpoint for this many seconds. Concurrent requests to "
+        "/metrics always share a single rendering, also when this is 0. "
+        f"Default: {DEFAULT_METRICS_CACHE_MAX_AGE}",
+        default=DEFAULT_METRICS_CACHE_MAX_AGE,
+    )
+    parser.add_argument(
+        "--module-cache-dir",
+        dest="module_cache_dir",
+        help="Save the compiled modules from the config file in this directory, so the next startup with the same "
+        "config file and dns_exporter version can load them instead of compiling them again. The cache files are "
+        "Python pickles, so the directory must only be writable by the exporter. Default: None",
+        default=None,
+    )
     parser.add_argument(
         "-p",
         "--port",
@@ -66,6 +149,14 @@ def get_parser() -> argparse.ArgumentParser:
         help="The port the exporter should listen for requests on. Default: 15353",
         default=15353,
     )
+    parser.add_argument(
+        "--queue-size",
+        dest="queue_size",
+        type=int,
+        help="The maximum number of requests waiting for a free worker. Requests arriving when all workers are busy "
+        f"and the queue is full fail right away with failure reason exporter_saturated. Default: {DEFAULT_QUEUE_SIZE}",
+        default=DEFAULT_QUEUE_SIZE,
+    )
     parser.add_argument(
         "-q",
         "--quiet",
@@ -75,6 +166,48 @@ def get_parser() -> argparse.ArgumentParser:
         help="Quiet mode. No output at all if no errors are encountered. Equal to setting --log-level=WARNING.",
         default=argparse.SUPPRESS,
     )
+    parser.add_argument(
+        "--resolve-cache-negative-ttl",
+        dest="resolve_cache_negative_ttl",
+        type=float,
+        help="The number of seconds a failed lookup of a DNS server hostname is cached. "
+        f"Default: {DEFAULT_RESOLVE_CACHE_NEGATIVE_TTL}",
+        default=DEFAULT_RESOLVE_CACHE_NEGATIVE_TTL,
+    )
+    parser.add_argument(
+        "--resolve-cache-size",
+        dest="resolve_cache_size",
+        type=int,
+        help="The maximum number of DNS server hostnames in the resolve cache. "
+        f"Default: {DEFAULT_RESOLVE_CACHE_MAXSIZE}",
+        default=DEFAULT_RESOLVE_CACHE_MAXSIZE,
+    )
+    parser.add_argument(
+        "--resolve-cache-ttl",
+        dest="resolve_cache_ttl",
+        type=float,
+        help="The number of seconds the resolved IPs of a DNS server hostname are cached. Set to 0 to disable the "
+        f"resolve cache. Default: {DEFAULT_RESOLVE_CACHE_TTL}",
+        default=DEFAULT_RESOLVE_CACHE_TTL,
+    )
+    parser.add_argument(
+        "--responsetime-labels",
+        dest="responsetime_labels",
+        type=str,
+        help="Comma separated list of the labels to keep in the dnsexp_dns_responsetime_seconds histogram, like "
+        "server,protocol,query_name,rcode. Labels like nsid and answer can have many values. "
+        "Default: all the labels of dnsexp_dns_query_time_seconds",
+        default=None,
+    )
+    parser.add_argument(
+        "--responsetime-max-series",
+        dest="responsetime_max_series",
+        type=int,
+        help="The maximum number of label sets in the dnsexp_dns_responsetime_seconds histogram, the least recently "
+        "observed label set is removed when it is reached. Set to 0 to disable the limit. "
+        f"Default: {DEFAULT_RESPONSETIME_MAX_SERIES}",
+        default=DEFAULT_RESPONSETIME_MAX_SERIES,
+    )
     parser.add_argument(
         "-v",
         "--version",
@@ -83,6 +216,13 @@ def get_parser() -> argparse.ArgumentParser:
         help="Show version and exit.",
         default=argparse.SUPPRESS,
     )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        help=f"The maximum number of requests handled at the same time. Default: {DEFAULT_WORKERS}",
+        default=DEFAULT_WORKERS,
+    )
     return parser
 
 
@@ -95,23 +235,26 @@ def parse_args(
     return parser, args
 
 
-def main(mockargs: list[str] | None = None) -> None:
-    """Read config and start exporter."""
-    # suppress warnings at runtime
-    if not sys.warnoptions:
-        warnings.simplefilter("ignore")
+def install_reload_signal_handler(handler: type[DNSExporter]) -> None:
+    """Reload the config file of the handler in a new thread when the process gets SIGHUP.
 
-    # get arpparser and parse args
-    parser, args = parse_args(mockargs)
+    Signal handlers can only be installed in the main thread, so this does nothing when called from other threads
+    (like when main() runs in a thread in the unit tests) or on platforms without SIGHUP.
+    """
+    if not hasattr(signal, "SIGHUP") or threading.current_thread() is not threading.main_thread():
+        logger.debug("Not installing SIGHUP handler")
+        return
 
-    # handle version check
-    if hasattr(args, "version"):
-        print(f"dns_exporter version {DNSExporter.__version__}")  # noqa: T201
-        sys.exit(0)
+    def reload(signum: int, frame: FrameType | None) -> None:  # noqa: ARG001
+        # reload in a thread so the signal handler does not block the listener
+        threading.Thread(target=handler.reload, name="dnsexp-reload", daemon=True).start()
 
-    # configure the log format and level
+    signal.signal(signal.SIGHUP, reload)
+
+
+def configure_logging(level: str) -> None:
+    """Configure the log format and level."""
     console_logformat = "%(asctime)s %(levelname)s %(name)s.%(funcName)s():%(lineno)i:  %(message)s"
-    level = getattr(args, "log-level")
     logging.basicConfig(
         level=level,
         format=console_logformat,
@@ -125,53 +268,133 @@ def main(mockargs: list[str] | None = None) -> None:
     if level == "INFO":
         # httpx is noisy at level info, cap to WARNING
         logging.getLogger("httpx").setLevel(logging.WARNING)
-    logger.info(
-        f"dns_exporter v{DNSExporter.__version__} starting up - logging at level {level}",
-    )
-
-    if hasattr(args, "config-file"):
-        with Path(getattr(args, "config-file")).open() as f:
-            try:
-                configfile = yaml.load(f, Loader=yaml.SafeLoader)
-            except Exception:
-                logger.exception(
-                    f"Unable to parse YAML config file {getattr(args, 'config-file')} - bailing out.",
-                )
-                sys.exit(1)
-        if (
-            not configfile
-            or "modules" not in configfile
-            or not isinstance(configfile["modules"], dict)
-            or not configfile["modules"]
-        ):
-            # configfile is empty, missing "modules" key, or modules is empty or not a dict
-            logger.error(
-                f"Invalid config file {getattr(args, 'config-file')} - yaml was valid but no modules found",
-            )
-            sys.exit(1)
-        logger.debug(f"Read {len(configfile['modules'])} modules from config file {getattr(args, 'config-file')}:")
-        logger.debug(list(configfile["modules"].keys()))
-    else:
+
+
+def configure_responsetime_histogram(labels: str | None, max_series: int) -> None:
+    """Configure the labels and series limit of the response time histogram, exit if either is invalid."""
+    from dns_exporter.metrics import QTIME_LABELS, dnsexp_dns_responsetime_seconds
+
+    labelnames = labels.split(",") if labels else QTIME_LABELS
+    unknown = [label for label in labelnames if label not in QTIME_LABELS]
+    if unknown:
+        logger.error(f"Unknown --responsetime-labels {','.join(unknown)}, must be from {','.join(QTIME_LABELS)}")
+        sys.exit(1)
+    if max_series < 0:
+        logger.error(f"Invalid --responsetime-max-series {max_series}, must be 0 or more")
+        sys.exit(1)
+    dnsexp_dns_responsetime_seconds.configure(labelnames=labelnames, max_series=max_series)
+
+
+def configure_modules(handler: type[DNSExporter], config_file: str | None) -> None:
+    """Load the modules from the config file (if any) into the handler, exit if the config file is invalid."""
+    if config_file is None:
         # there is no config file
-        configfile = {"modules": {}}
         logger.debug(
             "No -c / --config-file found so a config file will not be used. No modules loaded.",
         )
-
-    # configure DNSExporter handler and start HTTPServer
-    handler = DNSExporter
-    if configfile["modules"] and not handler.configure(
-        modules={k: ConfigDict(**v) for k, v in configfile["modules"].items()},  # type: ignore[misc]
-    ):
+        return
+    try:
+        modules = handler.load_config_file(config_file)
+    except (OSError, ValueError) as e:
+        # include the traceback from the YAML parser if there is one
+        logger.error(f"{e} - bailing out.", exc_info=e.__cause__)  # noqa: TRY400
+        sys.exit(1)
+    if modules is None:
         logger.error(
             "An error occurred while configuring dns_exporter. Bailing out.",
         )
         sys.exit(1)
+    handler.modules = modules
+    handler.config_cache.clear()
+
+
+def main(mockargs: list[str] | None = None) -> None:
+    """Read config and start exporter."""
+    # suppress warnings at runtime
+    if not sys.warnoptions:
+        warnings.simplefilter("ignore")
+
+    # get arpparser and parse args
+    parser, args = parse_args(mockargs)
+
+    # handle version check
+    if hasattr(args, "version"):
+        print(f"dns_exporter version {__version__}")  # noqa: T201
+        sys.exit(0)
+
+    # configure the log format and level
+    level = getattr(args, "log-level")
+    configure_logging(level=level)
+    logger.info(
+        f"dns_exporter v{__version__} starting up - logging at level {level}",
+    )
+
+    # check the admission control settings before doing any work
+    if args.workers < 1:
+        logger.error(f"Invalid --workers {args.workers}, must be 1 or more")
+        sys.exit(1)
+    if args.queue_size < 0:
+        logger.error(f"Invalid --queue-size {args.queue_size}, must be 0 or more")
+        sys.exit(1)
+
+    # the exporter imports dnspython and the libraries it uses for DoH and DoQ, so only import it when needed
+    import asyncio
+
+    from dns_exporter.cache import configure_metrics_cache, configure_resolve_cache
+    from dns_exporter.connections import configure_pools
+    from dns_exporter.exporter import DNSExporter
+    from dns_exporter.metrics import (
+        dnsexp_config_last_reload_success_timestamp_seconds,
+        gc_pause_tracker,
+    )
+    from dns_exporter.server import WorkerPoolHTTPServer, serve
+
+    # configure DNSExporter handler
+    handler = DNSExporter
+    handler.lazy_modules = args.lazy_modules
+    handler.module_cache_dir = args.module_cache_dir
+
+    configure_modules(handler=handler, config_file=getattr(args, "config-file", None))
+
+    # configure connection pools
+    configure_pools(maxsize=args.connection_pool_size, max_idle=args.connection_idle_timeout)
+
+    # configure the cache for resolving server hostnames
+    configure_resolve_cache(
+        ttl=args.resolve_cache_ttl,
+        negative_ttl=args.resolve_cache_negative_ttl,
+        maxsize=args.resolve_cache_size,
+    )
+
+    # configure the cache for the rendered /metrics output
+    configure_metrics_cache(max_age=args.metrics_cache_max_age)
+
+    # configure the labels and the series limit of the response time histogram
+    configure_responsetime_histogram(labels=args.responsetime_labels, max_series=args.responsetime_max_series)
+
+    # observe the duration of garbage collections in dnsexp_gc_pause_seconds
+    gc_pause_tracker.install()
+
+    dnsexp_config_last_reload_success_timestamp_seconds.set_to_current_time()
+
+    # the config file can be reloaded with SIGHUP, and with a POST to /-/reload if enabled
+    handler.config_file = getattr(args, "config-file", None)
+    handler.reload_endpoint = args.enable_reload_endpoint
+    handler.profile_endpoint = args.enable_profile_endpoint
+    install_reload_signal_handler(handler=handler)
+
     logger.info(
-        f"Ready to serve requests. Starting listener on {args.listen_ip} port {args.port}...",
+        f"Ready to serve requests. Starting {args.engine} listener on {args.listen_ip} port {args.port}...",
     )
     try:
-        ThreadingHTTPServer((args.listen_ip, args.port), handler).serve_forever()
+        if args.engine == "asyncio":
+            asyncio.run(
+                serve(listen_ip=args.listen_ip, port=args.port, workers=args.workers, queue_size=args.queue_size)
+            )
+        else:
+            WorkerPoolHTTPServer(
+                (args.listen_ip, args.port), handler, workers=args.workers, queue_size=args.queue_size
+            ).serve_forever()
     except OSError:
         logger.exception(
             f"Unable to start listener, maybe port {args.port} is in use? bailing out",
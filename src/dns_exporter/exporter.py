@@ -14,37 +14,67 @@ Made with love by Thomas Steen Rasmussen/Tykling, 2023.
 
 from __future__ import annotations
 
+import gzip
 import ipaddress
 import logging
 import random
+import re
 import socket
+import threading
+import time
 import urllib.parse
-from dataclasses import asdict
 from ipaddress import IPv4Address, IPv6Address
+from pathlib import Path
 from typing import TYPE_CHECKING, Literal
 
-import dns.edns
 import dns.exception
-import dns.flags
 import dns.opcode
 import dns.query
 import dns.rcode
 import dns.rdatatype
-import dns.resolver
-import socks  # type: ignore[import]
+import yaml
 from prometheus_client import CollectorRegistry, MetricsHandler, exposition
 
+from dns_exporter.cache import (
+    ConfigCache,
+    get_module_cache_path,
+    load_module_cache,
+    metrics_cache,
+    resolve_cache,
+    save_module_cache,
+)
 from dns_exporter.collector import DNSCollector, FailCollector
-from dns_exporter.config import Config, ConfigDict, RFValidator, RRValidator
+from dns_exporter.config import Config, ConfigDict, Modules, RFValidator, RRValidator
 from dns_exporter.exceptions import ConfigError
-from dns_exporter.metrics import QTIME_LABELS, dnsexp_http_requests_total, dnsexp_http_responses_total
+from dns_exporter.metrics import (
+    QTIME_LABELS,
+    dnsexp_config_last_reload_success_timestamp_seconds,
+    dnsexp_config_load_seconds,
+    dnsexp_config_reloads_total,
+    dnsexp_http_requests_total,
+    dnsexp_http_responses_total,
+    dnsexp_query_request_cpu_seconds,
+    dnsexp_query_request_stage_seconds,
+    dnsexp_query_requests_in_flight,
+)
+from dns_exporter.phases import PhaseTimer
+from dns_exporter.profiler import PROFILE_DEFAULT_SECONDS, PROFILE_MAX_SECONDS, profile
+from dns_exporter.query import get_query_template
+from dns_exporter.serializer import generate_text
 from dns_exporter.version import __version__
 
 if TYPE_CHECKING:  # pragma: no cover
-    from prometheus_client.registry import RestrictedRegistry
+    import dns.resolver
+    from prometheus_client.registry import Collector
 
 logger = logging.getLogger(f"dns_exporter.{__name__}")
 
+# use the much faster libyaml parser when pyyaml was built with it
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# the phases of loading the config file, reported in the dnsexp_config_load_seconds metric
+CONFIG_LOAD_PHASES = ("read", "cache_load", "parse", "compile", "cache_save", "total")
+
 INDEX = """<!DOCTYPE html>
 <html lang="en">
 <head><title>DNS Exporter</title></head>
@@ -64,11 +94,15 @@ class DNSExporter(MetricsHandler):
     MetricsHandler subclass for incoming scrape requests. Initiated on each
     request as a handler by http.server.HTTPServer().
 
-    The configure() classmethod can optionally be called to load modules before use.
+    The configure() classmethod can optionally be called to load modules before use, and the reload()
+    classmethod replaces them with the modules from the config file.
 
     Attributes:
     -----------
         modules: A dict of dns_exporter.config.Config instances to be used in scrape requests.
+        config_file: The path to the config file used by reload().
+        lazy_modules: Compile the modules from the config file when they are first used instead of when loading.
+        module_cache_dir: The directory to save compiled modules in, so they can be loaded faster next time.
 
     """
 
@@ -77,6 +111,31 @@ class DNSExporter(MetricsHandler):
     # the modules key is populated by configure() before the class is initialised
     modules: dict[str, Config] | None = None
 
+    # compile modules from the config file on first use, and only one module at a time
+    lazy_modules: bool = False
+    compile_lock = threading.Lock()
+
+    # the directory for the module cache files, or None to disable the module cache
+    module_cache_dir: str | None = None
+
+    # configs built from modules and querystrings, cleared when modules are (re)configured
+    config_cache = ConfigCache()
+
+    # the config file the modules were loaded from, set by main() so the config can be reloaded
+    config_file: str | None = None
+
+    # allow reloading the config file with a POST to /-/reload
+    reload_endpoint: bool = False
+
+    # only one reload at a time
+    reload_lock = threading.Lock()
+
+    # allow profiling the exporter with a GET to /debug/profile
+    profile_endpoint: bool = False
+
+    # set on the handler used for requests which arrive when all workers are busy and the queue is full
+    saturated: bool = False
+
     @classmethod
     def prepare_config_rrvalidators(
         cls,
@@ -99,7 +158,9 @@ class DNSExporter(MetricsHandler):
                     else:
                         # unsupported type
                         raise TypeError(validator)  # noqa: TRY301
-        except TypeError as e:
+                    # compile the matcher now so invalid regexes are found here instead of during scrapes
+                    tmp[validator].matcher()
+        except (TypeError, re.error) as e:
             logger.exception("Unable to create RRValidator object")
             raise ConfigError("invalid_request_config") from e
         return tmp
@@ -121,6 +182,8 @@ class DNSExporter(MetricsHandler):
                 else:
                     # unsupported type
                     raise TypeError("validate_response_flags")  # noqa: TRY301
+                # compile the matcher now instead of during the first scrape
+                tmp["validate_response_flags"].matcher()
         except TypeError as e:
             logger.exception("Unable to create validator object")
             raise ConfigError("invalid_request_config") from e
@@ -157,11 +220,12 @@ class DNSExporter(MetricsHandler):
     ) -> ConfigDict:
         """Parse and create integer objects for the config."""
         tmp: ConfigDict = {}
+        collect_ttl_max_rrs: Literal["collect_ttl_max_rrs"] = "collect_ttl_max_rrs"
         collect_ttl_rr_value_length: Literal["collect_ttl_rr_value_length"] = "collect_ttl_rr_value_length"
         edns_bufsize: Literal["edns_bufsize"] = "edns_bufsize"
         edns_pad: Literal["edns_pad"] = "edns_pad"
         try:
-            for key in [edns_bufsize, edns_pad, collect_ttl_rr_value_length]:
+            for key in [edns_bufsize, edns_pad, collect_ttl_max_rrs, collect_ttl_rr_value_length]:
                 if key in config:
                     if isinstance(config[key], str):
                         tmp[key] = int(config[key])
@@ -210,12 +274,26 @@ class DNSExporter(MetricsHandler):
         tmp: ConfigDict = {}
         # use literals for TypedDict keys to make mypy happy
         collect_ttl: Literal["collect_ttl"] = "collect_ttl"
+        collect_ttl_aggregate: Literal["collect_ttl_aggregate"] = "collect_ttl_aggregate"
+        doh_http2: Literal["doh_http2"] = "doh_http2"
         edns: Literal["edns"] = "edns"
         edns_do: Literal["edns_do"] = "edns_do"
         recursion_desired: Literal["recursion_desired"] = "recursion_desired"
+        reuse_connections: Literal["reuse_connections"] = "reuse_connections"
+        tls_session_resumption: Literal["tls_session_resumption"] = "tls_session_resumption"
         verify_certificate: Literal["verify_certificate"] = "verify_certificate"
         try:
-            for key in [collect_ttl, edns, edns_do, recursion_desired, verify_certificate]:
+            for key in [
+                collect_ttl,
+                collect_ttl_aggregate,
+                doh_http2,
+                edns,
+                edns_do,
+                recursion_desired,
+                reuse_connections,
+                tls_session_resumption,
+                verify_certificate,
+            ]:
                 if key not in config:
                     continue
                 if isinstance(config[key], str):
@@ -276,6 +354,9 @@ class DNSExporter(MetricsHandler):
                         logger.error("No scheme in proxy")
                         raise ConfigError("invalid_request_proxy")
 
+                    # pysocks is only needed by modules and scrapes which use a proxy
+                    import socks  # type: ignore[import-untyped]
+
                     # parse proxy into a SplitResult
                     splitresult = urllib.parse.urlsplit(proxy)
                     if not splitresult.scheme or splitresult.scheme.upper() not in socks.PROXY_TYPES:
@@ -364,19 +445,48 @@ class DNSExporter(MetricsHandler):
         fail_registry.register(fail_collector)
 
     def build_final_config(self, qs: dict[str, str]) -> None:
-        """Construct the final effective scrape config from defaults and values from the querystring."""
+        """Construct the final effective scrape config from defaults and values from the querystring.
+
+        The config built from the module and querystring is cached, so identical scrapes only need to validate the
+        cached config (which resolves the server ip if needed). Configs are immutable so the cached config is shared
+        by all the scrapes using it, only scrapes which need to set the server ip get their own copy of it.
+        """
+        # the phase timer for this scrape, resolving the server is the first phase
+        self.timer = PhaseTimer()
+        # the cache key is the handler class (which has the modules) and the normalised querystring
+        key = (type(self), tuple(sorted(qs.items())))
+        config = self.config_cache.get(key)
+        if config is None:
+            # do not cache the config if the modules are reloaded while it is being built
+            generation = self.config_cache.generation
+            config = self.create_final_config(qs=qs)
+            self.config_cache.put(key, config, generation=generation)
+        else:
+            logger.debug("Using cached config")
+            qs.pop("module", None)
+
+        self.config = config
+
+        # validate config
+        self.validate_config()
+
+        logger.debug(f"Final scrape configuration: {self.config}")
+
+    def create_final_config(self, qs: dict[str, str]) -> Config:
+        """Create and return a Config object from defaults, the module (if any) and values from the querystring."""
         # first get the defaults
-        config = ConfigDict(**asdict(Config.create(name="defaults")))  # type: ignore[misc]
+        config = Config.create(name="defaults").as_config_dict()
 
         # if a module is specified in the querystring apply it first
         if "module" in qs:
-            if self.modules is None or qs["module"] not in self.modules:
+            module = self.get_module(qs["module"])
+            if module is None:
                 raise ConfigError("invalid_request_module")
-            config.update(asdict(self.modules[qs["module"]]))
+            config.update(module.as_config_dict())
             del qs["module"]
 
         # and the querystring from the scrape request has highest precedence
-        config.update(qs)
+        config.update(qs)  # type: ignore[typeddict-item]
 
         # prepare config dict
         config = self.prepare_config(config)
@@ -386,18 +496,13 @@ class DNSExporter(MetricsHandler):
 
         # create the config object
         try:
-            self.config = Config.create(**config)
+            return Config.create(**config)
         except TypeError as e:
             logger.exception(
                 "Exception while creating config - invalid field specified?",
             )
             raise ConfigError("invalid_request_config") from e
 
-        # validate config
-        self.validate_config()
-
-        logger.debug(f"Final scrape configuration: {self.config}")
-
     @classmethod
     def configure(
         cls,
@@ -420,33 +525,267 @@ class DNSExporter(MetricsHandler):
             bool: True if all ConfigDict objects was validated and loaded OK, False
                   if an error was encountered.
         """
-        prepared: ConfigDict | None
+        # cached configs might be built from old modules
+        cls.config_cache.clear()
         if modules is None:
             modules = {}
         if cls.modules is None:
             cls.modules = {}
         for name, config in modules.items():
-            try:
-                prepared = cls.prepare_config(ConfigDict(**config))  # type: ignore[misc]
-            except ConfigError:
-                logger.exception(f"There was an issue while preparing config {name}")
+            module = cls.create_module(name=name, config=config)
+            if module is None:
+                return False
+            cls.modules[name] = module
+
+        logger.info(
+            f"{len(modules)} module(s) loaded OK, total modules: {len(cls.modules)}.",
+        )
+        return True
+
+    @classmethod
+    def get_module(cls, name: str) -> Config | None:
+        """Return the Config object for the module, compiling it first if it has not been used before.
+
+        Returns None if the module does not exist, and raises ConfigError if the module could not be compiled.
+        """
+        # the modules dict can be replaced by a reload at any time, only look it up once
+        modules = cls.modules if cls.modules is not None else {}
+        module = modules.get(name)
+        sources = getattr(modules, "sources", {})
+        if module is not None or name not in sources:
+            return module
+        with cls.compile_lock:
+            # another thread might have compiled the module while this one was waiting for the lock
+            module = modules.get(name)
+            if module is None:
+                logger.debug(f"Compiling module {name} on first use")
+                module = cls.create_module(name=name, config=sources[name])
+                if module is None:
+                    raise ConfigError("invalid_request_module")
+                modules[name] = module
+        return module
+
+    @classmethod
+    def create_module(cls, name: str, config: ConfigDict) -> Config | None:
+        """Prepare the ConfigDict and return a Config object for the module, or None if the config is invalid."""
+        prepared: ConfigDict | None
+        try:
+            prepared = cls.prepare_config(ConfigDict(**config))  # type: ignore[misc]
+        except ConfigError:
+            logger.exception(f"There was an issue while preparing config {name}")
+            return None
+        try:
+            return Config.create(name=name, **prepared)
+        except TypeError:
+            logger.exception(f"Unable to parse config {prepared}")
+        except ConfigError:
+            logger.exception(
+                f"Invalid value found while building config {prepared}",
+            )
+        return None
+
+    @classmethod
+    def read_config_file(cls, path: str) -> dict[str, ConfigDict]:
+        """Read the YAML config file and return the modules from it.
+
+        Raises ValueError if the file is not valid YAML or has no modules, and OSError if it can not be read.
+        """
+        return cls.parse_config_file(data=Path(path).read_bytes(), path=path)
+
+    @staticmethod
+    def parse_config_file(data: bytes, path: str) -> dict[str, ConfigDict]:
+        """Parse the contents of the YAML config file and return the modules from it.
+
+        Raises ValueError if the data is not valid YAML or has no modules.
+        """
+        try:
+            configfile = yaml.load(data, Loader=YAML_LOADER)  # noqa: S506
+        except yaml.YAMLError as e:
+            msg = f"Unable to parse YAML config file {path}"
+            raise ValueError(msg) from e
+        if (
+            not configfile
+            or "modules" not in configfile
+            or not isinstance(configfile["modules"], dict)
+            or not configfile["modules"]
+        ):
+            # configfile is empty, missing "modules" key, or modules is empty or not a dict
+            msg = f"Invalid config file {path} - yaml was valid but no modules found"
+            raise ValueError(msg)
+        logger.debug(f"Read {len(configfile['modules'])} modules from config file {path}:")
+        logger.debug(list(configfile["modules"].keys()))
+        return {k: ConfigDict(**v) for k, v in configfile["modules"].items()}  # type: ignore[misc]
+
+    @classmethod
+    def build_modules(cls, configured: dict[str, ConfigDict]) -> Modules | None:
+        """Return a Modules object with the modules from the config file, or None if a module is invalid.
+
+        With lazy_modules enabled the modules are not compiled here, invalid modules are found when they are used.
+        """
+        modules = Modules(sources=configured)
+        if cls.lazy_modules:
+            logger.debug(f"Deferring compilation of {len(configured)} module(s) until they are used")
+            return modules
+        for name, config in configured.items():
+            module = cls.create_module(name=name, config=config)
+            if module is None:
+                logger.error(f"Invalid module {name} in config file")
+                return None
+            modules[name] = module
+        return modules
+
+    @classmethod
+    def load_config_file(cls, path: str) -> Modules | None:
+        """Load the modules from the config file, or from the module cache if the config file is unchanged.
+
+        The time spent in each phase is logged and saved in the dnsexp_config_load_seconds metric.
+
+        Raises ValueError if the file is not valid YAML or has no modules, and OSError if it can not be read.
+
+        Returns:
+        --------
+            Modules: The modules, or None if a module in the config file is invalid.
+        """
+        timings = dict.fromkeys(CONFIG_LOAD_PHASES, 0.0)
+        start = last = time.perf_counter()
+
+        def phase(name: str) -> None:
+            nonlocal last
+            now = time.perf_counter()
+            timings[name] = now - last
+            last = now
+
+        data = Path(path).read_bytes()
+        phase("read")
+
+        modules = None
+        cache_path = None
+        if cls.module_cache_dir:
+            cache_path = get_module_cache_path(directory=cls.module_cache_dir, config_file=path, data=data)
+            modules = load_module_cache(path=cache_path)
+            phase("cache_load")
+
+        if modules is None:
+            configured = cls.parse_config_file(data=data, path=path)
+            phase("parse")
+            modules = cls.build_modules(configured=configured)
+            phase("compile")
+            if modules is None:
+                return None
+            # only fully compiled modules are worth caching
+            if cache_path and not modules.pending:
+                save_module_cache(path=cache_path, modules=modules)
+                phase("cache_save")
+
+        timings["total"] = time.perf_counter() - start
+        for name, seconds in timings.items():
+            dnsexp_config_load_seconds.labels(phase=name).set(seconds)
+        phases = ", ".join(f"{name} {seconds:.3f}s" for name, seconds in timings.items() if name != "total")
+        logger.info(
+            f"Loaded {len(modules.sources)} module(s) from config file {path} in {timings['total']:.3f}s ({phases})",
+        )
+        return modules
+
+    @staticmethod
+    def changed_modules(old: dict[str, Config], new: dict[str, Config]) -> set[str]:
+        """Return the names of the modules which were added, removed or changed between old and new.
+
+        Modules loaded from the config file are compared by their source ConfigDict, since they might not have
+        been compiled yet, other modules are compared by their Config objects.
+        """
+        old_sources: dict[str, ConfigDict] = getattr(old, "sources", {})
+        new_sources: dict[str, ConfigDict] = getattr(new, "sources", {})
+        changed = set()
+        for name in old.keys() | old_sources.keys() | new.keys() | new_sources.keys():
+            if name in old_sources and name in new_sources:
+                if old_sources[name] != new_sources[name]:
+                    changed.add(name)
+            elif old.get(name) is None or old.get(name) != new.get(name):
+                changed.add(name)
+        return changed
+
+    @classmethod
+    def reload(cls) -> bool:
+        """Read the config file again and replace the modules.
+
+        The new modules are built and validated before they replace the current modules in one step, so scrapes
+        never see a partially loaded config. Cached configs are only removed for the modules which changed, and
+        connection pools are not touched. If the config file is invalid the current modules are kept.
+
+        Returns:
+        --------
+            bool: True if the config file was reloaded, False if an error was encountered.
+        """
+        with cls.reload_lock:
+            if cls.config_file is None:
+                logger.warning("Not reloading, dns_exporter was started without a config file")
+                dnsexp_config_reloads_total.labels(result="failure").inc()
                 return False
+            logger.info(f"Reloading config file {cls.config_file}")
             try:
-                cls.modules[name] = Config.create(name=name, **prepared)
-            except TypeError:
-                logger.exception(f"Unable to parse config {prepared}")
+                modules = cls.load_config_file(cls.config_file)
+            except (OSError, ValueError):
+                logger.exception("Unable to read config file, keeping the current modules")
+                dnsexp_config_reloads_total.labels(result="failure").inc()
                 return False
-            except ConfigError:
-                logger.exception(
-                    f"Invalid value found while building config {prepared}",
-                )
+            if modules is None:
+                logger.error("Invalid module in config file, keeping the current modules")
+                dnsexp_config_reloads_total.labels(result="failure").inc()
                 return False
 
+            # find the added, removed and changed modules
+            changed = cls.changed_modules(old=cls.modules if cls.modules is not None else {}, new=modules)
+
+            # swap in the new modules, scrapes which are already running keep the config they built
+            cls.modules = modules
+            removed = cls.config_cache.discard(
+                lambda key: isinstance(key, tuple) and dict(key[1]).get("module") in changed,
+            )
+
+        dnsexp_config_reloads_total.labels(result="success").inc()
+        dnsexp_config_last_reload_success_timestamp_seconds.set_to_current_time()
         logger.info(
-            f"{len(modules)} module(s) loaded OK, total modules: {len(cls.modules)}.",
+            f"Config file reloaded OK, {len(modules.sources)} module(s) loaded, {len(changed)} module(s) added, "
+            f"removed or changed, {removed} cached config(s) removed.",
         )
         return True
 
+    def reload_response(self) -> tuple[int, bytes]:
+        """Reload the config file for a request to /-/reload and return the HTTP status and body."""
+        if not self.reload_endpoint:
+            logger.debug("The reload endpoint is not enabled, returning 404")
+            return 404, b"404 not found"
+        if self.saturated:
+            # this handler runs in the thread accepting connections, do not block it while reloading
+            logger.warning("Not reloading, all workers are busy and the queue is full")
+            return 503, b"exporter saturated, try again later"
+        if self.reload():
+            return 200, b"config reloaded"
+        return 500, b"config reload failed, see the log for details"
+
+    def profile_response(self) -> tuple[int, bytes]:
+        """Profile all threads for a request to /debug/profile and return the HTTP status and body.
+
+        The number of seconds to profile for is taken from the ``seconds`` querystring parameter.
+        """
+        if not self.profile_endpoint:
+            logger.debug("The profile endpoint is not enabled, returning 404")
+            return 404, b"404 not found"
+        if self.saturated:
+            # this handler runs in the thread accepting connections, do not block it while profiling
+            logger.warning("Not profiling, all workers are busy and the queue is full")
+            return 503, b"exporter saturated, try again later"
+        try:
+            seconds = float(self.qs.get("seconds", PROFILE_DEFAULT_SECONDS))
+        except ValueError:
+            return 400, b"seconds must be a number"
+        if not 0 < seconds <= PROFILE_MAX_SECONDS:
+            return 400, f"seconds must be between 0 and {PROFILE_MAX_SECONDS}".encode()
+        output = profile(seconds=seconds)
+        if output is None:
+            return 409, b"a profile is already running"
+        return 200, output
+
     @staticmethod
     def parse_server(server: str, protocol: str) -> urllib.parse.SplitResult:
         """Parse the server, add scheme (to make urllib.parse play ball), make port explicit.
@@ -474,7 +813,7 @@ class DNSExporter(MetricsHandler):
         splitresult = urllib.parse.urlsplit(server)
         # make sure scheme is the dns_exporter internal protocol identifier (not https://)
         splitresult = splitresult._replace(scheme=protocol)
-        if protocol == "doh" and not splitresult.path:
+        if protocol in ["doh", "doh3"] and not splitresult.path:
             # use the default DoH path
             splitresult = splitresult._replace(path="/dns-query")
         # is there an explicit port in the configured server url? use default if not.
@@ -486,7 +825,7 @@ class DNSExporter(MetricsHandler):
                 # DoT and DoQ
                 port = 853
             else:
-                # DoH
+                # DoH and DoH3
                 port = 443
             logger.debug(
                 f"No explicit port in configured server, using default for protocol {protocol}: {port}",
@@ -523,17 +862,21 @@ class DNSExporter(MetricsHandler):
                 pass
             method = "from config"
         else:
+            hostname = str(self.config.server.hostname)
             try:
                 # server host might be an ip, attempt to parse it as such
-                self.config.ip = ipaddress.ip_address(str(self.config.server.hostname))
+                ip = ipaddress.ip_address(hostname)
             except ValueError:
                 # there is no ip in the config, need to get ip by resolving server in dns
-                resolved = self.resolve_ip_getaddrinfo(
-                    hostname=str(self.config.server.hostname),
-                    family=str(self.config.family),
-                )
-                self.config.ip = ipaddress.ip_address(resolved)
-            method = f"resolved from {self.config.server.hostname}"
+                with self.timer.measure("resolve"):
+                    resolved = self.resolve_ip_getaddrinfo(
+                        hostname=hostname,
+                        family=str(self.config.family),
+                    )
+                ip = ipaddress.ip_address(resolved)
+            # the config might be shared with other scrapes, so set the ip in a copy
+            self.config = self.config.evolve(ip=ip)
+            method = f"resolved from {hostname}"
 
         logger.debug(
             f"Using server IP {self.config.ip} ({method}) for the DNS server connection",
@@ -547,21 +890,19 @@ class DNSExporter(MetricsHandler):
         return False
 
     def resolve_ip_getaddrinfo(self, hostname: str, family: str) -> str:
-        """Resolve the IP of a DNS server hostname."""
+        """Resolve the IP of a DNS server hostname, the addresses are cached in the resolve cache."""
         logger.debug(
             f"resolve_ip_getaddrinfo() called with hostname {hostname} and family {family}",
         )
         try:
-            if family == "ipv4":
-                logger.debug(f"doing getaddrinfo for hostname {hostname} for ipv4")
-                result = socket.getaddrinfo(hostname, 0, family=socket.AF_INET)
-                return str(random.choice(result)[4][0])  # noqa: S311
-            logger.debug(f"doing getaddrinfo for hostname {hostname} for ipv6")
-            result = socket.getaddrinfo(hostname, 0, family=socket.AF_INET6)
-            return str(random.choice(result)[4][0])  # noqa: S311
+            addresses = resolve_cache.resolve(
+                hostname=hostname,
+                family=socket.AF_INET if family == "ipv4" else socket.AF_INET6,
+            )
         except socket.gaierror as e:
             logger.exception("Unable to resolve server")
             raise ConfigError("invalid_request_server") from e
+        return random.choice(addresses)  # noqa: S311
 
     def parse_querystring(self) -> tuple[urllib.parse.SplitResult, dict[str, str]]:
         """Parse the incoming url and then the querystring."""
@@ -591,9 +932,16 @@ class DNSExporter(MetricsHandler):
             # default all labels to the string "none"
             self.labels[key] = "none"
 
+        # the exporter is too busy to do this scrape, fail fast instead of waiting for a worker
+        if self.saturated:
+            self.handle_failure(self.fail_registry, "exporter_saturated", labels=self.labels)
+            self.send_metric_response(registry=self.fail_registry, query=self.qs)
+            return
+
         # build and validate configuration for this scrape from defaults, config file and request querystring
         try:
-            self.build_final_config(qs=self.qs)
+            with dnsexp_query_request_stage_seconds.labels(stage="config").time():
+                self.build_final_config(qs=self.qs)
         except ConfigError as E:
             self.handle_failure(self.fail_registry, str(E), labels=self.labels)
             # something is wrong with the config, send error response and bail out
@@ -608,7 +956,29 @@ class DNSExporter(MetricsHandler):
             self.wfile.write(self.config.json().encode("utf-8"))
             return
 
-        # config is ready for action, begin the labels dict
+        # config is ready for action, update the labels dict and build the query
+        self.update_labels()
+        q, wire = self.build_query()
+
+        # register the DNSCollector in dnsexp_registry
+        dns_collector = DNSCollector(config=self.config, query=q, labels=self.labels, wire=wire, timer=self.timer)
+        dnsexp_registry.register(dns_collector)
+        # send the response (which triggers the collect)
+        logger.debug("Returning DNS query metrics")
+        start = time.perf_counter()
+        self.send_metric_response(registry=dnsexp_registry, query=self.qs)
+        # the DNS query is done while the response is rendered
+        dns = self.timer.total()
+        self.observe_query_stages(dns=dns, render=time.perf_counter() - start - dns)
+
+    @staticmethod
+    def observe_query_stages(dns: float, render: float) -> None:
+        """Observe the wall time spent in the DNS query and in rendering the response of a /query request."""
+        dnsexp_query_request_stage_seconds.labels(stage="dns").observe(dns)
+        dnsexp_query_request_stage_seconds.labels(stage="render").observe(render)
+
+    def update_labels(self) -> None:
+        """Update the labels dict with values from the final config."""
         self.labels.update(
             {
                 "server": str(self.config.server.geturl()),  # type: ignore[union-attr]
@@ -622,59 +992,25 @@ class DNSExporter(MetricsHandler):
             }
         )
 
-        # prepare query
-        qname = dns.name.from_text(str(self.config.query_name))
-        q = dns.message.make_query(
-            qname=qname,
-            rdtype=str(self.config.query_type),
-            rdclass=self.config.query_class,
-        )
+    def build_query(self) -> tuple[dns.message.QueryMessage, bytes]:
+        """Return the DNS query message and its wire format for the final config.
 
-        # use EDNS?
-        if self.config.edns:
-            # use edns
-            ednsargs: dict[
-                str,
-                str | int | bool | list[dns.edns.GenericOption],
-            ] = {"options": []}
-            # use the DO bit?
-            if self.config.edns_do:
-                ednsargs["ednsflags"] = dns.flags.DO
-            # use nsid?
-            if self.config.edns_nsid:
-                ednsargs["options"].append(  # type: ignore[union-attr]
-                    dns.edns.GenericOption(dns.edns.NSID, ""),
-                )
-            # set bufsize/payload?
-            if self.config.edns_bufsize:
-                # dnspython calls bufsize "payload"
-                ednsargs["payload"] = int(self.config.edns_bufsize)
-            # set edns padding?
-            if self.config.edns_pad:
-                ednsargs["options"].append(  # type: ignore[union-attr]
-                    dns.edns.GenericOption(
-                        dns.edns.PADDING,
-                        bytes(int(self.config.edns_pad)),
-                    ),
-                )
-            # enable edns with the chosen options
-            q.use_edns(edns=0, **ednsargs)  # type: ignore[arg-type]
-            logger.debug(f"using edns options {ednsargs}")
-        else:
-            # do not use edns
-            q.use_edns(edns=False)
-            logger.debug("not using edns")
-
-        # set RD flag?
-        if self.config.recursion_desired:
-            q.flags |= dns.flags.RD
-
-        # register the DNSCollector in dnsexp_registry
-        dns_collector = DNSCollector(config=self.config, query=q, labels=self.labels)
-        dnsexp_registry.register(dns_collector)
-        # send the response (which triggers the collect)
-        logger.debug("Returning DNS query metrics")
-        self.send_metric_response(registry=dnsexp_registry, query=self.qs)
+        The query is rendered from a cached QueryTemplate, only the message ID is new for each scrape.
+        """
+        template = get_query_template(
+            query_name=str(self.config.query_name),
+            query_type=str(self.config.query_type),
+            query_class=str(self.config.query_class),
+            recursion_desired=bool(self.config.recursion_desired),
+            edns=bool(self.config.edns),
+            edns_do=bool(self.config.edns_do),
+            edns_nsid=bool(self.config.edns_nsid),
+            edns_bufsize=int(self.config.edns_bufsize or 0),
+            edns_pad=int(self.config.edns_pad or 0),
+            # ask for the edns-tcp-keepalive idle timeout when keeping tcp connections open
+            edns_keepalive=self.config.protocol == "tcp" and bool(self.config.reuse_connections),
+        )
+        return template.render()
 
     def do_GET(self) -> None:  # noqa: N802
         """Handle incoming HTTP GET requests."""
@@ -688,12 +1024,31 @@ class DNSExporter(MetricsHandler):
 
         # /query is for doing a DNS query, it returns metrics about just that one dns query
         if self.url.path in ["/query", "/config"]:
-            self.handle_query_request()
+            # the worker thread only handles this request, so its CPU time is the CPU time of the request
+            cpu = time.thread_time()
+            with dnsexp_query_requests_in_flight.track_inprogress():
+                self.handle_query_request()
+            dnsexp_query_request_cpu_seconds.observe(time.thread_time() - cpu)
 
         # this endpoint exposes metrics about the exporter itself and the python process
         elif self.url.path == "/metrics":
             logger.debug("Returning exporter metrics for request to /metrics")
-            self.send_metric_response(registry=self.registry, query=self.qs)
+            self.send_baked_response(
+                *self.bake_exporter_metrics(
+                    accept_header=self.headers.get("Accept"),
+                    accept_encoding_header=self.headers.get("Accept-Encoding"),
+                ),
+            )
+
+        # the sampling profiler, only when enabled
+        elif self.url.path == "/debug/profile":
+            status, msg = self.profile_response()
+            self.send_response(status)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(msg)))
+            self.end_headers()
+            self.wfile.write(msg)
+            dnsexp_http_responses_total.labels(path=self.url.path, response_code=status).inc()
 
         # the root just returns a bit of informational html
         elif self.url.path == "/":
@@ -718,25 +1073,97 @@ class DNSExporter(MetricsHandler):
                 response_code=404,
             ).inc()
 
+    def do_POST(self) -> None:  # noqa: N802
+        """Handle incoming HTTP POST requests, only used for /-/reload."""
+        self.url, self.qs = self.parse_querystring()
+        logger.debug(f"Got HTTP POST request for {self.url.geturl()}")
+        # discard the request body, if any
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        dnsexp_http_requests_total.labels(path=self.url.path).inc()
+        if self.url.path != "/-/reload":
+            # the other endpoints only support GET
+            self.send_error(501, "Unsupported method (POST)")
+            dnsexp_http_responses_total.labels(path=self.url.path, response_code=501).inc()
+            return
+        status, msg = self.reload_response()
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(msg)))
+        self.end_headers()
+        self.wfile.write(msg)
+        dnsexp_http_responses_total.labels(path=self.url.path, response_code=status).inc()
+
     def send_metric_response(
         self,
-        registry: CollectorRegistry | RestrictedRegistry,
+        registry: CollectorRegistry,
         query: dict[str, str],
     ) -> None:
         """Bake and send output from the provided registry and querystring."""
-        # Bake output
-        status, headers, output = exposition._bake_output(  # type: ignore[no-untyped-call]  # noqa: SLF001
-            registry=registry,
-            accept_header=self.headers.get("Accept"),
-            accept_encoding_header=self.headers.get("Accept-Encoding"),
-            params=query,
-            disable_compression=False,
+        self.send_baked_response(
+            *self.bake_metric_response(
+                registry=registry,
+                query=query,
+                accept_header=self.headers.get("Accept"),
+                accept_encoding_header=self.headers.get("Accept-Encoding"),
+            ),
         )
-        headers.append(("Content-Length", str(len(output))))
-        # Return output
-        self.send_response(int(status.split(" ")[0]))
+
+    def send_baked_response(self, status: int, headers: list[tuple[str, str]], output: bytes) -> None:
+        """Send the status, headers and output from bake_metric_response() or bake_exporter_metrics()."""
+        self.send_response(status)
         for header in headers:
             self.send_header(*header)
         self.end_headers()
         self.wfile.write(output)
-        dnsexp_http_responses_total.labels(path=self.url.path, response_code=200).inc()
+        dnsexp_http_responses_total.labels(path=self.url.path, response_code=status).inc()
+
+    @staticmethod
+    def bake_metric_response(
+        registry: CollectorRegistry,
+        query: dict[str, str],
+        accept_header: str | None,
+        accept_encoding_header: str | None,
+    ) -> tuple[int, list[tuple[str, str]], bytes]:
+        """Bake output from the provided registry and querystring, return a tuple of (status, headers, output).
+
+        The default text format is rendered with the fast generate_text() serializer, other formats like OpenMetrics
+        are rendered by prometheus_client.
+        """
+        encoder, content_type = exposition.choose_encoder(accept_header or "")
+        collector: Collector = registry
+        if "name[]" in query:
+            collector = registry.restricted_registry([query["name[]"]])
+        output = generate_text(collector) if encoder is exposition.generate_latest else encoder(collector)
+        headers = [("Content-Type", content_type)]
+        if exposition.gzip_accepted(accept_encoding_header or ""):
+            output = gzip.compress(output)
+            headers.append(("Content-Encoding", "gzip"))
+        headers.append(("Content-Length", str(len(output))))
+        return 200, headers, output
+
+    def bake_exporter_metrics(
+        self,
+        accept_header: str | None,
+        accept_encoding_header: str | None,
+    ) -> tuple[int, list[tuple[str, str]], bytes]:
+        """Bake the output for /metrics from the registry of the exporter, return a tuple of (status, headers, output).
+
+        The output is taken from the metrics cache when possible. Requests which only ask for some metrics with
+        name[] are not cached.
+        """
+        if "name[]" in self.qs:
+            return self.bake_metric_response(
+                registry=self.registry,  # type: ignore[arg-type]
+                query=self.qs,
+                accept_header=accept_header,
+                accept_encoding_header=accept_encoding_header,
+            )
+        encoder, content_type = exposition.choose_encoder(accept_header or "")
+        rendered = metrics_cache.get(key=content_type, render=lambda: encoder(self.registry))
+        headers = [("Content-Type", content_type)]
+        if exposition.gzip_accepted(accept_encoding_header or ""):
+            output = rendered.gzipped()
+            headers.append(("Content-Encoding", "gzip"))
+        else:
+            output = rendered.plain
+        headers.append(("Content-Length", str(len(output))))
+        return 200, headers, output
@@ -5,16 +5,33 @@ and the built-in Python metrics).
 """
 from __future__ import annotations
 
+import gc
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
 from prometheus_client.core import (
     Counter,
+    Gauge,
     GaugeMetricFamily,
     Histogram,
     Info,
 )
+from prometheus_client.registry import REGISTRY, Collector, CollectorRegistry
 from prometheus_client.utils import INF
 
+from dns_exporter.defaults import DEFAULT_RESPONSETIME_MAX_SERIES
 from dns_exporter.version import __version__
 
+if TYPE_CHECKING:  # pragma: no cover
+    from collections.abc import Iterable, Mapping, Sequence
+
+    from prometheus_client.metrics_core import Metric
+
+logger = logging.getLogger(f"dns_exporter.{__name__}")
+
 ########################################################
 # scrape-specific metrics used by the DNSCollector (served under /query)
 
@@ -38,11 +55,16 @@ QTIME_LABELS = [
     "nsid",
 ]
 
-# additional labels used in the per-RR TTL metrics
-TTL_LABELS = [
+# additional labels used in the aggregated TTL metrics
+RRSET_LABELS = [
     "rr_section",  # answer, authority or additional
     "rr_name",
     "rr_type",
+]
+
+# additional labels used in the per-RR TTL metrics
+TTL_LABELS = [
+    *RRSET_LABELS,
     "rr_value",
 ]
 
@@ -68,6 +90,7 @@ FAILURE_REASONS = [
     "invalid_response_answer_rrs",
     "invalid_response_authority_rrs",
     "invalid_response_additional_rrs",
+    "exporter_saturated",
     "other_failure",
 ]
 """FAILURE_REASONS is a list of the possible failure modes which might show up in the dnsexp_failure_reason metric."""
@@ -163,6 +186,96 @@ def get_dns_ttl_metric() -> GaugeMetricFamily:
     )
 
 
+def get_dns_connection_reused_metric(value: int) -> GaugeMetricFamily:
+    """``dnsexp_dns_connection_reused`` is a Gauge set to 1 when the DNS query used an existing pooled connection.
+
+    It is set to 0 when a new connection had to be opened for the query. This metric is only included for scrapes
+    which use the connection pools, so for protocol ``doh3`` and for modules with ``reuse_connections`` or
+    ``doh_http2`` enabled.
+    """
+    return GaugeMetricFamily(
+        name="dnsexp_dns_connection_reused",
+        documentation="Did this DNS query use an existing pooled connection, 1 for reused or 0 for a new connection.",
+        value=value,
+    )
+
+
+def get_dns_ttl_truncated_metric(value: int) -> GaugeMetricFamily:
+    """``dnsexp_dns_response_rr_ttl_truncated`` is a Gauge set to 1 when some RRs have no TTL metric.
+
+    It is set to 0 when all the RRs in the response are included in ``dnsexp_dns_response_rr_ttl_seconds``. This
+    metric is only included for scrapes with ``collect_ttl_max_rrs`` set.
+    """
+    return GaugeMetricFamily(
+        name="dnsexp_dns_response_rr_ttl_truncated",
+        documentation="Were some response RRs left out of the TTL metric because of collect_ttl_max_rrs, 1 for truncated or 0 for complete.",  # noqa: E501
+        value=value,
+    )
+
+
+def get_dns_ttl_min_metric() -> GaugeMetricFamily:
+    """``dnsexp_dns_response_rr_ttl_min_seconds`` is a Gauge with the lowest TTL of the RRs with the same labels.
+
+    This metric is used instead of ``dnsexp_dns_response_rr_ttl_seconds`` when ``collect_ttl_aggregate`` is enabled.
+    It has the same labels as ``dnsexp_dns_response_rr_ttl_seconds`` except ``rr_value``, so there is one sample
+    per section, RR name and RR type.
+    """
+    return GaugeMetricFamily(
+        name="dnsexp_dns_response_rr_ttl_min_seconds",
+        documentation="Lowest TTL in seconds of the response RRs in each section with the same name and type.",
+        labels=[
+            *QTIME_LABELS,
+            *RRSET_LABELS,
+        ],
+    )
+
+
+def get_dns_ttl_max_metric() -> GaugeMetricFamily:
+    """``dnsexp_dns_response_rr_ttl_max_seconds`` is a Gauge with the highest TTL of the RRs with the same labels.
+
+    It has the same labels as ``dns_exporter.metrics.get_dns_ttl_min_metric`` and is only used when
+    ``collect_ttl_aggregate`` is enabled.
+    """
+    return GaugeMetricFamily(
+        name="dnsexp_dns_response_rr_ttl_max_seconds",
+        documentation="Highest TTL in seconds of the response RRs in each section with the same name and type.",
+        labels=[
+            *QTIME_LABELS,
+            *RRSET_LABELS,
+        ],
+    )
+
+
+def get_dns_rr_count_metric() -> GaugeMetricFamily:
+    """``dnsexp_dns_response_rrs`` is a Gauge with the number of response RRs with the same labels.
+
+    It has the same labels as ``dns_exporter.metrics.get_dns_ttl_min_metric`` and is only used when
+    ``collect_ttl_aggregate`` is enabled.
+    """
+    return GaugeMetricFamily(
+        name="dnsexp_dns_response_rrs",
+        documentation="Number of response RRs in each section with the same name and type.",
+        labels=[
+            *QTIME_LABELS,
+            *RRSET_LABELS,
+        ],
+    )
+
+
+def get_dns_phase_metric() -> GaugeMetricFamily:
+    """``dnsexp_dns_query_phase_seconds`` is a Gauge with the time spent in each phase of the scrape.
+
+    The ``phase`` label is one of ``resolve``, ``connect``, ``handshake``, ``query``, ``parse`` or ``validate``, see
+    ``dns_exporter.phases`` for what each phase covers. Only the phases the scrape went through are included, so a
+    scrape to an IP over UDP has no ``resolve``, ``connect`` or ``handshake`` samples.
+    """
+    return GaugeMetricFamily(
+        name="dnsexp_dns_query_phase_seconds",
+        documentation="Time spent in each phase of the DNS query in seconds.",
+        labels=["phase"],
+    )
+
+
 ########################################################
 # exporter internal/persitent metrics (served under /metrics)
 
@@ -214,7 +327,101 @@ dnsexp_dns_queries_total = Counter(
 This metric has no labels.
 """
 
-dnsexp_dns_responsetime_seconds = Histogram(
+dnsexp_dns_responsetime_series_evicted_total = Counter(
+    name="dnsexp_dns_responsetime_series_evicted_total",
+    documentation="The total number of label sets removed from dnsexp_dns_responsetime_seconds because the series limit was reached.",  # noqa: E501
+)
+"""``dnsexp_dns_responsetime_series_evicted_total`` is a Counter of the series removed from the response time histogram.
+
+When ``dnsexp_dns_responsetime_seconds`` has ``--responsetime-max-series`` label sets and a response with a new label
+set is observed, the label set which was observed least recently is removed and this counter is increased. A steadily
+increasing value means the limit is too low for the number of servers and queries, or that too many labels are kept
+(see ``--responsetime-labels``). This metric has no labels.
+"""
+
+
+class BoundedHistogram(Collector):
+    """A Histogram with a limit on the number of label sets, and a configurable subset of the labels.
+
+    Observations are passed the full labels dict and only the configured labels are kept. When a new label set
+    would go over ``max_series`` the least recently observed label set is removed from the histogram.
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str],
+        buckets: Sequence[float],
+        max_series: int,
+        evictions: Counter,
+        registry: CollectorRegistry | None = REGISTRY,
+    ) -> None:
+        """Save settings, create the histogram and register in the registry unless it is None."""
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.evictions = evictions
+        self._lock = threading.Lock()
+        self.labelnames: tuple[str, ...] = ()
+        self.max_series = max_series
+        self.histogram = self.create_histogram(labelnames=labelnames)
+        self._series: OrderedDict[tuple[str, ...], None] = OrderedDict()
+        if registry is not None:
+            registry.register(self)
+
+    def create_histogram(self, labelnames: Sequence[str]) -> Histogram:
+        """Return a new unregistered Histogram with the labels and save the label names."""
+        self.labelnames = tuple(labelnames)
+        return Histogram(
+            name=self.name,
+            documentation=self.documentation,
+            labelnames=self.labelnames,
+            buckets=self.buckets,
+            registry=None,
+        )
+
+    def configure(self, labelnames: Sequence[str], max_series: int) -> None:
+        """Set the labels to keep and the maximum number of label sets, 0 means no limit.
+
+        Changing the labels removes all series, lowering the limit removes the least recently observed series.
+        """
+        with self._lock:
+            if tuple(labelnames) != self.labelnames:
+                self.histogram = self.create_histogram(labelnames=labelnames)
+                self._series.clear()
+            self.max_series = max_series
+            self.evict()
+
+    def evict(self) -> None:
+        """Remove the least recently observed series until the limit is respected, the caller must hold the lock."""
+        while self.max_series > 0 and len(self._series) > self.max_series:
+            evicted, _ = self._series.popitem(last=False)
+            self.histogram.remove(*evicted)
+            self.evictions.inc()
+            logger.debug(f"Removed label set {evicted} from {self.name}, the series limit was reached")
+
+    def observe(self, labels: Mapping[str, str], value: float) -> None:
+        """Observe the value for the configured labels, removing the least recently observed series if needed."""
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            if key in self._series:
+                self._series.move_to_end(key)
+            else:
+                self._series[key] = None
+                self.evict()
+            self.histogram.labels(*key).observe(value)
+
+    def describe(self) -> Iterable[Metric]:
+        """Return the description of the histogram."""
+        return self.histogram.describe()
+
+    def collect(self) -> Iterable[Metric]:
+        """Return the current series of the histogram."""
+        return self.histogram.collect()
+
+
+dnsexp_dns_responsetime_seconds = BoundedHistogram(
     name="dnsexp_dns_responsetime_seconds",
     documentation="DNS query response timing histogram. This histogram is updated every time the dns_exporter receives a query response.",  # noqa: E501
     labelnames=QTIME_LABELS,
@@ -235,11 +442,13 @@ dnsexp_dns_responsetime_seconds = Histogram(
         10.0,
         INF,
     ),
+    max_series=DEFAULT_RESPONSETIME_MAX_SERIES,
+    evictions=dnsexp_dns_responsetime_series_evicted_total,
 )
 """``dnsexp_dns_responsetime_seconds`` is the Histogram keeping track of how many DNS responses this exporter
 received since start and how long the query took.
 
-    Each DNS query duration is observed in this histogram with the following labels to identify it:
+    By default each DNS query duration is observed in this histogram with the following labels to identify it:
 
         - ``server``
         - ``ip``
@@ -258,6 +467,11 @@ received since start and how long the query took.
         - ``nsid``
 
     In some cases the ``nsid`` label has no value and the placeholder ``no_nsid`` is used instead.
+
+    Labels like ``nsid`` and ``answer`` can have many values, so the labels kept can be limited with
+    ``--responsetime-labels``. The number of label sets is limited by ``--responsetime-max-series``, when the limit
+    is reached the least recently observed label set is removed and
+    ``dnsexp_dns_responsetime_series_evicted_total`` is increased.
 """
 
 dnsexp_scrape_failures_total = Counter(
@@ -289,3 +503,282 @@ plus the ``reason`` label which has the failure reason.
 
 The placeholder ``none`` is used for cases where there is no suitable value for the label.
 """
+
+dnsexp_connection_pool_connections = Gauge(
+    name="dnsexp_connection_pool_connections",
+    documentation="The number of connections currently kept open in each connection pool for reuse between scrapes.",
+    labelnames=["pool"],
+)
+"""``dnsexp_connection_pool_connections`` is a Gauge with the number of connections kept in each connection pool.
+
+Connections are only pooled for modules with ``reuse_connections`` enabled.
+
+This metric has a single label, ``pool``, which is set to the name of the pool, like ``doh``.
+"""
+
+dnsexp_resolve_cache_lookups_total = Counter(
+    name="dnsexp_resolve_cache_lookups_total",
+    documentation="The total number of DNS server hostname lookups in the resolve cache by result (hit, miss or expired).",  # noqa: E501
+    labelnames=["result"],
+)
+"""``dnsexp_resolve_cache_lookups_total`` is a Counter of lookups in the cache of resolved DNS server hostnames.
+
+This metric has a single label, ``result``, which is one of:
+    - ``hit`` when the addresses (or a failed lookup) were found in the cache.
+    - ``miss`` when the hostname was not in the cache and had to be resolved.
+    - ``expired`` when the cached addresses were too old and the hostname had to be resolved again.
+"""
+
+dnsexp_resolve_cache_entries = Gauge(
+    name="dnsexp_resolve_cache_entries",
+    documentation="The number of DNS server hostnames currently in the resolve cache.",
+)
+"""``dnsexp_resolve_cache_entries`` is a Gauge with the number of hostnames in the resolve cache.
+
+This metric has no labels.
+"""
+
+dnsexp_doh_streams_per_connection = Histogram(
+    name="dnsexp_doh_streams_per_connection",
+    documentation="The number of concurrent DoH requests per open connection, observed every time a pooled DoH client sends a request.",  # noqa: E501
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, INF),
+)
+"""``dnsexp_doh_streams_per_connection`` is a Histogram of the number of concurrent requests per open connection.
+
+It is observed every time a pooled DoH client (``reuse_connections`` or ``doh_http2`` enabled) sends a request. With
+``doh_http2`` enabled concurrent scrapes to the same server are multiplexed as streams over a single connection, so
+values above 1 mean connections are being shared.
+
+This metric has no labels.
+"""
+
+dnsexp_tls_handshakes_total = Counter(
+    name="dnsexp_tls_handshakes_total",
+    documentation="The total number of TLS connections used for DNS queries by protocol and handshake type (full, resumed or none for reused connections).",  # noqa: E501
+    labelnames=["protocol", "handshake"],
+)
+"""``dnsexp_tls_handshakes_total`` is a Counter keeping track of the TLS handshakes done for DNS queries.
+
+This metric has two labels:
+    - ``protocol`` is set to the protocol of the DNS query, currently always ``dot``.
+    - ``handshake`` is set to ``full`` for a full TLS handshake, ``resumed`` when a TLS session was resumed
+      (see ``tls_session_resumption``), or ``none`` when the query used an existing pooled connection.
+"""
+
+dnsexp_scrapes_in_flight = Gauge(
+    name="dnsexp_scrapes_in_flight",
+    documentation="The number of HTTP requests currently being handled by the exporter.",
+)
+"""``dnsexp_scrapes_in_flight`` is a Gauge with the number of HTTP requests currently being handled.
+
+This can not go above the ``--workers`` setting. This metric has no labels.
+"""
+
+dnsexp_scrapes_queued = Gauge(
+    name="dnsexp_scrapes_queued",
+    documentation="The number of HTTP requests waiting for a free worker.",
+)
+"""``dnsexp_scrapes_queued`` is a Gauge with the number of HTTP requests waiting for a free worker.
+
+This can not go above the ``--queue-size`` setting. This metric has no labels.
+"""
+
+dnsexp_scrapes_rejected_total = Counter(
+    name="dnsexp_scrapes_rejected_total",
+    documentation="The total number of HTTP requests rejected because all workers were busy and the queue was full.",
+)
+"""``dnsexp_scrapes_rejected_total`` is a Counter of the HTTP requests rejected because the exporter was saturated.
+
+Rejected scrapes get a fast response with failure reason ``exporter_saturated`` instead of doing the DNS query.
+Requests for ``/metrics`` are still answered when the exporter is saturated. This metric has no labels.
+"""
+
+dnsexp_config_reloads_total = Counter(
+    name="dnsexp_config_reloads_total",
+    documentation="The total number of config file reloads.",
+    labelnames=["result"],
+)
+"""``dnsexp_config_reloads_total`` is a Counter of the config file reloads.
+
+Reloads are triggered by ``SIGHUP`` or a ``POST`` to ``/-/reload``. The ``result`` label is ``success`` or
+``failure``, after a failed reload the exporter keeps using the modules it had before.
+"""
+
+dnsexp_config_last_reload_success_timestamp_seconds = Gauge(
+    name="dnsexp_config_last_reload_success_timestamp_seconds",
+    documentation="The time of the last successful config file load or reload.",
+)
+"""``dnsexp_config_last_reload_success_timestamp_seconds`` is a Gauge with the time of the last successful load.
+
+The value is a unix timestamp. It is set when the exporter starts and after each successful reload. This metric has
+no labels.
+"""
+
+dnsexp_config_load_seconds = Gauge(
+    name="dnsexp_config_load_seconds",
+    documentation="The time spent in each phase of the last config file load or reload.",
+    labelnames=["phase"],
+)
+"""``dnsexp_config_load_seconds`` is a Gauge with the time spent in each phase of the last config file load.
+
+The ``phase`` label is one of ``read``, ``cache_load``, ``parse``, ``compile``, ``cache_save`` or ``total``. Phases
+which were skipped, like ``parse`` and ``compile`` when the modules were loaded from the module cache, are 0.
+"""
+
+dnsexp_dns_phase_duration_seconds = Histogram(
+    name="dnsexp_dns_phase_duration_seconds",
+    documentation="The time spent in each phase of the DNS queries, observed for every scrape.",
+    labelnames=["protocol", "phase"],
+    buckets=(
+        0.0001,
+        0.00025,
+        0.0005,
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1.0,
+        2.5,
+        5.0,
+        10.0,
+        INF,
+    ),
+)
+"""``dnsexp_dns_phase_duration_seconds`` is a Histogram of the time spent in each phase of the DNS queries.
+
+It is observed with the same values as ``dnsexp_dns_query_phase_seconds`` for every scrape, labeled with the
+``protocol`` of the scrape and the ``phase``. The buckets start at 100 microseconds since the ``parse`` and
+``validate`` phases are usually much faster than the query itself.
+"""
+
+dnsexp_query_requests_in_flight = Gauge(
+    name="dnsexp_query_requests_in_flight",
+    documentation="The number of /query and /config requests currently being handled by the exporter.",
+)
+"""``dnsexp_query_requests_in_flight`` is a Gauge with the number of ``/query`` and ``/config`` requests being handled.
+
+Unlike ``dnsexp_scrapes_in_flight`` this does not include requests for ``/metrics`` and the other endpoints. This
+metric has no labels.
+"""
+
+dnsexp_query_request_stage_seconds = Histogram(
+    name="dnsexp_query_request_stage_seconds",
+    documentation="The wall time spent in each stage of handling /query requests.",
+    labelnames=["stage"],
+    buckets=(
+        0.0001,
+        0.00025,
+        0.0005,
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1.0,
+        2.5,
+        5.0,
+        10.0,
+        INF,
+    ),
+)
+"""``dnsexp_query_request_stage_seconds`` is a Histogram of the wall time spent in each stage of ``/query`` requests.
+
+The ``stage`` label is one of:
+
+    - ``config``: building and validating the scrape config, including resolving the server hostname
+    - ``dns``: the DNS query, the ``connect``, ``handshake``, ``query`` and ``parse`` phases of
+      ``dnsexp_dns_query_phase_seconds``
+    - ``render``: collecting and rendering the metrics and sending the response, without the DNS query
+
+Requests which fail while building the config only observe the ``config`` stage.
+"""
+
+dnsexp_query_request_cpu_seconds = Histogram(
+    name="dnsexp_query_request_cpu_seconds",
+    documentation="The CPU time used by the thread handling each /query request, only observed by the threading engine.",  # noqa: E501
+    buckets=(
+        0.00005,
+        0.0001,
+        0.00025,
+        0.0005,
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        INF,
+    ),
+)
+"""``dnsexp_query_request_cpu_seconds`` is a Histogram of the CPU time used to handle each ``/query`` request.
+
+The CPU time is measured with ``time.thread_time()`` in the worker thread handling the request, so time spent
+waiting for the DNS server is not included. The asyncio engine handles all requests in the same thread, so this is
+only observed by the threading engine. This metric has no labels.
+"""
+
+dnsexp_threads = Gauge(
+    name="dnsexp_threads",
+    documentation="The number of threads in the exporter process.",
+)
+dnsexp_threads.set_function(threading.active_count)
+"""``dnsexp_threads`` is a Gauge with the number of Python threads in the exporter process.
+
+This includes the worker threads, the reader threads of pooled TCP connections and the threads used by the asyncio
+engine. This metric has no labels.
+"""
+
+dnsexp_gc_pause_seconds = Histogram(
+    name="dnsexp_gc_pause_seconds",
+    documentation="The time spent in each garbage collection, the process is paused while it runs.",
+    labelnames=["generation"],
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, INF),
+)
+"""``dnsexp_gc_pause_seconds`` is a Histogram of the duration of the garbage collections in the exporter process.
+
+All threads are paused while the garbage collector runs. The ``generation`` label is the oldest generation
+collected, ``0``, ``1`` or ``2``. This metric is only observed after ``gc_pause_tracker.install()`` is called, which
+``main()`` does.
+"""
+
+
+class GCPauseTracker:
+    """Garbage collector callback which observes the duration of each collection in ``dnsexp_gc_pause_seconds``."""
+
+    __slots__ = ("children", "start")
+
+    def __init__(self) -> None:
+        """Create the tracker, call install() to start tracking."""
+        self.start = 0.0
+        self.children: dict[int, Histogram] = {}
+
+    def install(self) -> None:
+        """Add the tracker to the garbage collector callbacks, if it is not there already."""
+        # look up the children once, the callback should do as little as possible
+        self.children = {
+            generation: dnsexp_gc_pause_seconds.labels(generation=str(generation)) for generation in range(3)
+        }
+        if self not in gc.callbacks:
+            gc.callbacks.append(self)
+
+    def __call__(self, phase: str, info: dict[str, int]) -> None:
+        """Save the time when a collection starts and observe the duration when it stops."""
+        # only one collection can run at a time, so a single start time is enough
+        if phase == "start":
+            self.start = time.perf_counter()
+        elif self.start:
+            self.children[info["generation"]].observe(time.perf_counter() - self.start)
+
+
+gc_pause_tracker = GCPauseTracker()
+"""``gc_pause_tracker`` is the GCPauseTracker observing ``dnsexp_gc_pause_seconds``, installed by ``main()``."""
@@ -0,0 +1,86 @@
+"""``dns_exporter.phases`` contains the PhaseTimer class used to measure the time spent in each phase of a scrape.
+
+The phases are:
+
+    - ``resolve``: resolving the server hostname to an IP with ``getaddrinfo()``
+    - ``connect``: opening the TCP connection for queries over new connections the exporter opens itself
+    - ``handshake``: the TLS handshake for DoT queries over new connections the exporter opens itself
+    - ``query``: sending the query and waiting for the response
+    - ``parse``: parsing the response and checking it matches the query
+    - ``validate``: validating the response against the ``validate_*`` settings
+
+Phases are measured with ``time.perf_counter_ns()``. When a phase is measured while another phase is being
+measured, the time is only counted for the inner phase. Connections opened by dnspython, ``httpx`` and the QUIC
+managers can not be measured separately, so for those queries the ``query`` phase includes the ``connect`` and
+``handshake`` time.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import logging
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:  # pragma: no cover
+    from collections.abc import Iterable, Iterator
+
+    from dns.message import Message
+
+logger = logging.getLogger(f"dns_exporter.{__name__}")
+
+# the phases of a scrape in the order they happen
+PHASES = ("resolve", "connect", "handshake", "query", "parse", "validate")
+
+# the phases which are part of the DNS query itself
+DNS_PHASES = ("connect", "handshake", "query", "parse")
+
+
+class PhaseTimer:
+    """Keep track of the time spent in each phase of a scrape, in nanoseconds."""
+
+    __slots__ = ("durations", "nested")
+
+    def __init__(self) -> None:
+        """Start with no phases measured."""
+        self.durations: dict[str, int] = {}
+        # the time spent in inner phases, one item for each phase being measured
+        self.nested: list[int] = []
+
+    def add(self, phase: str, duration: int) -> None:
+        """Add duration nanoseconds to the phase."""
+        self.durations[phase] = self.durations.get(phase, 0) + duration
+        if self.nested:
+            # do not count the time again for the enclosing phase
+            self.nested[-1] += duration
+
+    @contextlib.contextmanager
+    def measure(self, phase: str) -> Iterator[None]:
+        """Measure the time spent in the block, also if it raises, minus the time spent in inner phases."""
+        self.nested.append(0)
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            self.add(phase, elapsed - self.nested.pop())
+
+    def split_response(self, response: Message) -> None:
+        """Move the time spent after the response was received from the ``query`` phase to the ``parse`` phase.
+
+        dnspython sets ``response.time`` to the time between sending the query and receiving the response, before
+        the response is parsed. Responses without a time (like responses from pooled TCP connections) are left as is.
+        """
+        rtt = int(response.time * 1_000_000_000)
+        query = self.durations.get("query", 0)
+        if 0 < rtt < query:
+            self.durations["query"] = rtt
+            self.add("parse", query - rtt)
+
+    def total(self, phases: Iterable[str] = DNS_PHASES) -> float:
+        """Return the seconds spent in the phases, by default the phases of the DNS query itself."""
+        return sum(self.durations.get(phase, 0) for phase in phases) / 1_000_000_000
+
+    def seconds(self) -> dict[str, float]:
+        """Return a dict with the seconds spent in each measured phase, in the order the phases happen."""
+        return {phase: self.durations[phase] / 1_000_000_000 for phase in PHASES if phase in self.durations}
@@ -0,0 +1,77 @@
+"""``dns_exporter.profiler`` contains the sampling profiler used by the ``/debug/profile`` endpoint.
+
+The profiler takes a snapshot of the stack of every thread in the process (except its own) with
+``sys._current_frames()`` at a fixed interval, and counts how many times each stack was seen. The result is returned
+in the collapsed stack format used by flame graph tools like ``flamegraph.pl`` and speedscope, one line per stack
+with the frames from the outermost to the innermost separated by ``;`` followed by a space and the number of samples.
+
+Nothing is installed or hooked while the profiler is not running, so it has no cost for normal scrapes. Only one
+profile can run at a time.
+"""
+
+from __future__ import annotations
+
+import collections
+import logging
+import sys
+import threading
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:  # pragma: no cover
+    from types import FrameType
+
+logger = logging.getLogger(f"dns_exporter.{__name__}")
+
+# the time between samples in seconds
+PROFILE_INTERVAL = 0.01
+
+# the time to profile for when the request does not say, in seconds
+PROFILE_DEFAULT_SECONDS = 10
+
+# the longest profile a request can ask for, in seconds
+PROFILE_MAX_SECONDS = 60
+
+# only one profile at a time
+profile_lock = threading.Lock()
+
+
+def collapse_stack(frame: FrameType | None) -> str:
+    """Return the stack of the frame as ``module.function`` names from the outermost frame, separated by ``;``."""
+    names = []
+    while frame is not None:
+        names.append(f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def sample_stacks(seconds: float, interval: float = PROFILE_INTERVAL) -> collections.Counter[str]:
+    """Sample the stacks of all other threads every interval seconds for seconds, and return the stack counts."""
+    stacks: collections.Counter[str] = collections.Counter()
+    own = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():  # noqa: SLF001
+            if ident != own:
+                stacks[collapse_stack(frame)] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def render_collapsed(stacks: collections.Counter[str]) -> bytes:
+    """Return the stack counts in the collapsed stack format, the most common stacks first."""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common()).encode("utf-8")
+
+
+def profile(seconds: float) -> bytes | None:
+    """Profile all threads for seconds and return the collapsed stacks, or None if a profile is already running."""
+    if not profile_lock.acquire(blocking=False):
+        logger.warning("A profile is already running, not starting another one")
+        return None
+    try:
+        logger.info(f"Profiling all threads for {seconds} seconds")
+        stacks = sample_stacks(seconds=seconds)
+    finally:
+        profile_lock.release()
+    logger.debug(f"Profile done, got {sum(stacks.values())} samples of {len(stacks)} different stacks")
+    return render_collapsed(stacks)
@@ -0,0 +1,108 @@
+"""``dns_exporter.query`` contains the QueryTemplate class used to build DNS queries for scrapes.
+
+Building a ``dns.message`` for a query means parsing the ``query_name``, creating the EDNS options and rendering
+the message to wire format. The result is the same for every scrape with the same query settings except for the
+2 byte message ID, so each unique query is built once and kept in a ``QueryTemplate``. Scrapes get a copy of the
+message and the wire format with a new message ID.
+"""
+
+from __future__ import annotations
+
+import copy
+import logging
+from functools import lru_cache
+
+import dns.edns
+import dns.entropy
+import dns.flags
+import dns.message
+import dns.name
+
+logger = logging.getLogger(f"dns_exporter.{__name__}")
+
+# the maximum number of unique queries kept as templates
+QUERY_TEMPLATE_CACHE_SIZE = 1024
+
+
+class QueryTemplate:
+    """A prebuilt DNS query message and its wire format."""
+
+    __slots__ = ("message", "wire")
+
+    def __init__(self, message: dns.message.QueryMessage) -> None:
+        """Save the message and render it to wire format."""
+        self.message = message
+        self.wire = message.to_wire()
+
+    def render(self) -> tuple[dns.message.QueryMessage, bytes]:
+        """Return a shallow copy of the message with a new random message ID, and the matching wire format.
+
+        The copy shares the sections with the template, so it must not be changed apart from the message ID.
+        """
+        query = copy.copy(self.message)
+        query.id = dns.entropy.random_16()
+        return query, query.id.to_bytes(2, "big") + self.wire[2:]
+
+
+@lru_cache(maxsize=QUERY_TEMPLATE_CACHE_SIZE)
+def get_query_template(  # noqa: PLR0913
+    *,
+    query_name: str,
+    query_type: str,
+    query_class: str,
+    recursion_desired: bool,
+    edns: bool,
+    edns_do: bool,
+    edns_nsid: bool,
+    edns_bufsize: int,
+    edns_pad: int,
+    edns_keepalive: bool,
+) -> QueryTemplate:
+    """Build and return the QueryTemplate for the query settings, cached so each unique query is only built once."""
+    q = dns.message.make_query(
+        qname=dns.name.from_text(query_name),
+        rdtype=query_type,
+        rdclass=query_class,
+    )
+
+    # use EDNS?
+    if edns:
+        # use edns
+        ednsargs: dict[
+            str,
+            str | int | bool | list[dns.edns.GenericOption],
+        ] = {"options": []}
+        # use the DO bit?
+        if edns_do:
+            ednsargs["ednsflags"] = dns.flags.DO
+        # use nsid?
+        if edns_nsid:
+            ednsargs["options"].append(  # type: ignore[union-attr]
+                dns.edns.GenericOption(dns.edns.NSID, ""),
+            )
+        # set bufsize/payload?
+        if edns_bufsize:
+            # dnspython calls bufsize "payload"
+            ednsargs["payload"] = edns_bufsize
+        # set edns padding?
+        if edns_pad:
+            ednsargs["options"].append(  # type: ignore[union-attr]
+                dns.edns.GenericOption(dns.edns.PADDING, bytes(edns_pad)),
+            )
+        # ask for the edns-tcp-keepalive idle timeout
+        if edns_keepalive:
+            ednsargs["options"].append(  # type: ignore[union-attr]
+                dns.edns.GenericOption(dns.edns.KEEPALIVE, b""),
+            )
+        # enable edns with the chosen options
+        q.use_edns(edns=0, **ednsargs)  # type: ignore[arg-type]
+        logger.debug(f"using edns options {ednsargs}")
+    else:
+        # do not use edns
+        q.use_edns(edns=False)
+        logger.debug("not using edns")
+
+    # set RD flag?
+    if recursion_desired:
+        q.flags |= dns.flags.RD
+    return QueryTemplate(message=q)
@@ -0,0 +1,122 @@
+"""``dns_exporter.serializer`` contains a fast serializer for the registries built for each ``/query`` request.
+
+The registries only contain the few gauges and counters from ``DNSCollector``, but ``generate_latest()`` from
+``prometheus_client`` handles every metric type, timestamp and escaping scheme for every sample it renders.
+``generate_text()`` renders the plain samples directly and produces byte-identical output, any other metric is
+rendered by ``generate_latest()``. OpenMetrics and other non-default formats are not handled here.
+
+The escaping functions used to check metric and label names are only in ``prometheus_client`` 0.23.1 and later,
+with older versions ``generate_text()`` renders everything with ``generate_latest()``.
+"""
+
+from __future__ import annotations
+
+import logging
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
+from prometheus_client.exposition import generate_latest
+from prometheus_client.utils import floatToGoString
+
+try:
+    from prometheus_client.openmetrics.exposition import UNDERSCORES, escape_label_name, escape_metric_name
+
+    FAST_TEXT = True
+except ImportError:  # pragma: no cover
+    FAST_TEXT = False
+
+if TYPE_CHECKING:  # pragma: no cover
+    from collections.abc import Iterator
+
+    from prometheus_client.metrics_core import Metric
+    from prometheus_client.registry import Collector
+
+logger = logging.getLogger(f"dns_exporter.{__name__}")
+
+# the maximum number of escaped metric and label names kept
+NAME_CACHE_SIZE = 1024
+
+# the metric types rendered by generate_text(), and the suffix and type used in the text format
+TEXT_TYPES = {"gauge": ("", "gauge"), "counter": ("_total", "counter"), "unknown": ("", "untyped")}
+
+
+@lru_cache(maxsize=NAME_CACHE_SIZE)
+def get_sample_template(name: str, label_names: tuple[str, ...]) -> tuple[tuple[str, ...], str]:
+    """Return the sorted label names and a format string for sample lines with the metric name and label names.
+
+    The format string takes the escaped label values in the sorted order followed by the sample value.
+    """
+    ordered = tuple(sorted(label_names))
+    labels = ",".join(f'{escape_label_name(key, UNDERSCORES)}="{{}}"' for key in ordered)
+    return ordered, f"{name}{{{{{labels}}}}} {{}}\n"
+
+
+@lru_cache(maxsize=NAME_CACHE_SIZE)
+def get_metric_header(name: str, metric_type: str, documentation: str) -> str:
+    """Return the HELP and TYPE lines for a metric, or an empty string if generate_text() can not render it."""
+    if metric_type not in TEXT_TYPES:
+        return ""
+    suffix, text_type = TEXT_TYPES[metric_type]
+    name += suffix
+    if escape_metric_name(name, UNDERSCORES) != name:
+        return ""
+    documentation = documentation.replace("\\", r"\\").replace("\n", r"\n")
+    return f"# HELP {name} {documentation}\n# TYPE {name} {text_type}\n"
+
+
+def escape_label_value(value: str) -> str:
+    """Return the label value with backslash, newline and double quote escaped."""
+    if "\\" in value or "\n" in value or '"' in value:
+        return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+    return value
+
+
+class SingleMetric:
+    """Collector returning a single metric, used to render unsupported metrics with generate_latest()."""
+
+    __slots__ = ("metric",)
+
+    def __init__(self, metric: Metric) -> None:
+        """Save the metric."""
+        self.metric = metric
+
+    def collect(self) -> Iterator[Metric]:
+        """Yield the metric."""
+        yield self.metric
+
+
+def render_metric(metric: Metric, output: list[str]) -> bool:
+    """Append the text format lines for the metric to output, return False if the metric is not supported.
+
+    Histograms, summaries and the other OpenMetrics types, metrics with names which need escaping, and metrics with
+    timestamps or with samples named differently than the metric (like ``_created``) are not supported.
+    """
+    header = get_metric_header(metric.name, metric.type, metric.documentation)
+    if not header:
+        return False
+    name = metric.name + TEXT_TYPES[metric.type][0]
+    for sample in metric.samples:
+        if sample.name != name or sample.timestamp is not None:
+            return False
+    output.append(header)
+    for sample in metric.samples:
+        if sample.labels:
+            # the samples in a metric family usually have the same label names, so the template is reused
+            ordered, template = get_sample_template(name, tuple(sample.labels))
+            values = [escape_label_value(sample.labels[key]) for key in ordered]
+            output.append(template.format(*values, floatToGoString(sample.value)))  # type: ignore[no-untyped-call]
+        else:
+            output.append(f"{name} {floatToGoString(sample.value)}\n")  # type: ignore[no-untyped-call]
+    return True
+
+
+def generate_text(registry: Collector) -> bytes:
+    """Return the metrics from the registry in the Prometheus text format, like generate_latest() does."""
+    if not FAST_TEXT:
+        return generate_latest(registry)
+    output: list[str] = []
+    for metric in registry.collect():
+        if not render_metric(metric, output):
+            logger.debug(f"Rendering metric {metric.name} of type {metric.type} with generate_latest()")
+            output.append(generate_latest(SingleMetric(metric)).decode("utf-8"))
+    return "".join(output).encode("utf-8")
@@ -0,0 +1,566 @@
+"""``dns_exporter.server`` contains the HTTP servers for the threading and asyncio scrape engines.
+
+The default threading engine handles each scrape in a worker thread and blocks
+that thread while waiting for the DNS response. The ``WorkerPoolHTTPServer`` has a
+fixed number of worker threads and a bounded queue of waiting requests, requests
+arriving when the queue is full get a fast ``exporter_saturated`` failure instead.
+
+The asyncio engine in this module
+runs a small HTTP/1.1 server on an event loop and does the DNS lookups with
+``dns.asyncquery`` so many scrapes can wait for DNS responses at the same time
+without a thread each.
+
+The config parsing, labels, query building and metric output is shared with the
+threading engine, so both engines return the same metrics for the same scrape.
+Scrapes using features which only exist for the threading engine (proxies and
+pooled connections) are handed off to the regular ``DNSCollector`` in a worker thread.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import email.utils
+import functools
+import logging
+import queue
+import time
+from http.server import HTTPServer
+from threading import BoundedSemaphore, Thread
+from typing import TYPE_CHECKING
+
+import dns.asyncquery
+import dns.query
+from prometheus_client import CollectorRegistry
+
+from dns_exporter.collector import DNSCollector, doh_exceptions, dot_exceptions, quic_exceptions
+from dns_exporter.connections import get_ssl_context
+from dns_exporter.defaults import DEFAULT_QUEUE_SIZE, DEFAULT_WORKERS
+from dns_exporter.exceptions import ConfigError
+from dns_exporter.exporter import INDEX, DNSExporter
+from dns_exporter.metrics import (
+    QTIME_LABELS,
+    dnsexp_dns_queries_total,
+    dnsexp_http_requests_total,
+    dnsexp_http_responses_total,
+    dnsexp_query_request_stage_seconds,
+    dnsexp_query_requests_in_flight,
+    dnsexp_scrapes_in_flight,
+    dnsexp_scrapes_queued,
+    dnsexp_scrapes_rejected_total,
+    dnsexp_tls_handshakes_total,
+)
+from dns_exporter.version import __version__
+
+if TYPE_CHECKING:  # pragma: no cover
+    import socket
+    import urllib.parse
+    from collections.abc import AsyncIterator, Callable, Iterator
+    from ipaddress import IPv4Address, IPv6Address
+    from socketserver import BaseRequestHandler
+
+    from dns.message import Message, QueryMessage
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+    from dns_exporter.config import Config
+    from dns_exporter.phases import PhaseTimer
+
+logger = logging.getLogger(f"dns_exporter.{__name__}")
+
+# a status, headers and body tuple for a HTTP response
+Response = tuple[int, list[tuple[str, str]], bytes]
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 501: "Not Implemented"}
+
+# the socket timeout for rejected requests, they are handled in the thread accepting connections
+REJECT_TIMEOUT = 1.0
+
+
+class WorkerPoolHTTPServer(HTTPServer):
+    """HTTPServer handling requests in a fixed number of worker threads.
+
+    Accepted connections are put in a queue of at most ``queue_size`` requests. When all
+    workers are busy and the queue is full the request is handled right away in the thread
+    accepting connections, using a handler with ``saturated`` set, so scrapes fail fast with
+    ``exporter_saturated``. With a ``queue_size`` of 0 requests are rejected whenever no
+    worker is free, like the ScrapeLimiter used by the asyncio engine.
+    """
+
+    # the listen backlog, the socketserver default of 5 drops connections during bursts of scrapes
+    request_queue_size = 128
+
+    def __init__(
+        self,
+        server_address: tuple[str, int],
+        RequestHandlerClass: type[DNSExporter],  # noqa: N803
+        workers: int = DEFAULT_WORKERS,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+    ) -> None:
+        """Create the queue and start the worker threads."""
+        super().__init__(server_address, RequestHandlerClass)
+        self.requests: queue.Queue[tuple[socket.socket, tuple[str, int]]] = queue.Queue()
+        # each accepted request holds a slot until it is handled, so at most workers + queue_size are accepted
+        self.slots = BoundedSemaphore(workers + queue_size)
+        # the handler for rejected requests, with a short timeout so slow clients can not block new connections
+        self.rejecting_handler = type(
+            f"Saturated{RequestHandlerClass.__name__}",
+            (RequestHandlerClass,),
+            {"saturated": True, "timeout": REJECT_TIMEOUT},
+        )
+        for i in range(workers):
+            Thread(target=self.worker, name=f"dns_exporter-worker-{i}", daemon=True).start()
+
+    def process_request(self, request: socket.socket, client_address: tuple[str, int]) -> None:  # type: ignore[override]
+        """Queue the request for a worker, or reject it if all workers are busy and the queue is full."""
+        if not self.slots.acquire(blocking=False):
+            logger.warning(f"All workers busy and queue full, rejecting request from {client_address}")
+            dnsexp_scrapes_rejected_total.inc()
+            self.handle_request_with(self.rejecting_handler, request=request, client_address=client_address)
+            return
+        self.requests.put((request, client_address))
+        dnsexp_scrapes_queued.inc()
+
+    def worker(self) -> None:
+        """Handle requests from the queue forever."""
+        while True:
+            request, client_address = self.requests.get()
+            dnsexp_scrapes_queued.dec()
+            try:
+                with dnsexp_scrapes_in_flight.track_inprogress():
+                    self.handle_request_with(self.RequestHandlerClass, request=request, client_address=client_address)
+            finally:
+                self.slots.release()
+
+    def handle_request_with(
+        self, handler: Callable[..., BaseRequestHandler], request: socket.socket, client_address: tuple[str, int]
+    ) -> None:
+        """Handle the request with the handler class and close it, like socketserver.ThreadingMixIn does."""
+        try:
+            handler(request, client_address, self)
+        except Exception:  # noqa: BLE001
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+class ScrapeLimiter:
+    """Admission control for the asyncio engine.
+
+    At most ``workers`` requests are handled at the same time and at most ``queue_size``
+    requests wait for their turn, like the WorkerPoolHTTPServer used by the threading engine.
+    """
+
+    def __init__(self, workers: int = DEFAULT_WORKERS, queue_size: int = DEFAULT_QUEUE_SIZE) -> None:
+        """Create the semaphore, this must be called with a running event loop."""
+        self.semaphore = asyncio.Semaphore(workers)
+        self.queue_size = queue_size
+        self.queued = 0
+
+    def saturated(self) -> bool:
+        """Return True if all workers are busy and the queue is full."""
+        return self.semaphore.locked() and self.queued >= self.queue_size
+
+    @contextlib.asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Wait for a free worker slot and hold it until the request is handled."""
+        self.queued += 1
+        dnsexp_scrapes_queued.inc()
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.queued -= 1
+            dnsexp_scrapes_queued.dec()
+        try:
+            with dnsexp_scrapes_in_flight.track_inprogress():
+                yield
+        finally:
+            self.semaphore.release()
+
+
+class AsyncDNSCollector(DNSCollector):
+    """DNSCollector subclass which does the DNS lookup with ``dns.asyncquery``.
+
+    Call and await ``query_dns()`` before registering the collector, ``collect()`` then
+    yields the metrics for the result without doing any I/O.
+    """
+
+    def __init__(
+        self,
+        config: Config,
+        query: QueryMessage,
+        labels: dict[str, str],
+        timer: PhaseTimer | None = None,
+    ) -> None:
+        """Save config and q object as class attributes for use later."""
+        super().__init__(config=config, query=query, labels=labels, timer=timer)
+        # the result of the DNS query, a tuple of (response, transport, qtime, reason)
+        self.result: tuple[Message | None, str, float, str] | None = None
+
+    async def query_dns(self) -> None:
+        """Do the DNS query and save the result for collect_dns()."""
+        # pleasing mypy
+        if TYPE_CHECKING:  # pragma: no cover
+            assert isinstance(self.config.ip, (IPv4Address, IPv6Address))
+            assert isinstance(self.config.server, urllib.parse.SplitResult)
+            assert isinstance(self.config.server.port, int)
+
+        r = None
+        transport = "NONE"
+        reason = ""
+        # mark the start time and do the request
+        start = time.time()
+        try:
+            with self.timer.measure("query"):
+                r, transport = await self.get_dns_response_async(
+                    protocol=str(self.config.protocol),
+                    server=self.config.server,
+                    ip=self.config.ip,
+                    port=self.config.server.port,
+                    query=self.query,
+                    timeout=float(str(self.config.timeout)),
+                )
+        except Exception as e:  # noqa: BLE001
+            reason = self.get_failure_reason(e)
+        # clock it
+        qtime = time.time() - start
+        if r is not None:
+            self.timer.split_response(response=r)
+        self.result = (r, transport, qtime, reason)
+
+    def collect_dns(self) -> Iterator[CounterMetricFamily | GaugeMetricFamily]:
+        """Yield the DNS metrics for the result saved by query_dns()."""
+        if self.result is None:
+            # registering the collector calls describe(), so this only happens if query_dns() was not awaited
+            logger.warning("No DNS query result to collect, was query_dns() awaited?")
+            return
+        r, transport, qtime, reason = self.result
+        yield from self.collect_result(response=r, transport=transport, qtime=qtime, reason=reason)
+
+    async def get_dns_response_async(  # noqa: PLR0911,PLR0913
+        self,
+        protocol: str,
+        server: urllib.parse.SplitResult,
+        ip: IPv4Address | IPv6Address,
+        port: int,
+        query: Message,
+        timeout: float,
+    ) -> tuple[Message | None, str]:
+        """Perform a DNS query with the specified server and protocol using dns.asyncquery."""
+        # increase query counter
+        dnsexp_dns_queries_total.inc()
+        verify = self.get_verify()
+        logger.debug(f"Doing async DNS query {query.question} with server {server.geturl()} (using IP {ip})")
+        where = str(ip)
+
+        if protocol == "udp":
+            r = await dns.asyncquery.udp(q=query, where=where, port=port, timeout=timeout, one_rr_per_rrset=True)
+            return r, "UDP"
+
+        if protocol == "tcp":
+            r = await dns.asyncquery.tcp(q=query, where=where, port=port, timeout=timeout, one_rr_per_rrset=True)
+            return r, "TCP"
+
+        if protocol == "udptcp":
+            r, tcp = await dns.asyncquery.udp_with_fallback(
+                q=query, where=where, port=port, timeout=timeout, one_rr_per_rrset=True
+            )
+            return r, "TCP" if tcp else "UDP"
+
+        if protocol == "dot":
+            with dot_exceptions():
+                r = await dns.asyncquery.tls(
+                    q=query,
+                    where=where,
+                    port=port,
+                    server_hostname=server.hostname if verify else None,
+                    timeout=timeout,
+                    ssl_context=get_ssl_context(verify=verify, check_hostname=bool(verify)),
+                    one_rr_per_rrset=True,
+                )
+            dnsexp_tls_handshakes_total.labels(protocol="dot", handshake="full").inc()
+            return r, "TCP"
+
+        if protocol in ["doh", "doh3"]:
+            with doh_exceptions() if protocol == "doh" else quic_exceptions(protocol="doh3"):
+                r = await dns.asyncquery.https(
+                    q=query,
+                    where=self.get_doh_url(server=server, port=port),
+                    bootstrap_address=where,
+                    port=port,
+                    timeout=timeout,
+                    verify=verify,
+                    one_rr_per_rrset=True,
+                    http_version=dns.query.HTTPVersion.H3 if protocol == "doh3" else dns.query.HTTPVersion.DEFAULT,
+                )
+            return r, "TCP" if protocol == "doh" else "QUIC"
+
+        if protocol == "doq":
+            with quic_exceptions(protocol="doq"):
+                r = await dns.asyncquery.quic(
+                    q=query,
+                    where=where,
+                    port=port,
+                    server_hostname=server.hostname,
+                    timeout=timeout,
+                    verify=verify,
+                    one_rr_per_rrset=True,
+                )
+            return r, "QUIC"
+
+        # return None on unsupported protocol
+        return None, "NONE"
+
+
+class AsyncScrape(DNSExporter):
+    """A single request to the asyncio engine.
+
+    This reuses the config handling from DNSExporter but is not a http.server request
+    handler, the HTTP request is read and the response written by handle_connection().
+    """
+
+    def __init__(self, path: str, headers: dict[str, str], client_address: tuple[str, int]) -> None:
+        """Save the request details and parse the querystring."""
+        self.path = path
+        self.request_headers = headers
+        self.client_address = client_address
+        self.url, self.qs = self.parse_querystring()
+
+    @staticmethod
+    def needs_threaded_collector(config: Config) -> bool:
+        """Return True if the config uses features which only exist in the threading engine."""
+        return bool(
+            config.proxy or config.reuse_connections or config.doh_http2 or config.tls_session_resumption,
+        )
+
+    def bake(self, registry: CollectorRegistry) -> Response:
+        """Bake the output from the provided registry."""
+        return self.bake_metric_response(
+            registry=registry,
+            query=self.qs,
+            accept_header=self.request_headers.get("accept"),
+            accept_encoding_header=self.request_headers.get("accept-encoding"),
+        )
+
+    async def handle_request(self) -> Response:
+        """Handle incoming HTTP GET requests."""
+        logger.debug(f"Got HTTP request for {self.url.geturl()} - parsed qs is {self.qs}")
+        # increase the persistent http request metric
+        dnsexp_http_requests_total.labels(path=self.url.path).inc()
+
+        # /query is for doing a DNS query, it returns metrics about just that one dns query
+        if self.url.path in ["/query", "/config"]:
+            with dnsexp_query_requests_in_flight.track_inprogress():
+                return await self.handle_async_query_request()
+
+        # this endpoint exposes metrics about the exporter itself and the python process
+        if self.url.path == "/metrics":
+            logger.debug("Returning exporter metrics for request to /metrics")
+            # rendering all the metrics can take a while, so do it in a thread
+            return await asyncio.to_thread(
+                self.bake_exporter_metrics,
+                accept_header=self.request_headers.get("accept"),
+                accept_encoding_header=self.request_headers.get("accept-encoding"),
+            )
+
+        # the sampling profiler, only when enabled
+        if self.url.path == "/debug/profile":
+            # sampling blocks for the whole profile, so do it in a thread
+            status, body = await asyncio.to_thread(self.profile_response)
+            return status, [("Content-Type", "text/plain; charset=utf-8")], body
+
+        # the root just returns a bit of informational html
+        if self.url.path == "/":
+            logger.debug("Returning index page for request to /")
+            return 200, [], INDEX.encode("utf-8")
+
+        # unknown endpoint
+        logger.debug(f"Unknown endpoint '{self.url.path}' returning 404")
+        return 404, [], b"404 not found"
+
+    async def handle_post_request(self) -> Response:
+        """Handle incoming HTTP POST requests, only used for /-/reload."""
+        logger.debug(f"Got HTTP POST request for {self.url.geturl()}")
+        dnsexp_http_requests_total.labels(path=self.url.path).inc()
+        if self.url.path == "/-/reload":
+            # reading and validating the config file blocks, so do it in a thread
+            status, body = await asyncio.to_thread(self.reload_response)
+            return status, [], body
+        # the other endpoints only support GET
+        return 501, [], b"Unsupported method (POST)"
+
+    async def handle_async_query_request(self) -> Response:
+        """Handle incoming HTTP GET requests to /query or /config."""
+        logger.debug(f"Got {self.url.path} request from client {self.client_address}")
+        self.fail_registry = CollectorRegistry()
+
+        # begin labels dict, default all labels to the string "none"
+        self.labels: dict[str, str] = dict.fromkeys(QTIME_LABELS, "none")
+
+        # the exporter is too busy to do this scrape, fail fast instead of waiting for a worker
+        if self.saturated:
+            self.handle_failure(self.fail_registry, "exporter_saturated", labels=self.labels)
+            return self.bake(registry=self.fail_registry)
+
+        # build and validate configuration for this scrape, in a thread since resolving the server blocks
+        try:
+            with dnsexp_query_request_stage_seconds.labels(stage="config").time():
+                await asyncio.to_thread(self.build_final_config, qs=self.qs)
+        except ConfigError as E:
+            self.handle_failure(self.fail_registry, str(E), labels=self.labels)
+            # something is wrong with the config, send error response and bail out
+            return self.bake(registry=self.fail_registry)
+
+        # if this is a config check return now
+        if self.url.path == "/config":
+            logger.debug("returning config")
+            return 200, [], self.config.json().encode("utf-8")
+
+        # config is ready for action, update the labels dict and build the query
+        self.update_labels()
+        q, wire = self.build_query()
+        dnsexp_registry = CollectorRegistry()
+
+        if self.needs_threaded_collector(config=self.config):
+            # proxies and pooled connections are only supported by the regular collector
+            logger.debug("Config needs the threading engine, using DNSCollector in a worker thread")
+            dnsexp_registry.register(
+                DNSCollector(config=self.config, query=q, labels=self.labels, wire=wire, timer=self.timer)
+            )
+            # baking the output triggers the collect
+            start = time.perf_counter()
+            response = await asyncio.to_thread(self.bake, registry=dnsexp_registry)
+            dns = self.timer.total()
+            self.observe_query_stages(dns=dns, render=time.perf_counter() - start - dns)
+            return response
+
+        dns_collector = AsyncDNSCollector(config=self.config, query=q, labels=self.labels, timer=self.timer)
+        await dns_collector.query_dns()
+        dnsexp_registry.register(dns_collector)
+        logger.debug("Returning DNS query metrics")
+        start = time.perf_counter()
+        response = self.bake(registry=dnsexp_registry)
+        self.observe_query_stages(dns=self.timer.total(), render=time.perf_counter() - start)
+        return response
+
+
+async def read_request(reader: asyncio.StreamReader) -> tuple[str, str, str, dict[str, str]] | None:
+    """Read a HTTP request and return a tuple of (method, path, version, headers), or None if the client is gone."""
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    method, path, version = request_line.decode("latin-1").split()
+    headers = {}
+    while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return method, path, version, headers
+
+
+def keep_alive(version: str, headers: dict[str, str]) -> bool:
+    """Return True if the HTTP connection should be kept open after the response."""
+    connection = headers.get("connection", "").lower()
+    if version == "HTTP/1.1":
+        return connection != "close"
+    return connection == "keep-alive"
+
+
+async def handle_connection(limiter: ScrapeLimiter, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Handle requests on a HTTP connection until the client closes it or asks for it to be closed."""
+    client_address = writer.get_extra_info("peername")
+    try:
+        while True:
+            try:
+                request = await read_request(reader)
+            except (ValueError, UnicodeDecodeError):
+                # malformed request line or headers too long
+                logger.debug(f"Invalid HTTP request from client {client_address}")
+                await write_response(writer, response=(400, [], b"400 bad request"), keep_open=False)
+                return
+            if request is None:
+                return
+            method, path, version, headers = request
+            response = await dispatch_request(
+                limiter=limiter, reader=reader, method=method, path=path, headers=headers, client_address=client_address
+            )
+            if response is None:
+                return
+            keep_open = keep_alive(version=version, headers=headers)
+            await write_response(writer, response=response, keep_open=keep_open)
+            if not keep_open:
+                return
+    except ConnectionError:
+        logger.debug(f"Client {client_address} went away")
+    finally:
+        writer.close()
+
+
+async def dispatch_request(  # noqa: PLR0913
+    limiter: ScrapeLimiter,
+    reader: asyncio.StreamReader,
+    method: str,
+    path: str,
+    headers: dict[str, str],
+    client_address: tuple[str, int],
+) -> Response | None:
+    """Handle the request and return the response, or None if the request body is invalid or incomplete."""
+    if method == "POST":
+        # discard the request body, if any
+        try:
+            await reader.readexactly(int(headers.get("content-length", 0)))
+        except (ValueError, asyncio.IncompleteReadError):
+            logger.debug(f"Invalid or incomplete request body from client {client_address}")
+            return None
+        scrape = AsyncScrape(path=path, headers=headers, client_address=client_address)
+        response: Response = await scrape.handle_post_request()
+    elif method != "GET":
+        return (501, [], f"Unsupported method ({method})".encode())
+    else:
+        scrape = AsyncScrape(path=path, headers=headers, client_address=client_address)
+        response = await handle_scrape(limiter=limiter, scrape=scrape)
+    dnsexp_http_responses_total.labels(path=scrape.url.path, response_code=response[0]).inc()
+    return response
+
+
+async def handle_scrape(limiter: ScrapeLimiter, scrape: AsyncScrape) -> Response:
+    """Handle the scrape when a worker slot is free, or reject it right away if the limiter is saturated."""
+    if limiter.saturated():
+        logger.warning(f"All workers busy and queue full, rejecting request from {scrape.client_address}")
+        dnsexp_scrapes_rejected_total.inc()
+        scrape.saturated = True
+        return await scrape.handle_request()
+    async with limiter.slot():
+        return await scrape.handle_request()
+
+
+async def write_response(writer: asyncio.StreamWriter, response: Response, *, keep_open: bool) -> None:
+    """Write a HTTP response to the client."""
+    status, headers, body = response
+    head = [
+        f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}",
+        f"Server: dns_exporter/{__version__}",
+        f"Date: {email.utils.formatdate(usegmt=True)}",
+        f"Connection: {'keep-alive' if keep_open else 'close'}",
+    ]
+    head += [f"{name}: {value}" for name, value in headers if name.lower() != "content-length"]
+    head.append(f"Content-Length: {len(body)}")
+    writer.write("\r\n".join(head).encode("latin-1") + b"\r\n\r\n" + body)
+    await writer.drain()
+
+
+async def start_server(
+    listen_ip: str, port: int, workers: int = DEFAULT_WORKERS, queue_size: int = DEFAULT_QUEUE_SIZE
+) -> asyncio.Server:
+    """Start the asyncio engine HTTP server and return it."""
+    limiter = ScrapeLimiter(workers=workers, queue_size=queue_size)
+    return await asyncio.start_server(
+        functools.partial(handle_connection, limiter), host=listen_ip, port=port, backlog=workers + queue_size
+    )
+
+
+async def serve(
+    listen_ip: str, port: int, workers: int = DEFAULT_WORKERS, queue_size: int = DEFAULT_QUEUE_SIZE
+) -> None:
+    """Run the asyncio engine HTTP server forever."""
+    server = await start_server(listen_ip=listen_ip, port=port, workers=workers, queue_size=queue_size)
+    async with server:
+        await server.serve_forever()
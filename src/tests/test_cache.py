@@ -0,0 +1,244 @@
+"""Unit tests for cache.py."""
+
+import gzip
+import logging
+import socket
+import threading
+import time
+
+import pytest
+from dns_exporter.cache import ConfigCache, MetricsCache, ResolveCache, metrics_cache
+from prometheus_client import REGISTRY
+
+
+def addrinfo(*ips: str):
+    """Return the ips in the format returned by socket.getaddrinfo."""
+    return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (ip, 0)) for ip in ips]
+
+
+def lookups(result):
+    """Return the current value of the resolve cache lookup counter for the result."""
+    return REGISTRY.get_sample_value("dnsexp_resolve_cache_lookups_total", {"result": result}) or 0
+
+
+def test_resolve_cache_hit(mocker):
+    """Make sure a cached hostname is only resolved once."""
+    getaddrinfo = mocker.patch("socket.getaddrinfo", return_value=addrinfo("192.0.2.1", "192.0.2.2"))
+    cache = ResolveCache(ttl=60)
+    hits, misses = lookups("hit"), lookups("miss")
+    for _ in range(3):
+        assert cache.resolve(hostname="dns.example", family=socket.AF_INET) == ["192.0.2.1", "192.0.2.2"]
+    getaddrinfo.assert_called_once_with("dns.example", 0, family=socket.AF_INET)
+    assert lookups("hit") - hits == 2
+    assert lookups("miss") - misses == 1
+
+
+def test_resolve_cache_family(mocker):
+    """Make sure the address family is part of the cache key."""
+    getaddrinfo = mocker.patch("socket.getaddrinfo", return_value=addrinfo("192.0.2.1"))
+    cache = ResolveCache(ttl=60)
+    cache.resolve(hostname="dns.example", family=socket.AF_INET)
+    cache.resolve(hostname="dns.example", family=socket.AF_INET6)
+    assert getaddrinfo.call_count == 2
+
+
+def test_resolve_cache_expiry(mocker):
+    """Make sure expired entries are resolved again."""
+    getaddrinfo = mocker.patch("socket.getaddrinfo", return_value=addrinfo("192.0.2.1"))
+    monotonic = mocker.patch("time.monotonic", return_value=1000.0)
+    cache = ResolveCache(ttl=60)
+    expired = lookups("expired")
+    cache.resolve(hostname="dns.example", family=socket.AF_INET)
+    monotonic.return_value = 1061.0
+    cache.resolve(hostname="dns.example", family=socket.AF_INET)
+    assert getaddrinfo.call_count == 2
+    assert lookups("expired") - expired == 1
+
+
+def test_resolve_cache_negative(mocker):
+    """Make sure failed lookups are cached for the negative TTL."""
+    getaddrinfo = mocker.patch("socket.getaddrinfo", side_effect=socket.gaierror(-2, "Name or service not known"))
+    monotonic = mocker.patch("time.monotonic", return_value=1000.0)
+    cache = ResolveCache(ttl=60, negative_ttl=5)
+    for _ in range(2):
+        with pytest.raises(socket.gaierror):
+            cache.resolve(hostname="nonexistent.example", family=socket.AF_INET)
+    assert getaddrinfo.call_count == 1
+    monotonic.return_value = 1006.0
+    with pytest.raises(socket.gaierror):
+        cache.resolve(hostname="nonexistent.example", family=socket.AF_INET)
+    assert getaddrinfo.call_count == 2
+
+
+def test_resolve_cache_maxsize(mocker):
+    """Make sure the least recently used entry is evicted when the cache is full."""
+    getaddrinfo = mocker.patch("socket.getaddrinfo", return_value=addrinfo("192.0.2.1"))
+    cache = ResolveCache(ttl=60, maxsize=2)
+    for hostname in ["one.example", "two.example", "one.example", "three.example"]:
+        cache.resolve(hostname=hostname, family=socket.AF_INET)
+    assert len(cache) == 2
+    assert getaddrinfo.call_count == 3
+    # one.example was used more recently than two.example so it is still cached
+    cache.resolve(hostname="one.example", family=socket.AF_INET)
+    assert getaddrinfo.call_count == 3
+
+
+def test_resolve_cache_disabled(mocker):
+    """Make sure nothing is cached with a TTL of 0."""
+    getaddrinfo = mocker.patch("socket.getaddrinfo", return_value=addrinfo("192.0.2.1"))
+    cache = ResolveCache(ttl=0)
+    for _ in range(2):
+        cache.resolve(hostname="dns.example", family=socket.AF_INET)
+    assert getaddrinfo.call_count == 2
+    assert len(cache) == 0
+
+
+def test_resolve_random_choice(exporter, mocker):
+    """Make sure the exporter still picks a random address among the cached addresses."""
+    mocker.patch("socket.getaddrinfo", return_value=addrinfo("192.0.2.1", "192.0.2.2"))
+    mocker.patch("dns_exporter.exporter.resolve_cache", ResolveCache(ttl=60))
+    ips = {exporter.resolve_ip_getaddrinfo(exporter, hostname="dns.example", family="ipv4") for _ in range(50)}
+    assert ips == {"192.0.2.1", "192.0.2.2"}
+
+
+def test_config_cache_lru():
+    """Make sure the least recently used config is evicted when the config cache is full."""
+    cache = ConfigCache(maxsize=2)
+    cache.put("a", "config_a")
+    cache.put("b", "config_b")
+    assert cache.get("a") == "config_a"
+    cache.put("c", "config_c")
+    assert cache.get("b") is None
+    assert cache.get("a") == "config_a"
+    assert len(cache) == 2
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_config_cache_build_final_config(exporter, mocker):
+    """Make sure identical scrapes reuse the cached config, and each scrape gets its own copy."""
+    exporter.configure(modules={"test": {"protocol": "tcp"}})
+    handler = exporter.__new__(exporter)
+    create = mocker.spy(handler, "create_final_config")
+    for _ in range(3):
+        qs = {"module": "test", "server": "127.0.0.1", "query_name": "example.com"}
+        handler.build_final_config(qs=qs)
+        # the module must be removed from the querystring also when the config is cached
+        assert qs == {"server": "127.0.0.1", "query_name": "example.com"}
+        assert handler.config.protocol == "tcp"
+    assert create.call_count == 1
+    first = handler.config
+    handler.build_final_config(qs={"module": "test", "server": "127.0.0.1", "query_name": "example.com"})
+    assert handler.config is not first
+
+
+def test_config_cache_configure(exporter):
+    """Make sure configure() invalidates cached configs built from old modules."""
+    exporter.configure(modules={"test": {"protocol": "tcp"}})
+    handler = exporter.__new__(exporter)
+    handler.build_final_config(qs={"module": "test", "server": "127.0.0.1", "query_name": "example.com"})
+    assert handler.config.protocol == "tcp"
+    exporter.configure(modules={"test": {"protocol": "udptcp"}})
+    handler.build_final_config(qs={"module": "test", "server": "127.0.0.1", "query_name": "example.com"})
+    assert handler.config.protocol == "udptcp"
+
+
+def test_config_cache_shared(exporter):
+    """Make sure scrapes with an ip in the config share the cached config without copying it."""
+    exporter.configure(modules={"test": {"protocol": "tcp"}})
+    handler = exporter.__new__(exporter)
+    qs = {"module": "test", "server": "127.0.0.1", "ip": "127.0.0.1", "family": "ipv4", "query_name": "example.com"}
+    handler.build_final_config(qs=dict(qs))
+    first = handler.config
+    handler.build_final_config(qs=dict(qs))
+    assert handler.config is first
+
+
+def test_metrics_cache_max_age(mocker):
+    """Make sure rendered metrics are reused until they are max_age seconds old."""
+    monotonic = mocker.patch("time.monotonic", return_value=1000.0)
+    render = mocker.Mock(return_value=b"metrics")
+    cache = MetricsCache(max_age=5)
+    first = cache.get(key="text/plain", render=render)
+    monotonic.return_value = 1004.0
+    assert cache.get(key="text/plain", render=render) is first
+    assert render.call_count == 1
+    cache.get(key="application/openmetrics-text", render=render)
+    assert render.call_count == 2
+    monotonic.return_value = 1005.0
+    assert cache.get(key="text/plain", render=render) is not first
+    assert render.call_count == 3
+
+
+def test_metrics_cache_disabled(mocker):
+    """Make sure sequential requests render the metrics every time when max_age is 0."""
+    render = mocker.Mock(return_value=b"metrics")
+    cache = MetricsCache(max_age=0)
+    cache.get(key="text/plain", render=render)
+    cache.get(key="text/plain", render=render)
+    assert render.call_count == 2
+
+
+def test_metrics_cache_single_flight(caplog):
+    """Make sure concurrent requests share a single render, also when max_age is 0."""
+    caplog.set_level(logging.DEBUG)
+    cache = MetricsCache(max_age=0)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def render() -> bytes:
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return b"metrics"
+
+    results = []
+    owner = threading.Thread(target=lambda: results.append(cache.get(key="text/plain", render=render)))
+    owner.start()
+    assert started.wait(5)
+    waiters = [
+        threading.Thread(target=lambda: results.append(cache.get(key="text/plain", render=render))) for _ in range(3)
+    ]
+    for waiter in waiters:
+        waiter.start()
+    # wait until all the waiters have found the render in progress before releasing it
+    while caplog.text.count("Waiting for the render") < len(waiters):
+        time.sleep(0.01)
+    release.set()
+    for thread in [owner, *waiters]:
+        thread.join(5)
+    assert len(results) == 4
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+
+
+def test_metrics_cache_exception(mocker):
+    """Make sure a failed render is not cached."""
+    cache = MetricsCache(max_age=60)
+    with pytest.raises(RuntimeError):
+        cache.get(key="text/plain", render=mocker.Mock(side_effect=RuntimeError("boom")))
+    assert cache.get(key="text/plain", render=lambda: b"metrics").plain == b"metrics"
+
+
+def test_metrics_cache_gzipped(mocker):
+    """Make sure the gzip variant is only compressed once."""
+    compress = mocker.patch("gzip.compress", wraps=gzip.compress)
+    rendered = MetricsCache().get(key="text/plain", render=lambda: b"metrics")
+    assert gzip.decompress(rendered.gzipped()) == b"metrics"
+    rendered.gzipped()
+    compress.assert_called_once()
+
+
+def test_bake_exporter_metrics(exporter):
+    """Make sure /metrics output is returned from the metrics cache in the requested encoding."""
+    metrics_cache.clear()
+    handler = exporter.__new__(exporter)
+    handler.qs = {}
+    status, headers, output = handler.bake_exporter_metrics(accept_header=None, accept_encoding_header="gzip")
+    assert status == 200
+    assert ("Content-Encoding", "gzip") in headers
+    assert ("Content-Length", str(len(output))) in headers
+    assert b"dnsexp_build_version" in gzip.decompress(output)
+    status, headers, output = handler.bake_exporter_metrics(accept_header=None, accept_encoding_header=None)
+    assert ("Content-Encoding", "gzip") not in headers
+    assert b"dnsexp_build_version" in output
@@ -1,7 +1,13 @@
 """Unit tests for DNSCollector and other collector.py code."""
 
+import dns.flags
+import dns.message
+import dns.rdtypes.IN.A
+import dns.rrset
 import pytest
-from dns_exporter.collector import DNSCollector
+from dns_exporter.collector import FLAGS_LABELS, FLAGS_MASK, DNSCollector
+from dns_exporter.config import Config
+from dns_exporter.metrics import QTIME_LABELS
 
 
 def test_invalid_failure_reason(caplog):
@@ -15,3 +21,82 @@ def test_invalid_failure_reason(caplog):
     with pytest.raises(Exception, match="Unknown failure_reason foo - please file a bug!") as e:
         list(c.increase_failure_reason_metric(failure_reason="foo", labels={}))
     assert str(e.value) == "Unknown failure_reason foo - please file a bug!"
+
+
+def test_flags_labels():
+    """Make sure the precomputed flags labels are the sorted text flags for every combination of flags."""
+    assert len(FLAGS_LABELS) == 2 ** len(dns.flags.Flag)
+    for flags, label in FLAGS_LABELS.items():
+        assert label == " ".join(sorted(dns.flags.to_text(flags).split(" ")))
+    # the opcode and rcode bits are not part of the label
+    assert FLAGS_LABELS[(dns.flags.QR | dns.flags.RD | 0x800 | 0x3) & FLAGS_MASK] == "QR RD"
+
+
+def ttl_collector(**settings: int):
+    """Return a DNSCollector with the settings and a response with 3 A RRs and 1 NS RR, and the labels."""
+    config = Config.create(name="test", server=None, query_name="example.com", **settings)
+    labels = dict.fromkeys(QTIME_LABELS, "none")
+    response = dns.message.make_response(dns.message.make_query("example.com", "A"))
+    response.answer.append(dns.rrset.from_text("example.com.", 300, "IN", "A", "192.0.2.1", "192.0.2.2"))
+    # a second rrset with the same name and type, like RRSIGs covering different types
+    response.answer.append(dns.rrset.from_text("example.com.", 60, "IN", "A", "192.0.2.3"))
+    response.authority.append(dns.rrset.from_text("example.com.", 3600, "IN", "NS", "ns.example.com."))
+    return DNSCollector(config, None, labels), response, labels
+
+
+def samples(metrics, name):
+    """Return the samples of the named metric as a dict of (section, name, type[, value]) to value."""
+    metric = next(metric for metric in metrics if metric.name == name)
+    return {
+        tuple(value for key, value in sample.labels.items() if key.startswith("rr_")): sample.value
+        for sample in metric.samples
+    }
+
+
+def test_ttl_per_rr():
+    """Make sure each RR gets a TTL sample and the collector labels are not changed."""
+    collector, response, labels = ttl_collector()
+    metrics = list(collector.yield_ttl_metrics(response=response))
+    assert [metric.name for metric in metrics] == ["dnsexp_dns_response_rr_ttl_seconds"]
+    assert samples(metrics, "dnsexp_dns_response_rr_ttl_seconds") == {
+        ("answer", "example.com.", "A", "192.0.2.1"): 300,
+        ("answer", "example.com.", "A", "192.0.2.2"): 300,
+        ("answer", "example.com.", "A", "192.0.2.3"): 60,
+        ("authority", "example.com.", "NS", "ns.example.com."): 3600,
+    }
+    assert labels == dict.fromkeys(QTIME_LABELS, "none")
+
+
+def test_ttl_max_rrs():
+    """Make sure collect_ttl_max_rrs limits the TTL samples and sets the truncated metric."""
+    collector, response, _ = ttl_collector(collect_ttl_max_rrs=2)
+    metrics = list(collector.yield_ttl_metrics(response=response))
+    assert len(samples(metrics, "dnsexp_dns_response_rr_ttl_seconds")) == 2
+    assert metrics[-1].name == "dnsexp_dns_response_rr_ttl_truncated"
+    assert metrics[-1].samples[0].value == 1
+    collector, response, _ = ttl_collector(collect_ttl_max_rrs=4)
+    metrics = list(collector.yield_ttl_metrics(response=response))
+    assert len(samples(metrics, "dnsexp_dns_response_rr_ttl_seconds")) == 4
+    assert metrics[-1].samples[0].value == 0
+
+
+def test_ttl_no_rr_value(mocker):
+    """Make sure RRs are not rendered as text when collect_ttl_rr_value_length is 0."""
+    to_text = mocker.patch.object(dns.rdtypes.IN.A.A, "to_text")
+    collector, response, _ = ttl_collector(collect_ttl_rr_value_length=0)
+    metrics = list(collector.yield_ttl_metrics(response=response))
+    assert ("answer", "example.com.", "A", "") in samples(metrics, "dnsexp_dns_response_rr_ttl_seconds")
+    to_text.assert_not_called()
+
+
+def test_ttl_aggregate(mocker):
+    """Make sure collect_ttl_aggregate yields the lowest and highest TTL and RR count per section, name and type."""
+    to_text = mocker.patch.object(dns.rdtypes.IN.A.A, "to_text")
+    collector, response, _ = ttl_collector(collect_ttl_aggregate=True)
+    metrics = list(collector.yield_ttl_metrics(response=response))
+    assert samples(metrics, "dnsexp_dns_response_rr_ttl_seconds") == {}
+    answer, authority = ("answer", "example.com.", "A"), ("authority", "example.com.", "NS")
+    assert samples(metrics, "dnsexp_dns_response_rr_ttl_min_seconds") == {answer: 60, authority: 3600}
+    assert samples(metrics, "dnsexp_dns_response_rr_ttl_max_seconds") == {answer: 300, authority: 3600}
+    assert samples(metrics, "dnsexp_dns_response_rrs") == {answer: 3, authority: 1}
+    to_text.assert_not_called()
@@ -1,8 +1,13 @@
 """dns_exporter tests for the config module."""
+import copy
+import dataclasses
+import pickle
 from ipaddress import IPv4Address
 
+import dns.rrset
 import pytest
-from dns_exporter.config import Config, ConfigDict, ConfigError
+from dns_exporter.collector import FLAGS_LABELS
+from dns_exporter.config import Config, ConfigDict, ConfigError, RFValidator, RRValidator
 
 
 def test_nonbool_bool(exporter):
@@ -85,6 +90,21 @@ def test_edns_do_true(exporter):
     assert c.edns_do is True
 
 
+def test_collect_ttl_settings(exporter):
+    """Test when collect_ttl_aggregate and collect_ttl_max_rrs are set to strings."""
+    prepared = exporter.prepare_config(ConfigDict(collect_ttl_aggregate="true", collect_ttl_max_rrs="100"))
+    c = Config.create(name="test", **prepared)
+    assert c.collect_ttl_aggregate is True
+    assert c.collect_ttl_max_rrs == 100
+
+
+def test_negative_collect_ttl_max_rrs(exporter):
+    """Test a negative collect_ttl_max_rrs."""
+    prepared = exporter.prepare_config(ConfigDict(collect_ttl_max_rrs=-1))
+    with pytest.raises(ConfigError):
+        Config.create(name="test", **prepared)
+
+
 def test_rd_true(exporter):
     """Test when recursion_desired is set to a string."""
     prepared = exporter.prepare_config(ConfigDict(recursion_desired="true"))
@@ -99,10 +119,11 @@ def test_rd_false(exporter):
     assert c.recursion_desired is False
 
 
-def test_proxy_for_unsupported_protocol(exporter):
+@pytest.mark.parametrize("protocol", ["dot", "doh3", "doq"])
+def test_proxy_for_unsupported_protocol(exporter, protocol):
     """Test proxy with a protocol not supported."""
     prepared = exporter.prepare_config(
-        ConfigDict(protocol="dot", proxy="socks5://127.0.0.1"),
+        ConfigDict(protocol=protocol, proxy="socks5://127.0.0.1"),
     )
     with pytest.raises(ConfigError):
         Config.create(name="test", **prepared)
@@ -154,3 +175,154 @@ def test_wrongtype_bool(exporter):
     prepared["edns_do"] = 42
     with pytest.raises(ConfigError):
         Config.create(name="test", **prepared)
+
+
+def ns_rrs(*names: str) -> list[dns.rrset.RRset]:
+    """Return a list of root NS RRsets, one per RR like in responses parsed with one_rr_per_rrset."""
+    return [dns.rrset.from_text(".", 86400, "IN", "NS", name) for name in names]
+
+
+def test_rrmatcher_cached():
+    """Make sure validators with the same rules share a compiled matcher."""
+    first = RRValidator.create(fail_if_matches_regexp=[".*k.root-servers.net"])
+    second = RRValidator.create(fail_if_matches_regexp=[".*k.root-servers.net"])
+    assert first.matcher() is second.matcher()
+    assert RRValidator.create().matcher().check(ns_rrs("a.root-servers.net.")) is None
+
+
+def test_rrmatcher_regexes():
+    """Test the regex rules of the compiled matcher."""
+    rrs = ns_rrs("a.root-servers.net.", "k.root-servers.net.")
+    matcher = RRValidator.create(fail_if_matches_regexp=[".*k.root-servers.net"]).matcher()
+    assert matcher.check(rrs) == "fail_if_matches_regexp"
+    assert matcher.check(rrs[:1]) is None
+    assert matcher.check([]) is None
+    matcher = RRValidator.create(fail_if_not_matches_regexp=[".*[a-m].root-servers.net"]).matcher()
+    assert matcher.check(rrs) is None
+    assert matcher.check(ns_rrs("a.iana-servers.net.")) == "fail_if_not_matches_regexp"
+    matcher = RRValidator.create(fail_if_all_match_regexp=[".*root-servers.net"]).matcher()
+    assert matcher.check(rrs) == "fail_if_all_match_regexp"
+    assert matcher.check([]) is None
+    matcher = RRValidator.create(fail_if_none_matches_regexp=[".*iana-servers.net"]).matcher()
+    assert matcher.check(rrs) == "fail_if_none_matches_regexp"
+
+
+def test_rrmatcher_counts():
+    """Test the fail_if_count_* rules of the compiled matcher."""
+    rrs = ns_rrs("a.root-servers.net.", "b.root-servers.net.", "c.root-servers.net.")
+    assert RRValidator.create(fail_if_count_eq=3).matcher().check(rrs) == "fail_if_count_eq"
+    assert RRValidator.create(fail_if_count_eq=2).matcher().check(rrs) is None
+    assert RRValidator.create(fail_if_count_ne=13).matcher().check(rrs) == "fail_if_count_ne"
+    assert RRValidator.create(fail_if_count_ne=3).matcher().check(rrs) is None
+    assert RRValidator.create(fail_if_count_lt=4).matcher().check(rrs) == "fail_if_count_lt"
+    assert RRValidator.create(fail_if_count_lt=3).matcher().check(rrs) is None
+    assert RRValidator.create(fail_if_count_gt=2).matcher().check(rrs) == "fail_if_count_gt"
+    assert RRValidator.create(fail_if_count_gt=3).matcher().check(rrs) is None
+    # the regexes are checked before the counts
+    validator = RRValidator.create(fail_if_matches_regexp=[".*c.root"], fail_if_count_eq=3)
+    assert validator.matcher().check(rrs) == "fail_if_matches_regexp"
+
+
+def test_rrmatcher_invalid_regex(exporter):
+    """Make sure an invalid regex is found when the config is prepared."""
+    with pytest.raises(ConfigError, match="invalid_request_config"):
+        exporter.prepare_config(ConfigDict(validate_answer_rrs={"fail_if_matches_regexp": ["[unclosed"]}))
+
+
+def check_flags_as_text(validator, flags):
+    """Validate flags by comparing the flags as text, the way it was done before RFMatcher."""
+    present = dns.flags.to_text(flags).split(" ")
+    if any(flag in present for flag in validator.fail_if_any_present):
+        return "fail_if_any_present"
+    if validator.fail_if_all_present and all(flag in present for flag in validator.fail_if_all_present):
+        return "fail_if_all_present"
+    if any(flag not in present for flag in validator.fail_if_any_absent):
+        return "fail_if_any_absent"
+    if validator.fail_if_all_absent and all(flag not in present for flag in validator.fail_if_all_absent):
+        return "fail_if_all_absent"
+    return None
+
+
+@pytest.mark.parametrize(
+    "rules",
+    [
+        {"fail_if_any_present": ["AD", "TC"]},
+        {"fail_if_all_present": ["QR", "RA", "RD"]},
+        {"fail_if_all_present": ["QR", "XX"]},
+        {"fail_if_any_absent": ["AD"]},
+        {"fail_if_any_absent": ["QR", "XX"]},
+        {"fail_if_all_absent": ["AA", "AD"]},
+        {"fail_if_all_absent": ["XX"]},
+        {"fail_if_any_present": ["CD"], "fail_if_all_absent": ["AA", "AD"], "fail_if_any_absent": ["RD"]},
+        {},
+    ],
+)
+def test_rfmatcher(rules):
+    """Make sure the compiled flag masks give the same result as comparing flags as text, for all combinations."""
+    validator = RFValidator.create(**rules)
+    matcher = validator.matcher()
+    for flags in [known | other for known in FLAGS_LABELS for other in (0, 0x0803)]:
+        assert matcher.check(flags) == check_flags_as_text(validator, flags), dns.flags.to_text(flags)
+
+
+def test_config_frozen():
+    """Make sure Config and validator objects are immutable, hashable and have no __dict__."""
+    config = Config.create(name="test", valid_rcodes=["NOERROR", "NXDOMAIN"])
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        config.protocol = "tcp"
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        config.validate_answer_rrs.fail_if_count_eq = 1
+    assert config.valid_rcodes == ("NOERROR", "NXDOMAIN")
+    assert hash(config) == hash(Config.create(name="test", valid_rcodes=["NOERROR", "NXDOMAIN"]))
+    assert not hasattr(config, "__dict__")
+    assert not hasattr(config.validate_response_flags, "__dict__")
+
+
+def test_validators_interned():
+    """Make sure identical validators are shared between configs."""
+    first = Config.create(name="first", validate_answer_rrs=RRValidator.create(fail_if_matches_regexp=[".*"]))
+    second = Config.create(name="second", validate_answer_rrs=RRValidator.create(fail_if_matches_regexp=(".*",)))
+    assert first.validate_answer_rrs is second.validate_answer_rrs
+    assert first.validate_authority_rrs is first.validate_additional_rrs
+    assert RFValidator.create(fail_if_any_absent=["QR"]) is RFValidator.create(fail_if_any_absent=["QR"])
+    assert RFValidator.create(fail_if_any_absent=["QR"]) is not RFValidator.create(fail_if_any_present=["QR"])
+
+
+def test_config_evolve():
+    """Make sure evolve() returns a changed copy which shares the other values."""
+    config = Config.create(name="test", valid_rcodes=["NOERROR", "NXDOMAIN"])
+    evolved = config.evolve(ip=IPv4Address("192.0.2.1"))
+    assert evolved.ip == IPv4Address("192.0.2.1")
+    assert config.ip is None
+    assert evolved.valid_rcodes is config.valid_rcodes
+    assert evolved == Config.create(name="test", valid_rcodes=["NOERROR", "NXDOMAIN"], ip=IPv4Address("192.0.2.1"))
+    with pytest.raises(TypeError, match="foo"):
+        config.evolve(foo="bar")
+
+
+def test_config_copy_pickle():
+    """Make sure frozen configs can be copied and pickled."""
+    config = Config.create(name="test", validate_answer_rrs=RRValidator.create(fail_if_count_gt=3))
+    assert copy.copy(config) == config
+    assert copy.deepcopy(config) == config
+    assert pickle.loads(pickle.dumps(config)) == config  # noqa: S301
+
+
+def test_config_unpickle_other_fields():
+    """Make sure a config pickled when Config had other fields is refused instead of loaded with shifted values."""
+    config = Config.create(name="test")
+    with pytest.raises(ValueError, match="fields"):
+        config.__setstate__(dict(list(config.__getstate__().items())[:-1]))
+    # a renamed field is refused as well, also when the number of fields is the same
+    state = config.__getstate__()
+    state["renamed"] = state.pop("name")
+    with pytest.raises(ValueError, match="fields"):
+        config.__setstate__(state)
+
+
+def test_validator_unpickle_interned():
+    """Make sure unpickled validators are interned like the validators returned by create()."""
+    config = Config.create(name="test", validate_answer_rrs=RRValidator.create(fail_if_count_gt=3))
+    assert pickle.loads(pickle.dumps(config)).validate_answer_rrs is config.validate_answer_rrs  # noqa: S301
+    flags = RFValidator.create(fail_if_any_present=["TC"])
+    assert pickle.loads(pickle.dumps(flags)) is flags  # noqa: S301
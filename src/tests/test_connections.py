@@ -0,0 +1,465 @@
+"""Unit tests for connection reuse and connections.py code."""
+
+import os
+import socket
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+
+import dns.exception
+import dns.message
+import dns.query
+import pytest
+import requests
+from dns_exporter.collector import DNSCollector
+from dns_exporter.config import Config
+from dns_exporter.connections import (
+    ConnectionPool,
+    PipelinedTCPConnection,
+    create_doh_client,
+    doh_clients,
+    dot_sockets,
+    quic_managers,
+    tcp_connections,
+    tls_sessions,
+)
+from dns_exporter.metrics import QTIME_LABELS
+
+
+class FakeConnection:
+    """Stand-in for a connection object which remembers if it was closed."""
+
+    closed = False
+
+    def close(self):
+        """Close the fake connection."""
+        self.closed = True
+
+
+def make_pool(maxsize=10, max_idle=60.0):
+    """Return a ConnectionPool of FakeConnection objects."""
+    return ConnectionPool(name="test", close=lambda conn: conn.close(), maxsize=maxsize, max_idle=max_idle)
+
+
+def test_pool_reuse():
+    """Make sure the pool returns the same connection for the same key."""
+    pool = make_pool()
+    conn, reused = pool.get(key="a", factory=FakeConnection)
+    assert not reused
+    conn2, reused = pool.get(key="a", factory=FakeConnection)
+    assert reused
+    assert conn2 is conn
+    other, reused = pool.get(key="b", factory=FakeConnection)
+    assert not reused
+    assert other is not conn
+    assert len(pool) == 2
+
+
+def test_pool_maxsize():
+    """Make sure the least recently used connection is closed when the pool is full."""
+    pool = make_pool(maxsize=2)
+    a, _ = pool.get(key="a", factory=FakeConnection)
+    b, _ = pool.get(key="b", factory=FakeConnection)
+    # use a so b becomes the least recently used
+    pool.get(key="a", factory=FakeConnection)
+    c, _ = pool.get(key="c", factory=FakeConnection)
+    assert len(pool) == 2
+    assert b.closed
+    assert not a.closed
+    assert not c.closed
+
+
+def test_pool_max_idle():
+    """Make sure idle connections are closed and replaced."""
+    pool = make_pool(max_idle=0.1)
+    a, _ = pool.get(key="a", factory=FakeConnection)
+    time.sleep(0.2)
+    a2, reused = pool.get(key="a", factory=FakeConnection)
+    assert a.closed
+    assert not reused
+    assert a2 is not a
+
+
+def test_pool_take_put():
+    """Make sure take() hands out a connection exclusively and put() returns it."""
+    pool = make_pool()
+    assert pool.take(key="a") is None
+    a = FakeConnection()
+    pool.put(key="a", connection=a)
+    assert pool.take(key="a") is a
+    assert pool.take(key="a") is None
+    pool.put(key="a", connection=a)
+    # a second connection for the same key is closed
+    b = FakeConnection()
+    pool.put(key="a", connection=b)
+    assert b.closed
+    assert not a.closed
+    assert len(pool) == 1
+
+
+def test_pool_discard():
+    """Make sure discard() closes and forgets the connection."""
+    pool = make_pool()
+    a, _ = pool.get(key="a", factory=FakeConnection)
+    pool.discard(key="a", connection=a)
+    assert a.closed
+    assert len(pool) == 0
+    pool.clear()
+
+
+def test_doh_reuse_connections(dns_exporter_example_config, doh_server):
+    """Make sure DoH scrapes with reuse_connections share a single connection."""
+    doh_clients.clear()
+    params = {
+        "server": f"https://127.0.0.1:{doh_server.server_port}/dns-query",
+        "query_name": "example.com",
+        "protocol": "doh",
+        "family": "ipv4",
+        "verify_certificate": "false",
+        "reuse_connections": "true",
+    }
+    for _ in range(3):
+        r = requests.get("http://127.0.0.1:25353/query", params=params)
+        assert "dnsexp_dns_query_success 1.0" in r.text
+    assert doh_server.connections == 1
+    assert len(doh_clients) == 1
+
+
+def test_doh_no_reuse_connections(dns_exporter_example_config, doh_server):
+    """Make sure DoH scrapes without reuse_connections open a new connection every time."""
+    params = {
+        "server": f"https://127.0.0.1:{doh_server.server_port}/dns-query",
+        "query_name": "example.com",
+        "protocol": "doh",
+        "family": "ipv4",
+        "verify_certificate": "false",
+    }
+    for _ in range(3):
+        r = requests.get("http://127.0.0.1:25353/query", params=params)
+        assert "dnsexp_dns_query_success 1.0" in r.text
+    assert doh_server.connections == 3
+
+
+def test_doh_http11_concurrent_requests(doh_server):
+    """Make sure concurrent requests over pooled HTTP/1.1 connections are not serialised by the headers lock."""
+    doh_server.delay = 0.5
+    client = create_doh_client(ip="127.0.0.1", verify=False)
+    wire = dns.message.make_query("example.com", "A").to_wire()
+    url = f"https://127.0.0.1:{doh_server.server_port}/dns-query"
+    headers = {"content-type": "application/dns-message"}
+    start = time.monotonic()
+    with client, ThreadPoolExecutor(max_workers=4) as executor:
+        responses = list(executor.map(lambda _: client.post(url, content=wire, headers=headers), range(4)))
+    assert [r.status_code for r in responses] == [200] * 4
+    assert time.monotonic() - start < 1.5
+
+
+def test_doh_http2_multiplexing(dns_exporter_example_config, doh2_server):
+    """Make sure concurrent DoH scrapes with doh_http2 share a single HTTP/2 connection."""
+    params = {
+        "server": f"https://127.0.0.1:{doh2_server.server_port}/dns-query",
+        "query_name": "example.com",
+        "protocol": "doh",
+        "family": "ipv4",
+        "verify_certificate": "false",
+        "doh_http2": "true",
+    }
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        responses = list(
+            executor.map(lambda _: requests.get("http://127.0.0.1:25353/query", params=params), range(20)),
+        )
+    for r in responses:
+        assert "dnsexp_dns_query_success 1.0" in r.text
+    assert doh2_server.connections == 1
+    r = requests.get("http://127.0.0.1:25353/metrics")
+    assert "dnsexp_doh_streams_per_connection_count" in r.text
+
+
+def test_doh3_reuse_connection(dns_exporter_example_config, doh3_server):
+    """Make sure DoH3 scrapes share a single QUIC connection."""
+    quic_managers.clear()
+    params = {
+        "server": f"https://127.0.0.1:{doh3_server.server_port}/dns-query",
+        "query_name": "example.com",
+        "protocol": "doh3",
+        "family": "ipv4",
+        "verify_certificate": "false",
+    }
+    for _ in range(3):
+        r = requests.get("http://127.0.0.1:25353/query", params=params)
+        assert "dnsexp_dns_query_success 1.0" in r.text
+        assert 'transport="QUIC"' in r.text
+    assert doh3_server.connections() == 1
+    assert len(quic_managers) == 1
+
+
+def test_doh3_connection_error(dns_exporter_example_config):
+    """Make sure a DoH3 scrape to a closed port fails and does not keep the connection in the pool."""
+    quic_managers.clear()
+    params = {
+        "server": "https://127.0.0.1:1/dns-query",
+        "query_name": "example.com",
+        "protocol": "doh3",
+        "family": "ipv4",
+        "verify_certificate": "false",
+        "timeout": "1",
+    }
+    r = requests.get("http://127.0.0.1:25353/query", params=params)
+    assert "dnsexp_dns_query_success 0.0" in r.text
+    assert len(quic_managers) == 0
+
+
+def test_doq_reuse_connection(dns_exporter_example_config, doq_server):
+    """Make sure DoQ scrapes with reuse_connections share a single QUIC connection and report it."""
+    quic_managers.clear()
+    params = {
+        "server": f"127.0.0.1:{doq_server.server_port}",
+        "query_name": "example.com",
+        "protocol": "doq",
+        "family": "ipv4",
+        "verify_certificate": "false",
+        "reuse_connections": "true",
+    }
+    r = requests.get("http://127.0.0.1:25353/query", params=params)
+    assert "dnsexp_dns_query_success 1.0" in r.text
+    assert "dnsexp_dns_connection_reused 0.0" in r.text
+    for _ in range(2):
+        r = requests.get("http://127.0.0.1:25353/query", params=params)
+        assert "dnsexp_dns_query_success 1.0" in r.text
+        assert "dnsexp_dns_connection_reused 1.0" in r.text
+    assert doq_server.connections() == 1
+
+
+def test_doq_reconnect(dns_exporter_example_config, doq_server):
+    """Make sure a pooled DoQ connection closed by the server is replaced by a new connection."""
+    quic_managers.clear()
+    params = {
+        "server": f"127.0.0.1:{doq_server.server_port}",
+        "query_name": "example.com",
+        "protocol": "doq",
+        "family": "ipv4",
+        "verify_certificate": "false",
+        "reuse_connections": "true",
+    }
+    r = requests.get("http://127.0.0.1:25353/query", params=params)
+    assert "dnsexp_dns_query_success 1.0" in r.text
+    doq_server.close_connections()
+    time.sleep(0.5)
+    r = requests.get("http://127.0.0.1:25353/query", params=params)
+    assert "dnsexp_dns_query_success 1.0" in r.text
+    assert doq_server.connections() == 2
+
+
+def test_doq_no_reuse_connections(dns_exporter_example_config, doq_server):
+    """Make sure DoQ scrapes without reuse_connections open a new connection every time."""
+    params = {
+        "server": f"127.0.0.1:{doq_server.server_port}",
+        "query_name": "example.com",
+        "protocol": "doq",
+        "family": "ipv4",
+        "verify_certificate": "false",
+    }
+    for _ in range(2):
+        r = requests.get("http://127.0.0.1:25353/query", params=params)
+        assert "dnsexp_dns_query_success 1.0" in r.text
+        assert "dnsexp_dns_connection_reused" not in r.text
+    assert doq_server.connections() == 2
+
+
+def test_dot_reuse_connections(dns_exporter_example_config, dot_server):
+    """Make sure DoT scrapes with reuse_connections share a single connection."""
+    dot_sockets.clear()
+    params = {
+        "server": f"127.0.0.1:{dot_server.server_port}",
+        "query_name": "example.com",
+        "protocol": "dot",
+        "family": "ipv4",
+        "verify_certificate": "false",
+        "reuse_connections": "true",
+    }
+    for _ in range(3):
+        r = requests.get("http://127.0.0.1:25353/query", params=params)
+        assert "dnsexp_dns_query_success 1.0" in r.text
+    assert dot_server.connections == 1
+    assert len(dot_sockets) == 1
+    r = requests.get("http://127.0.0.1:25353/metrics")
+    assert 'dnsexp_tls_handshakes_total{handshake="none",protocol="dot"}' in r.text
+
+
+def test_dot_tls_session_resumption(dns_exporter_example_config, dot_server):
+    """Make sure new DoT connections resume the TLS session with tls_session_resumption enabled."""
+    tls_sessions.clear()
+    params = {
+        "server": f"127.0.0.1:{dot_server.server_port}",
+        "query_name": "example.com",
+        "protocol": "dot",
+        "family": "ipv4",
+        "verify_certificate": "false",
+        "tls_session_resumption": "true",
+    }
+    for _ in range(3):
+        r = requests.get("http://127.0.0.1:25353/query", params=params)
+        assert "dnsexp_dns_query_success 1.0" in r.text
+    assert dot_server.connections == 3
+    assert dot_server.resumed == 2
+    r = requests.get("http://127.0.0.1:25353/metrics")
+    assert 'dnsexp_tls_handshakes_total{handshake="resumed",protocol="dot"}' in r.text
+
+
+def test_dot_reused_socket_closed_on_timeout(monkeypatch):
+    """Make sure a pooled DoT socket is closed, and not returned to the pool, when the query times out."""
+    dot_sockets.clear()
+    sock = FakeConnection()
+    key = ("dot.example", "127.0.0.1", 853, False)
+    dot_sockets.put(key, sock)
+
+    def timeout(**kwargs: object) -> None:
+        raise dns.exception.Timeout
+
+    monkeypatch.setattr(dns.query, "tls", timeout)
+    config = Config.create(name="test", server=None, query_name="example.com", reuse_connections=True)
+    collector = DNSCollector(config, None, dict.fromkeys(QTIME_LABELS, "none"))
+    with pytest.raises(dns.exception.Timeout):
+        collector.get_dns_response_dot_pooled(
+            query=dns.message.make_query("example.com", "A"),
+            ip="127.0.0.1",
+            port=853,
+            timeout=1,
+            server=urllib.parse.urlsplit("dot://dot.example:853"),
+            verify=False,
+            ssl_context=None,
+        )
+    assert sock.closed
+    assert len(dot_sockets) == 0
+
+
+def tcp_params(tcp_server):
+    """Return the querystring for a scrape of the local TCP server with reuse_connections enabled."""
+    return {
+        "server": f"127.0.0.1:{tcp_server.server_port}",
+        "query_name": "example.com",
+        "protocol": "tcp",
+        "family": "ipv4",
+        "reuse_connections": "true",
+    }
+
+
+def test_tcp_pipelining(dns_exporter_example_config, tcp_server):
+    """Make sure concurrent TCP scrapes with reuse_connections are pipelined over a single connection."""
+    tcp_connections.clear()
+    r = requests.get("http://127.0.0.1:25353/query", params=tcp_params(tcp_server))
+    assert "dnsexp_dns_query_success 1.0" in r.text
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        responses = list(
+            executor.map(
+                lambda _: requests.get("http://127.0.0.1:25353/query", params=tcp_params(tcp_server)),
+                range(20),
+            ),
+        )
+    for r in responses:
+        assert "dnsexp_dns_query_success 1.0" in r.text
+        assert "dnsexp_dns_connection_reused 1.0" in r.text
+    assert tcp_server.connections == 1
+    assert tcp_server.queries == 21
+
+
+def test_tcp_reconnect(dns_exporter_example_config, tcp_server):
+    """Make sure a pooled TCP connection closed by the server is replaced transparently."""
+    tcp_connections.clear()
+    tcp_server.queries_per_connection = 1
+    for _ in range(3):
+        r = requests.get("http://127.0.0.1:25353/query", params=tcp_params(tcp_server))
+        assert "dnsexp_dns_query_success 1.0" in r.text
+    assert tcp_server.connections == 3
+
+
+def test_tcp_keepalive(dns_exporter_example_config, tcp_server):
+    """Make sure the edns-tcp-keepalive timeout from the server is honoured."""
+    tcp_connections.clear()
+    # a keepalive timeout of 0 means the server wants the connection closed right away
+    tcp_server.keepalive = 0
+    for _ in range(2):
+        r = requests.get("http://127.0.0.1:25353/query", params=tcp_params(tcp_server))
+        assert "dnsexp_dns_query_success 1.0" in r.text
+    assert tcp_server.connections == 2
+
+
+def test_tcp_out_of_order_responses():
+    """Make sure responses arriving out of order are matched with the right query by message ID."""
+    listener = socket.create_server(("127.0.0.1", 0))
+
+    def serve() -> None:
+        sock, _ = listener.accept()
+        with sock, sock.makefile("rb") as f:
+            queries = [dns.message.from_wire(f.read(int.from_bytes(f.read(2), "big"))) for _ in range(2)]
+            for wire in reversed([dns.message.make_response(query).to_wire() for query in queries]):
+                sock.sendall(len(wire).to_bytes(2, "big") + wire)
+
+    Thread(target=serve, daemon=True).start()
+    connection = PipelinedTCPConnection(ip="127.0.0.1", port=listener.getsockname()[1], timeout=5)
+    queries = [dns.message.make_query(name, "A") for name in ["one.example.com", "two.example.com"]]
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        responses = list(executor.map(lambda q: connection.query(q=q, timeout=5), queries))
+    for q, r in zip(queries, responses):
+        assert r.id == q.id
+        assert r.question == q.question
+    connection.close()
+    listener.close()
+
+
+def test_tcp_timeout_discards_connection(dns_exporter_example_config):
+    """Make sure a pooled TCP connection is dropped when the server stops answering without closing it."""
+    tcp_connections.clear()
+    listener = socket.create_server(("127.0.0.1", 0))
+    params = {
+        "server": f"127.0.0.1:{listener.getsockname()[1]}",
+        "query_name": "example.com",
+        "protocol": "tcp",
+        "family": "ipv4",
+        "reuse_connections": "true",
+        "timeout": "0.5",
+    }
+    r = requests.get("http://127.0.0.1:25353/query", params=params)
+    assert "dnsexp_dns_query_success 0.0" in r.text
+    assert len(tcp_connections) == 0
+    listener.close()
+
+
+def test_tcp_write_timeout():
+    """Make sure writing to a server which stopped reading times out and closes the connection."""
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+    connection = PipelinedTCPConnection(ip="127.0.0.1", port=listener.getsockname()[1], timeout=5)
+    connection._sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)  # noqa: SLF001
+    query = dns.message.make_query("example.com", "A")
+    wire = query.to_wire() + bytes(60000)
+    for _ in range(100):
+        start = time.time()
+        with pytest.raises(dns.exception.Timeout):
+            connection.query(q=query, timeout=0.1, wire=wire)
+        assert time.time() - start < 1
+        if connection.closed:
+            break
+    assert connection.closed
+    listener.close()
+
+
+def test_tcp_high_file_descriptor(tcp_server):
+    """Make sure a connection with a file descriptor above FD_SETSIZE (1024) can read responses."""
+    resource = pytest.importorskip("resource")
+    if resource.getrlimit(resource.RLIMIT_NOFILE)[0] < 1100:
+        pytest.skip("the open files limit is too low")
+    # use up the low file descriptors so the connection gets a high one
+    fds = [os.open(os.devnull, os.O_RDONLY) for _ in range(1030)]
+    try:
+        connection = PipelinedTCPConnection(ip="127.0.0.1", port=tcp_server.server_port, timeout=5)
+        assert connection._sock.fileno() > 1024  # noqa: SLF001
+        q = dns.message.make_query("example.com", "A")
+        assert connection.query(q=q, timeout=5).id == q.id
+        connection.close()
+    finally:
+        for fd in fds:
+            os.close(fd)
@@ -1,4 +1,6 @@
 """Unit tests for entrypoint.py."""
+import subprocess
+import sys
 import time
 
 import dns_exporter.entrypoint
@@ -30,3 +32,28 @@ def test_version(capsys):
     assert e.type == SystemExit, f"Exit was not as expected, it was {e.type}"
     captured = capsys.readouterr()
     assert __version__ in captured.out
+
+
+def test_version_does_not_import_exporter():
+    """Make sure the entrypoint module and the argument parser do not import dnspython or the exporter."""
+    code = (
+        "import sys; from dns_exporter.entrypoint import get_parser; get_parser(); "
+        "print(sorted(m for m in sys.modules if m in ('dns.query', 'dns_exporter.exporter', 'socks')))"
+    )
+    result = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True)  # noqa: S603
+    assert result.stdout.strip() == "[]"
+
+
+@pytest.mark.parametrize(
+    ("args", "message"),
+    [
+        (["--workers", "0"], "Invalid --workers 0"),
+        (["--workers", "-1"], "Invalid --workers -1"),
+        (["--queue-size", "-1"], "Invalid --queue-size -1"),
+    ],
+)
+def test_invalid_admission_control(args, message, caplog):
+    """Make sure --workers below 1 and a negative --queue-size are rejected."""
+    with pytest.raises(SystemExit):
+        main(args)
+    assert message in caplog.text
@@ -0,0 +1,141 @@
+"""Unit tests for metrics.py."""
+
+import gc
+import threading
+
+import pytest
+import requests
+from dns_exporter.entrypoint import main
+from dns_exporter.metrics import QTIME_LABELS, BoundedHistogram, GCPauseTracker, gc_pause_tracker
+from prometheus_client import REGISTRY, CollectorRegistry, Counter
+
+
+@pytest.fixture()
+def histogram():
+    """Return a BoundedHistogram keeping the server and nsid labels, with room for 2 series."""
+    registry = CollectorRegistry()
+    evictions = Counter("test_evicted", "Test evictions.", registry=registry)
+    histogram = BoundedHistogram(
+        name="test_responsetime_seconds",
+        documentation="Test histogram.",
+        labelnames=["server", "nsid"],
+        buckets=(0.1, 1.0),
+        max_series=2,
+        evictions=evictions,
+        registry=registry,
+    )
+    return histogram, registry
+
+
+def labels(server, nsid="no_nsid"):
+    """Return a full labels dict like the DNSCollector builds."""
+    return {**dict.fromkeys(QTIME_LABELS, "none"), "server": server, "nsid": nsid}
+
+
+def count(registry, server, nsid="no_nsid"):
+    """Return the observation count for a series, or None if it does not exist."""
+    return registry.get_sample_value("test_responsetime_seconds_count", {"server": server, "nsid": nsid})
+
+
+def test_bounded_histogram_labels(histogram):
+    """Make sure only the configured labels are kept."""
+    histogram, registry = histogram
+    histogram.observe(labels=labels("a", nsid="x"), value=0.05)
+    histogram.observe(labels={**labels("a", nsid="x"), "answer": "7"}, value=0.5)
+    assert count(registry, "a", "x") == 2
+    assert registry.get_sample_value("test_evicted_total") == 0
+
+
+def test_bounded_histogram_evicts_least_recently_observed(histogram):
+    """Make sure the least recently observed label set is removed when the limit is reached."""
+    histogram, registry = histogram
+    histogram.observe(labels=labels("a"), value=0.05)
+    histogram.observe(labels=labels("b"), value=0.05)
+    # observing a again makes b the least recently observed
+    histogram.observe(labels=labels("a"), value=0.05)
+    histogram.observe(labels=labels("c"), value=0.05)
+    assert count(registry, "a") == 2
+    assert count(registry, "b") is None
+    assert count(registry, "c") == 1
+    assert registry.get_sample_value("test_evicted_total") == 1
+
+
+def test_bounded_histogram_configure(histogram):
+    """Make sure lowering the limit evicts series, and changing the labels starts over."""
+    histogram, registry = histogram
+    histogram.observe(labels=labels("a"), value=0.05)
+    histogram.observe(labels=labels("b"), value=0.05)
+    histogram.configure(labelnames=["server", "nsid"], max_series=1)
+    assert count(registry, "a") is None
+    assert count(registry, "b") == 1
+    histogram.configure(labelnames=["server"], max_series=0)
+    for server in "cdef":
+        histogram.observe(labels=labels(server), value=0.05)
+    assert registry.get_sample_value("test_responsetime_seconds_count", {"server": "b"}) is None
+    assert registry.get_sample_value("test_responsetime_seconds_count", {"server": "f"}) == 1
+    assert registry.get_sample_value("test_evicted_total") == 1
+
+
+def test_responsetime_labels_unknown(caplog):
+    """Make sure unknown labels in --responsetime-labels are rejected."""
+    with pytest.raises(SystemExit):
+        main(["--responsetime-labels", "server,colour"])
+    assert "Unknown --responsetime-labels colour" in caplog.text
+
+
+def test_responsetime_max_series_negative(caplog):
+    """Make sure a negative --responsetime-max-series is rejected."""
+    with pytest.raises(SystemExit):
+        main(["--responsetime-max-series", "-1"])
+    assert "Invalid --responsetime-max-series -1" in caplog.text
+
+
+def stage_count(stage):
+    """Return the number of /query requests which observed the stage."""
+    return REGISTRY.get_sample_value("dnsexp_query_request_stage_seconds_count", {"stage": stage}) or 0
+
+
+def gc_pauses(generation):
+    """Return the number of garbage collections of the generation observed in dnsexp_gc_pause_seconds."""
+    return REGISTRY.get_sample_value("dnsexp_gc_pause_seconds_count", {"generation": generation}) or 0
+
+
+def test_gc_pause_tracker():
+    """Make sure garbage collections are observed once, also when the tracker is installed twice."""
+    tracker = GCPauseTracker()
+    tracker.install()
+    tracker.install()
+    try:
+        assert gc.callbacks.count(tracker) == 1
+        # main() installs gc_pause_tracker, which observes the same histogram
+        trackers = 1 + (gc_pause_tracker in gc.callbacks)
+        before = gc_pauses(generation="2")
+        gc.collect()
+        assert gc_pauses(generation="2") == before + trackers
+    finally:
+        gc.callbacks.remove(tracker)
+
+
+def test_threads():
+    """Make sure the thread gauge has the number of threads."""
+    assert REGISTRY.get_sample_value("dnsexp_threads") == threading.active_count()
+
+
+def test_query_request_metrics(dns_exporter_example_config, tcp_server):
+    """Make sure /query requests observe the stage and CPU time histograms."""
+    stages = {stage: stage_count(stage) for stage in ["config", "dns", "render"]}
+    cpu = REGISTRY.get_sample_value("dnsexp_query_request_cpu_seconds_count") or 0
+    params = {"server": f"127.0.0.1:{tcp_server.server_port}", "query_name": "example.com", "protocol": "tcp"}
+    r = requests.get("http://127.0.0.1:25353/query", params=params)
+    assert "dnsexp_dns_query_success 1.0" in r.text
+    assert {stage: stage_count(stage) - before for stage, before in stages.items()} == {
+        "config": 1,
+        "dns": 1,
+        "render": 1,
+    }
+    assert REGISTRY.get_sample_value("dnsexp_query_request_cpu_seconds_count") == cpu + 1
+    assert REGISTRY.get_sample_value("dnsexp_query_requests_in_flight") == 0
+    # invalid configs only observe the config stage
+    requests.get("http://127.0.0.1:25353/query", params={**params, "module": "notfound"})
+    assert stage_count("config") - stages["config"] == 2
+    assert stage_count("render") - stages["render"] == 1
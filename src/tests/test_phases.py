@@ -0,0 +1,95 @@
+"""Unit tests for phases.py."""
+
+import re
+import time
+
+import dns.message
+import pytest
+import requests
+from dns_exporter.connections import dot_sockets
+from dns_exporter.phases import PhaseTimer
+
+
+def phases(text):
+    """Return a dict of phase to seconds from the dnsexp_dns_query_phase_seconds samples in the text."""
+    return {
+        phase: float(value)
+        for phase, value in re.findall(r'^dnsexp_dns_query_phase_seconds\{phase="(\w+)"\} (.*)$', text, re.MULTILINE)
+    }
+
+
+def test_measure():
+    """Make sure measured time is added to the phase, also when the block raises."""
+    timer = PhaseTimer()
+    with timer.measure("query"):
+        time.sleep(0.01)
+    with pytest.raises(ValueError, match="broken"), timer.measure("query"):
+        raise ValueError("broken")
+    assert timer.durations["query"] >= 10_000_000
+    assert timer.nested == []
+
+
+def test_measure_nested():
+    """Make sure time spent in inner phases is not counted for the enclosing phase."""
+    timer = PhaseTimer()
+    with timer.measure("query"):
+        with timer.measure("connect"):
+            time.sleep(0.02)
+        timer.add("handshake", 5_000_000)
+    assert timer.durations["connect"] >= 20_000_000
+    assert timer.durations["query"] < timer.durations["connect"]
+    assert timer.durations["handshake"] == 5_000_000
+
+
+def test_split_response():
+    """Make sure the time after the response was received is moved to the parse phase."""
+    response = dns.message.make_response(dns.message.make_query("example.com", "A"))
+    timer = PhaseTimer()
+    timer.add("query", 3_000_000)
+    # responses without a time are left alone
+    timer.split_response(response=response)
+    assert timer.durations == {"query": 3_000_000}
+    response.time = 0.002
+    timer.split_response(response=response)
+    assert timer.durations == {"query": 2_000_000, "parse": 1_000_000}
+
+
+def test_seconds_order():
+    """Make sure seconds() returns the measured phases in the order they happen."""
+    timer = PhaseTimer()
+    timer.add("validate", 1000)
+    timer.add("query", 2_000_000_000)
+    timer.add("resolve", 500_000_000)
+    assert list(timer.seconds().items()) == [("resolve", 0.5), ("query", 2.0), ("validate", 0.000001)]
+
+
+def test_scrape_phases(dns_exporter_example_config, tcp_server):
+    """Make sure a TCP scrape of a hostname has the resolve, connect, query, parse and validate phases."""
+    params = {
+        "server": f"localhost:{tcp_server.server_port}",
+        "query_name": "example.com",
+        "protocol": "tcp",
+        "family": "ipv4",
+    }
+    r = requests.get("http://127.0.0.1:25353/query", params=params)
+    assert "dnsexp_dns_query_success 1.0" in r.text
+    assert list(phases(r.text)) == ["resolve", "connect", "query", "parse", "validate"]
+    r = requests.get("http://127.0.0.1:25353/metrics")
+    assert 'dnsexp_dns_phase_duration_seconds_count{phase="connect",protocol="tcp"}' in r.text
+
+
+def test_scrape_phases_dot_reuse_connections(dns_exporter_example_config, dot_server):
+    """Make sure the DoT handshake is measured for new connections, and not for reused connections."""
+    dot_sockets.clear()
+    params = {
+        "server": f"127.0.0.1:{dot_server.server_port}",
+        "query_name": "example.com",
+        "protocol": "dot",
+        "family": "ipv4",
+        "verify_certificate": "false",
+        "reuse_connections": "true",
+    }
+    r = requests.get("http://127.0.0.1:25353/query", params=params)
+    assert list(phases(r.text)) == ["connect", "handshake", "query", "parse", "validate"]
+    r = requests.get("http://127.0.0.1:25353/query", params=params)
+    assert list(phases(r.text)) == ["query", "parse", "validate"]
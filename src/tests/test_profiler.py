@@ -0,0 +1,102 @@
+"""Unit tests for profiler.py and the /debug/profile endpoint."""
+
+import sys
+import threading
+import time
+from threading import Thread
+
+import pytest
+import requests
+from dns_exporter.profiler import collapse_stack, profile, profile_lock, render_collapsed, sample_stacks
+from dns_exporter.server import WorkerPoolHTTPServer
+
+
+def busy_loop(stop: threading.Event) -> None:
+    """Spin until stopped."""
+    while not stop.is_set():
+        time.sleep(0.001)
+
+
+@pytest.fixture()
+def busy_thread():
+    """Run busy_loop() in a thread while the test runs."""
+    stop = threading.Event()
+    thread = Thread(target=busy_loop, args=(stop,), daemon=True)
+    thread.start()
+    yield thread
+    stop.set()
+    thread.join()
+
+
+@pytest.fixture()
+def profile_url(exporter):
+    """Run the threading engine with the exporter and return the url of the /debug/profile endpoint."""
+    server = WorkerPoolHTTPServer(("127.0.0.1", 0), exporter, workers=2, queue_size=2)
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/debug/profile"
+    server.shutdown()
+    server.server_close()
+
+
+def test_collapse_stack():
+    """Make sure the stack starts with the outermost frame and ends with the current function."""
+    stack = collapse_stack(sys._getframe())  # noqa: SLF001
+    assert stack.endswith(";tests.test_profiler.test_collapse_stack")
+    assert stack.count(";") > 1
+    assert collapse_stack(None) == ""
+
+
+def test_sample_stacks(busy_thread):
+    """Make sure other threads are sampled and the sampling thread itself is not."""
+    stacks = sample_stacks(seconds=0.1, interval=0.01)
+    busy = [stack for stack in stacks if "tests.test_profiler.busy_loop" in stack]
+    assert busy
+    assert sum(stacks[stack] for stack in busy) >= 5
+    assert not any("dns_exporter.profiler.sample_stacks" in stack for stack in stacks)
+
+
+def test_render_collapsed():
+    """Make sure the most common stacks come first."""
+    stacks = sample_stacks(seconds=0)
+    stacks.update({"a;b": 1, "a;b;c": 3})
+    assert render_collapsed(stacks) == b"a;b;c 3\na;b 1\n"
+
+
+def test_profile_already_running():
+    """Make sure only one profile runs at a time."""
+    with profile_lock:
+        assert profile(seconds=0.01) is None
+    assert profile(seconds=0.01) is not None
+
+
+def test_profile_endpoint_disabled(profile_url):
+    """Make sure the endpoint returns 404 unless it is enabled."""
+    assert requests.get(profile_url, params={"seconds": "0.1"}).status_code == 404
+
+
+def test_profile_endpoint(exporter, profile_url, busy_thread):
+    """Make sure the endpoint returns the collapsed stacks and validates the seconds parameter."""
+    exporter.profile_endpoint = True
+    r = requests.get(profile_url, params={"seconds": "0.2"})
+    assert r.status_code == 200
+    assert r.headers["Content-Type"] == "text/plain; charset=utf-8"
+    assert "tests.test_profiler.busy_loop" in r.text
+    # the other worker thread is sampled while it waits for requests
+    assert "dns_exporter.server" in r.text
+    for seconds in ["0", "61", "soon"]:
+        assert requests.get(profile_url, params={"seconds": seconds}).status_code == 400
+
+
+def test_profile_endpoint_saturated(exporter):
+    """Make sure a profile request arriving when the exporter is saturated is rejected right away."""
+    exporter.profile_endpoint = True
+    handler = type("SaturatedDNSExporter", (exporter,), {"saturated": True})
+    server = WorkerPoolHTTPServer(("127.0.0.1", 0), handler, workers=1, queue_size=1)
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        r = requests.get(f"http://127.0.0.1:{server.server_address[1]}/debug/profile", params={"seconds": "5"})
+        assert r.status_code == 503
+        assert r.elapsed.total_seconds() < 1
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -1,5 +1,6 @@
 """Unit tests for proxy functionality."""
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 import requests
@@ -125,3 +126,28 @@ def test_proxy_module(dns_exporter_example_config, proxy_server):
     )
     assert 'proxy="socks5://127.0.0.1:1080"' in r.text
     assert 'server="udp://dns.google:53"' in r.text
+
+
+def test_proxy_concurrency(dns_exporter_example_config, tcp_server, socks_servers):
+    """Make sure concurrent scrapes with different proxies, and without proxy, each use the right path."""
+    proxies = [None, *[f"socks5://127.0.0.1:{server.server_port}" for server in socks_servers]]
+    params = {
+        "query_name": "example.com",
+        "server": f"127.0.0.1:{tcp_server.server_port}",
+        "family": "ipv4",
+        "protocol": "tcp",
+    }
+
+    def scrape(i) -> None:
+        proxy = proxies[i % len(proxies)]
+        r = requests.get("http://127.0.0.1:25353/query", params={**params, "proxy": proxy} if proxy else params)
+        assert "dnsexp_dns_query_success 1.0" in r.text
+        assert f'proxy="{proxy or "none"}"' in r.text
+
+    scrapes = 150
+    with ThreadPoolExecutor(max_workers=30) as executor:
+        list(executor.map(scrape, range(scrapes)))
+    # every proxied query went through its own proxy, and the direct queries through neither
+    for server in socks_servers:
+        assert server.connections == scrapes / len(proxies)
+    assert tcp_server.connections == scrapes
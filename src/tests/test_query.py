@@ -0,0 +1,79 @@
+"""Unit tests for query.py."""
+
+import dns.edns
+import dns.flags
+import dns.message
+import requests
+from dns_exporter.query import get_query_template
+
+
+def template_args(**kwargs: object) -> dict[str, object]:
+    """Return the arguments for get_query_template() with the defaults from the Config class."""
+    args = {
+        "query_name": "example.com",
+        "query_type": "A",
+        "query_class": "IN",
+        "recursion_desired": True,
+        "edns": True,
+        "edns_do": False,
+        "edns_nsid": True,
+        "edns_bufsize": 1232,
+        "edns_pad": 0,
+        "edns_keepalive": False,
+    }
+    args.update(kwargs)
+    return args
+
+
+def test_query_template_cached():
+    """Make sure identical queries share the template."""
+    assert get_query_template(**template_args()) is get_query_template(**template_args())
+    assert get_query_template(**template_args()) is not get_query_template(**template_args(query_type="AAAA"))
+
+
+def test_query_template_render():
+    """Make sure each rendered query gets a new message ID and the wire format matches the message."""
+    template = get_query_template(**template_args(edns_do=True, edns_pad=20))
+    queries = [template.render() for _ in range(10)]
+    assert len({q.id for q, _ in queries}) > 1
+    for q, wire in queries:
+        assert q.to_wire() == wire
+        assert dns.message.from_wire(wire) == q
+    q, _ = queries[0]
+    assert q.flags & dns.flags.RD
+    assert q.ednsflags & dns.flags.DO
+    assert [option.otype for option in q.options] == [dns.edns.NSID, dns.edns.PADDING]
+    # rendering must not change the template
+    assert template.message.to_wire() == template.wire
+
+
+def test_query_template_no_edns():
+    """Make sure a template without EDNS renders a plain query."""
+    q, wire = get_query_template(**template_args(edns=False)).render()
+    assert q.edns == -1
+    assert q.to_wire() == wire
+
+
+def test_udp_prebuilt_wire(dns_exporter_example_config, udp_server):
+    """Make sure protocol udp sends the prebuilt wire format and accepts the response."""
+    params = {"server": f"127.0.0.1:{udp_server.server_port}", "query_name": "example.com", "family": "ipv4"}
+    for _ in range(3):
+        r = requests.get("http://127.0.0.1:25353/query", params=params)
+        assert "dnsexp_dns_query_success 1.0" in r.text
+    assert len(udp_server.queries) == 3
+    # all queries are identical apart from the message ID
+    assert len({query[2:] for query in udp_server.queries}) == 1
+    assert len({query[:2] for query in udp_server.queries}) > 1
+
+
+def test_tcp_prebuilt_wire(dns_exporter_example_config, tcp_server):
+    """Make sure protocol tcp without reuse_connections sends the prebuilt wire format."""
+    params = {
+        "server": f"127.0.0.1:{tcp_server.server_port}",
+        "query_name": "example.com",
+        "family": "ipv4",
+        "protocol": "tcp",
+    }
+    r = requests.get("http://127.0.0.1:25353/query", params=params)
+    assert "dnsexp_dns_query_success 1.0" in r.text
+    assert tcp_server.connections == 1
@@ -0,0 +1,253 @@
+"""Unit tests for reloading the config file."""
+
+import os
+import signal
+import time
+from threading import Thread
+
+import pytest
+import requests
+import yaml
+from dns_exporter.entrypoint import install_reload_signal_handler
+from dns_exporter.server import WorkerPoolHTTPServer
+from prometheus_client import REGISTRY
+
+
+def reloads(result):
+    """Return the current value of the reload counter for the result."""
+    return REGISTRY.get_sample_value("dnsexp_config_reloads_total", {"result": result}) or 0
+
+
+@pytest.fixture()
+def configfile(tmp_path):
+    """Return a function which writes the modules to a config file and returns the path."""
+    path = tmp_path / "dns_exporter.yml"
+
+    def write(modules: dict) -> str:
+        path.write_text(yaml.dump({"modules": modules}))
+        return str(path)
+
+    return write
+
+
+@pytest.fixture()
+def reload_exporter(exporter, configfile):
+    """Return the exporter class configured from a config file with two modules."""
+    exporter.config_file = configfile({"udp": {"protocol": "udp"}, "tcp": {"protocol": "tcp"}})
+    exporter.modules = {}
+    exporter.configure(modules=exporter.read_config_file(exporter.config_file))
+    return exporter
+
+
+def build(exporter, module):
+    """Build the final config for a scrape with the module and return it."""
+    handler = exporter.__new__(exporter)
+    handler.build_final_config(qs={"module": module, "server": "127.0.0.1", "query_name": "example.com"})
+    return handler.config
+
+
+def test_reload(reload_exporter, configfile):
+    """Make sure a reload swaps the modules and only removes cached configs for changed modules."""
+    assert build(reload_exporter, "tcp").protocol == "tcp"
+    assert build(reload_exporter, "udp").protocol == "udp"
+    cached = len(reload_exporter.config_cache)
+    success = reloads("success")
+    configfile({"udp": {"protocol": "udp"}, "tcp": {"protocol": "udptcp"}, "new": {"protocol": "dot"}})
+    assert reload_exporter.reload()
+    assert reloads("success") - success == 1
+    assert sorted(reload_exporter.modules) == ["new", "tcp", "udp"]
+    # the config for the unchanged udp module is still cached
+    assert len(reload_exporter.config_cache) == cached - 1
+    assert build(reload_exporter, "tcp").protocol == "udptcp"
+    assert build(reload_exporter, "new").protocol == "dot"
+
+
+def test_reload_removed_module(reload_exporter, configfile):
+    """Make sure removed modules can not be used after a reload."""
+    assert build(reload_exporter, "tcp").protocol == "tcp"
+    configfile({"udp": {"protocol": "udp"}})
+    assert reload_exporter.reload()
+    with pytest.raises(Exception, match="invalid_request_module"):
+        build(reload_exporter, "tcp")
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        "modules: [",
+        "foo: bar",
+        yaml.dump({"modules": {"udp": {"protocol": "sctp"}}}),
+    ],
+)
+def test_reload_invalid(reload_exporter, content):
+    """Make sure the current modules are kept when the new config file is invalid."""
+    modules = reload_exporter.modules
+    failure = reloads("failure")
+    with open(reload_exporter.config_file, "w") as f:  # noqa: PTH123
+        f.write(content)
+    assert not reload_exporter.reload()
+    assert reloads("failure") - failure == 1
+    assert reload_exporter.modules is modules
+
+
+def test_reload_without_config_file(exporter):
+    """Make sure reload fails without a config file."""
+    exporter.config_file = None
+    assert not exporter.reload()
+
+
+def test_reload_endpoint(reload_exporter, configfile):
+    """Test reloading with a POST to /-/reload, which must be enabled first."""
+    server = WorkerPoolHTTPServer(("127.0.0.1", 0), reload_exporter, workers=2, queue_size=2)
+    Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    configfile({"udp": {"protocol": "udptcp"}})
+    try:
+        assert requests.post(f"{url}/-/reload").status_code == 404
+        assert "udp" in reload_exporter.modules
+        assert "tcp" in reload_exporter.modules
+        reload_exporter.reload_endpoint = True
+        assert requests.post(f"{url}/-/reload").status_code == 200
+        r = requests.get(f"{url}/config", params={"module": "udp", "server": "127.0.0.1", "query_name": "example.com"})
+        assert r.json()["protocol"] == "udptcp"
+        assert "tcp" not in reload_exporter.modules
+        # other endpoints do not support POST
+        assert requests.post(f"{url}/query").status_code == 501
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_reload_endpoint_saturated(reload_exporter):
+    """Make sure a reload request arriving when the exporter is saturated is rejected right away."""
+    reload_exporter.reload_endpoint = True
+    handler = type("SaturatedDNSExporter", (reload_exporter,), {"saturated": True})
+    server = WorkerPoolHTTPServer(("127.0.0.1", 0), handler, workers=1, queue_size=1)
+    Thread(target=server.serve_forever, daemon=True).start()
+    before = reloads("success")
+    try:
+        r = requests.post(f"http://127.0.0.1:{server.server_address[1]}/-/reload")
+        assert r.status_code == 503
+        assert reloads("success") == before
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGHUP"), reason="SIGHUP is not supported on this platform")
+def test_reload_sighup(reload_exporter, configfile):
+    """Make sure SIGHUP reloads the config file."""
+    previous = signal.getsignal(signal.SIGHUP)
+    install_reload_signal_handler(handler=reload_exporter)
+    configfile({"sighup": {"protocol": "tcp"}})
+    try:
+        os.kill(os.getpid(), signal.SIGHUP)
+        for _ in range(50):
+            if "sighup" in reload_exporter.modules:
+                break
+            time.sleep(0.1)
+        assert list(reload_exporter.modules) == ["sighup"]
+    finally:
+        signal.signal(signal.SIGHUP, previous)
+
+
+def test_lazy_modules(exporter, configfile):
+    """Make sure lazy modules are compiled when they are first used."""
+    exporter.lazy_modules = True
+    exporter.config_file = configfile({"udp": {"protocol": "udp"}, "tcp": {"protocol": "tcp"}})
+    exporter.modules = exporter.load_config_file(exporter.config_file)
+    assert exporter.modules.pending == {"udp", "tcp"}
+    assert build(exporter, "tcp").protocol == "tcp"
+    assert exporter.modules.pending == {"udp"}
+    with pytest.raises(Exception, match="invalid_request_module"):
+        build(exporter, "nonexistent")
+
+
+def test_lazy_modules_invalid(exporter, configfile):
+    """Make sure invalid lazy modules are found when they are used."""
+    exporter.lazy_modules = True
+    exporter.modules = exporter.load_config_file(configfile({"invalid": {"protocol": "sctp"}}))
+    assert exporter.modules.pending == {"invalid"}
+    with pytest.raises(Exception, match="invalid_request_module"):
+        build(exporter, "invalid")
+    assert exporter.modules.pending == {"invalid"}
+
+
+def test_lazy_modules_reload(reload_exporter, configfile):
+    """Make sure a reload with lazy modules only removes cached configs for changed modules."""
+    reload_exporter.lazy_modules = True
+    assert reload_exporter.reload()
+    assert build(reload_exporter, "tcp").protocol == "tcp"
+    assert build(reload_exporter, "udp").protocol == "udp"
+    cached = len(reload_exporter.config_cache)
+    configfile({"udp": {"protocol": "udp"}, "tcp": {"protocol": "udptcp"}})
+    assert reload_exporter.reload()
+    assert reload_exporter.modules.pending == {"udp", "tcp"}
+    assert len(reload_exporter.config_cache) == cached - 1
+    assert build(reload_exporter, "tcp").protocol == "udptcp"
+
+
+def test_load_config_file_timings(exporter, configfile):
+    """Make sure the time spent in each phase of loading the config file is saved in the metric."""
+    modules = exporter.load_config_file(configfile({"udp": {"protocol": "udp"}}))
+    assert list(modules) == ["udp"]
+    assert not modules.pending
+    assert REGISTRY.get_sample_value("dnsexp_config_load_seconds", {"phase": "compile"}) > 0
+    assert REGISTRY.get_sample_value("dnsexp_config_load_seconds", {"phase": "cache_load"}) == 0
+    assert REGISTRY.get_sample_value("dnsexp_config_load_seconds", {"phase": "total"}) > 0
+
+
+def test_load_config_file_invalid_module(exporter, configfile):
+    """Make sure loading a config file with an invalid module returns None."""
+    assert exporter.load_config_file(configfile({"invalid": {"protocol": "sctp"}})) is None
+
+
+def test_module_cache(exporter, configfile, tmp_path):
+    """Make sure compiled modules are saved in the module cache and loaded from it."""
+    exporter.module_cache_dir = str(tmp_path / "cache")
+    path = configfile({"udp": {"protocol": "udp"}, "tcp": {"protocol": "tcp"}})
+    modules = exporter.load_config_file(path)
+    assert len(list((tmp_path / "cache").glob("modules-*.pickle"))) == 1
+    cached = exporter.load_config_file(path)
+    assert cached == modules
+    assert cached.sources == modules.sources
+    assert REGISTRY.get_sample_value("dnsexp_config_load_seconds", {"phase": "parse"}) == 0
+    assert REGISTRY.get_sample_value("dnsexp_config_load_seconds", {"phase": "compile"}) == 0
+    # a changed config file gets a new cache file and the old one is removed
+    old = next((tmp_path / "cache").glob("modules-*.pickle"))
+    exporter.load_config_file(configfile({"udp": {"protocol": "udptcp"}}))
+    assert not old.exists()
+    assert len(list((tmp_path / "cache").glob("modules-*.pickle"))) == 1
+
+
+def test_module_cache_shared_directory(exporter, configfile, tmp_path):
+    """Make sure exporters with different config files do not remove each others module cache files."""
+    exporter.module_cache_dir = str(tmp_path / "cache")
+    first = configfile({"udp": {"protocol": "udp"}})
+    exporter.load_config_file(first)
+    second = tmp_path / "other.yml"
+    second.write_text(yaml.dump({"modules": {"tcp": {"protocol": "tcp"}}}))
+    exporter.load_config_file(str(second))
+    assert len(list((tmp_path / "cache").glob("modules-*.pickle"))) == 2
+    exporter.load_config_file(first)
+    assert REGISTRY.get_sample_value("dnsexp_config_load_seconds", {"phase": "parse"}) == 0
+
+
+def test_module_cache_lazy(exporter, configfile, tmp_path):
+    """Make sure modules which have not been compiled are not saved in the module cache."""
+    exporter.module_cache_dir = str(tmp_path)
+    exporter.lazy_modules = True
+    exporter.load_config_file(configfile({"udp": {"protocol": "udp"}}))
+    assert not list(tmp_path.glob("modules-*.pickle"))
+
+
+def test_module_cache_invalid(exporter, configfile, tmp_path, caplog):
+    """Make sure an unreadable module cache file is ignored."""
+    exporter.module_cache_dir = str(tmp_path)
+    path = configfile({"udp": {"protocol": "udp"}})
+    exporter.load_config_file(path)
+    cachefile = next(tmp_path.glob("modules-*.pickle"))
+    cachefile.write_bytes(b"garbage")
+    modules = exporter.load_config_file(path)
+    assert "Unable to read module cache file" in caplog.text
+    assert list(modules) == ["udp"]
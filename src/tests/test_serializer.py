@@ -0,0 +1,119 @@
+"""Unit tests for serializer.py."""
+
+from pathlib import Path
+
+import pytest
+from dns_exporter.collector import FailCollector
+from dns_exporter.metrics import QTIME_LABELS
+from dns_exporter.serializer import generate_text
+from prometheus_client import CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, InfoMetricFamily, Metric
+from prometheus_client.parser import text_string_to_metric_families
+
+FIXTURES = sorted(Path(__file__).parent.glob("prometheus/*/*.txt"))
+
+
+class StaticCollector:
+    """Collector returning the metrics it was created with."""
+
+    def __init__(self, *metrics: Metric) -> None:
+        """Save the metrics."""
+        self.metrics = metrics
+
+    def collect(self):
+        """Yield the metrics."""
+        yield from self.metrics
+
+    def describe(self):
+        """Yield the metrics, so the collector works with restricted registries."""
+        yield from self.metrics
+
+
+def registry_with(*metrics: Metric) -> CollectorRegistry:
+    """Return a registry with the metrics."""
+    registry = CollectorRegistry()
+    registry.register(StaticCollector(*metrics))
+    return registry
+
+
+@pytest.mark.parametrize("fixture", FIXTURES, ids=lambda path: f"{path.parent.name}/{path.name}")
+def test_generate_text_fixtures(fixture):
+    """Make sure the checked-in /query outputs are reproduced byte for byte."""
+    expected = fixture.read_bytes()
+    registry = registry_with(*text_string_to_metric_families(expected.decode("utf-8")))
+    assert generate_text(registry) == expected
+    assert generate_text(registry) == generate_latest(registry)
+
+
+def test_generate_text_escaping():
+    """Make sure label values and help texts are escaped like generate_latest() does."""
+    gauge = GaugeMetricFamily("dnsexp_test", 'Help with a \\ and a\nnewline and "quotes".', labels=["b", "a"])
+    gauge.add_metric(["back\\slash", 'new\nline "quoted"'], 1)
+    gauge.add_metric(["ünïcødé", ""], 0.1)
+    registry = registry_with(gauge)
+    assert generate_text(registry) == generate_latest(registry)
+
+
+def test_generate_text_values():
+    """Make sure sample values are formatted like generate_latest() does."""
+    gauge = GaugeMetricFamily("dnsexp_test", "Test values.", labels=["v"])
+    for value in [0, 1, -1, 1e-9, 1e21, 0.1 + 0.2, float("inf"), float("-inf"), float("nan")]:
+        gauge.add_metric([str(value)], value)
+    registry = registry_with(gauge)
+    assert generate_text(registry) == generate_latest(registry)
+
+
+def test_generate_text_fallback():
+    """Make sure metrics not handled by the fast path are rendered by generate_latest()."""
+    counter = CounterMetricFamily("dnsexp_test", "Test counter.", labels=["a"], created=1700000000)
+    counter.add_metric(["b"], 3, created=1700000000)
+    timestamped = GaugeMetricFamily("dnsexp_stamped", "Test timestamp.")
+    timestamped.add_metric([], 1, timestamp=1700000000.5)
+    info = InfoMetricFamily("dnsexp_info", "Test info.", value={"version": "1"})
+    registry = registry_with(counter, timestamped, info)
+    Histogram("dnsexp_test_histogram", "Test histogram.", registry=registry).observe(0.3)
+    Counter("dnsexp_test_counter", "Test counter.", registry=registry).inc()
+    assert generate_text(registry) == generate_latest(registry)
+
+
+def test_generate_text_old_prometheus_client(mocker):
+    """Make sure everything is rendered with generate_latest() when prometheus_client has no escaping functions."""
+    mocker.patch("dns_exporter.serializer.FAST_TEXT", new=False)
+    render = mocker.patch("dns_exporter.serializer.render_metric")
+    gauge = GaugeMetricFamily("dnsexp_test", "Test gauge.", labels=["server"])
+    gauge.add_metric(["127.0.0.1"], 1)
+    registry = StaticCollector(gauge)
+    assert generate_text(registry) == generate_latest(registry)
+    render.assert_not_called()
+
+
+def test_generate_text_fail_collector():
+    """Make sure the output of a failed scrape is identical."""
+    registry = CollectorRegistry()
+    labels = {**dict.fromkeys(QTIME_LABELS, "none"), "server": "udp://serializer.example:53"}
+    registry.register(FailCollector(failure_reason="invalid_request_module", labels=labels))
+    assert generate_text(registry) == generate_latest(registry)
+
+
+def test_bake_metric_response_openmetrics(exporter):
+    """Make sure OpenMetrics requests are rendered by prometheus_client."""
+    registry = registry_with(*text_string_to_metric_families(FIXTURES[0].read_text()))
+    status, headers, output = exporter.bake_metric_response(
+        registry=registry,
+        query={},
+        accept_header="application/openmetrics-text",
+        accept_encoding_header=None,
+    )
+    assert status == 200
+    assert headers[0][1].startswith("application/openmetrics-text")
+    assert output.endswith(b"# EOF\n")
+    _, headers, output = exporter.bake_metric_response(
+        registry=registry,
+        query={"name[]": "up"},
+        accept_header=None,
+        accept_encoding_header=None,
+    )
+    assert (
+        output
+        == b"# HELP up The value of this Gauge is always 1 when the dns_exporter is up\n# TYPE up gauge\nup 1.0\n"
+    )
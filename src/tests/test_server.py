@@ -0,0 +1,246 @@
+"""Unit tests for the asyncio engine in server.py."""
+
+import asyncio
+import re
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+
+import pytest
+import requests
+from dns_exporter.server import WorkerPoolHTTPServer, start_server
+from prometheus_client import REGISTRY
+
+
+def protocol_params(protocol, port):
+    """Return the querystring for a scrape of a local test server using the specified protocol."""
+    server = f"https://127.0.0.1:{port}/dns-query" if protocol in ["doh", "doh3"] else f"127.0.0.1:{port}"
+    return {
+        "server": server,
+        "query_name": "example.com",
+        "protocol": protocol,
+        "family": "ipv4",
+        "verify_certificate": "false",
+    }
+
+
+def strip_qtime(text):
+    """Remove the values of the query time metric and the phase samples which differ between scrapes.
+
+    The phases which can be measured separately depend on the engine, so the phase samples are removed entirely.
+    """
+    text = re.sub(r"^dnsexp_dns_query_phase_seconds\{.*\n", "", text, flags=re.MULTILINE)
+    return re.sub(r"^(dnsexp_dns_query_time_seconds\{.*\}) .*$", r"\1", text, flags=re.MULTILINE)
+
+
+def test_index(dns_exporter_asyncio_engine):
+    """Make sure the asyncio engine returns the index page."""
+    r = requests.get("http://127.0.0.1:26353/")
+    assert r.status_code == 200
+    assert "DNS Exporter" in r.text
+
+
+def test_unknown_path(dns_exporter_asyncio_engine):
+    """Make sure the asyncio engine returns 404 for unknown paths."""
+    r = requests.get("http://127.0.0.1:26353/notfound")
+    assert r.status_code == 404
+
+
+def test_unsupported_method(dns_exporter_asyncio_engine):
+    """Make sure the asyncio engine returns 501 for methods other than GET."""
+    r = requests.post("http://127.0.0.1:26353/query")
+    assert r.status_code == 501
+
+
+def test_invalid_request(dns_exporter_asyncio_engine):
+    """Make sure the asyncio engine returns 400 for a malformed request."""
+    with socket.create_connection(("127.0.0.1", 26353)) as sock:
+        sock.sendall(b"GARBAGE\r\n\r\n")
+        assert sock.recv(1024).startswith(b"HTTP/1.1 400")
+
+
+def test_metrics(dns_exporter_asyncio_engine):
+    """Make sure the asyncio engine returns the exporter metrics."""
+    requests.get("http://127.0.0.1:26353/")
+    r = requests.get("http://127.0.0.1:26353/metrics")
+    assert r.status_code == 200
+    assert 'dnsexp_http_responses_total{path="/",response_code="200"}' in r.text
+
+
+def test_profile_disabled(dns_exporter_asyncio_engine):
+    """Make sure the asyncio engine only profiles when the profile endpoint is enabled."""
+    r = requests.get("http://127.0.0.1:26353/debug/profile", params={"seconds": "0.1"})
+    assert r.status_code == 404
+
+
+def test_query_request_stages(dns_exporter_asyncio_engine, tcp_server):
+    """Make sure the asyncio engine observes the stages of /query requests."""
+    before = REGISTRY.get_sample_value("dnsexp_query_request_stage_seconds_count", {"stage": "dns"}) or 0
+    r = requests.get("http://127.0.0.1:26353/query", params=protocol_params("tcp", tcp_server.server_port))
+    assert "dnsexp_dns_query_success 1.0" in r.text
+    assert REGISTRY.get_sample_value("dnsexp_query_request_stage_seconds_count", {"stage": "dns"}) == before + 1
+    assert REGISTRY.get_sample_value("dnsexp_query_requests_in_flight") == 0
+
+
+def test_config(dns_exporter_asyncio_engine, tcp_server):
+    """Make sure the asyncio engine returns the final config for /config requests."""
+    r = requests.get("http://127.0.0.1:26353/config", params=protocol_params("tcp", tcp_server.server_port))
+    assert r.status_code == 200
+    assert r.json()["protocol"] == "tcp"
+
+
+def test_config_error(dns_exporter_asyncio_engine):
+    """Make sure the asyncio engine returns the failure metrics for invalid configs."""
+    r = requests.get("http://127.0.0.1:26353/query", params={"server": "127.0.0.1", "module": "notfound"})
+    assert "dnsexp_dns_query_success 0.0" in r.text
+    r = requests.get("http://127.0.0.1:26353/metrics")
+    assert 'reason="invalid_request_module"' in r.text
+
+
+def test_connection_error(dns_exporter_asyncio_engine):
+    """Make sure a scrape of a closed port fails with connection_error."""
+    r = requests.get("http://127.0.0.1:26353/query", params=protocol_params("tcp", 1))
+    assert "dnsexp_dns_query_success 0.0" in r.text
+    r = requests.get("http://127.0.0.1:26353/metrics")
+    assert 'reason="connection_error"' in r.text
+
+
+@pytest.mark.parametrize(
+    ("protocol", "fixture", "transport"),
+    [
+        ("tcp", "tcp_server", "TCP"),
+        ("dot", "dot_server", "TCP"),
+        ("doh", "doh_server", "TCP"),
+        ("doh3", "doh3_server", "QUIC"),
+        ("doq", "doq_server", "QUIC"),
+    ],
+)
+def test_protocols(dns_exporter_asyncio_engine, request, protocol, fixture, transport):
+    """Make sure the asyncio engine can do DNS queries with all the protocols."""
+    server = request.getfixturevalue(fixture)
+    r = requests.get("http://127.0.0.1:26353/query", params=protocol_params(protocol, server.server_port))
+    assert "dnsexp_dns_query_success 1.0" in r.text
+    assert f'transport="{transport}"' in r.text
+
+
+def test_same_output_as_threading_engine(dns_exporter_asyncio_engine, dns_exporter_example_config, tcp_server):
+    """Make sure the asyncio engine returns the same metrics as the threading engine."""
+    params = protocol_params("tcp", tcp_server.server_port)
+    threading = requests.get("http://127.0.0.1:25353/query", params=params)
+    asyncio = requests.get("http://127.0.0.1:26353/query", params=params)
+    assert strip_qtime(asyncio.text) == strip_qtime(threading.text)
+    assert asyncio.headers["Content-Type"] == threading.headers["Content-Type"]
+
+
+def test_threaded_collector_fallback(dns_exporter_asyncio_engine, tcp_server):
+    """Make sure scrapes using pooled connections are handled by the threaded collector."""
+    params = {**protocol_params("tcp", tcp_server.server_port), "reuse_connections": "true"}
+    for _ in range(2):
+        r = requests.get("http://127.0.0.1:26353/query", params=params)
+        assert "dnsexp_dns_query_success 1.0" in r.text
+    assert "dnsexp_dns_connection_reused 1.0" in r.text
+
+
+def test_concurrent_scrapes(dns_exporter_asyncio_engine, tcp_server):
+    """Make sure the asyncio engine handles concurrent scrapes on keep-alive connections."""
+    params = protocol_params("tcp", tcp_server.server_port)
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=10) as executor:
+        responses = list(
+            executor.map(lambda _: session.get("http://127.0.0.1:26353/query", params=params), range(50)),
+        )
+    for r in responses:
+        assert "dnsexp_dns_query_success 1.0" in r.text
+    assert tcp_server.queries == 50
+
+
+@pytest.fixture()
+def silent_dns_server():
+    """Run a TCP server which accepts connections but never answers, like a DNS server gone dark."""
+    listener = socket.create_server(("127.0.0.1", 0))
+    yield listener.getsockname()[1]
+    listener.close()
+
+
+def saturate(port, silent_dns_server):
+    """Send four concurrent scrapes of the silent DNS server to the exporter and return the response times."""
+    params = {**protocol_params("tcp", silent_dns_server), "timeout": "2"}
+
+    def scrape(i) -> float:
+        # stagger the requests so they arrive in order
+        time.sleep(i * 0.2)
+        start = time.time()
+        r = requests.get(f"http://127.0.0.1:{port}/query", params=params)
+        assert "dnsexp_dns_query_success 0.0" in r.text
+        return time.time() - start
+
+    rejected = REGISTRY.get_sample_value("dnsexp_scrapes_rejected_total")
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        durations = list(executor.map(scrape, range(4)))
+    r = requests.get(f"http://127.0.0.1:{port}/metrics")
+    assert r.status_code == 200
+    assert 'reason="exporter_saturated"' in r.text
+    # the request for /metrics is the only one in flight now
+    assert "dnsexp_scrapes_in_flight 1.0" in r.text
+    assert "dnsexp_scrapes_queued 0.0" in r.text
+    return durations, REGISTRY.get_sample_value("dnsexp_scrapes_rejected_total") - rejected
+
+
+def test_worker_pool_saturated(exporter, silent_dns_server):
+    """Make sure scrapes are rejected when all workers are busy and the queue is full."""
+    server = WorkerPoolHTTPServer(("127.0.0.1", 0), exporter, workers=1, queue_size=1)
+    Thread(target=server.serve_forever, daemon=True).start()
+    durations, rejected = saturate(port=server.server_address[1], silent_dns_server=silent_dns_server)
+    server.shutdown()
+    server.server_close()
+    # one scrape is handled by the worker and one waits in the queue, both time out
+    assert all(duration > 1.5 for duration in durations[:2])
+    # the rest are rejected right away
+    assert all(duration < 1 for duration in durations[2:])
+    assert rejected == 2
+
+
+def test_asyncio_engine_saturated(silent_dns_server):
+    """Make sure the asyncio engine rejects scrapes when all workers are busy and the queue is full."""
+    loop = asyncio.new_event_loop()
+    Thread(target=loop.run_forever, daemon=True).start()
+    server = asyncio.run_coroutine_threadsafe(
+        start_server(listen_ip="127.0.0.1", port=0, workers=1, queue_size=1), loop
+    ).result()
+    durations, rejected = saturate(port=server.sockets[0].getsockname()[1], silent_dns_server=silent_dns_server)
+    loop.call_soon_threadsafe(server.close)
+    assert all(duration > 1.5 for duration in durations[:2])
+    assert all(duration < 1 for duration in durations[2:])
+    assert rejected == 2
+
+
+def test_worker_pool_no_queue(exporter, silent_dns_server):
+    """Make sure a queue size of 0 rejects scrapes whenever no worker is free."""
+    server = WorkerPoolHTTPServer(("127.0.0.1", 0), exporter, workers=2, queue_size=0)
+    Thread(target=server.serve_forever, daemon=True).start()
+    durations, rejected = saturate(port=server.server_address[1], silent_dns_server=silent_dns_server)
+    server.shutdown()
+    server.server_close()
+    assert all(duration > 1.5 for duration in durations[:2])
+    assert all(duration < 1 for duration in durations[2:])
+    assert rejected == 2
+
+
+def test_asyncio_engine_no_queue(silent_dns_server):
+    """Make sure the asyncio engine also rejects scrapes whenever no worker is free with a queue size of 0."""
+    loop = asyncio.new_event_loop()
+    Thread(target=loop.run_forever, daemon=True).start()
+    server = asyncio.run_coroutine_threadsafe(
+        start_server(listen_ip="127.0.0.1", port=0, workers=2, queue_size=0), loop
+    ).result()
+    durations, rejected = saturate(port=server.sockets[0].getsockname()[1], silent_dns_server=silent_dns_server)
+    loop.call_soon_threadsafe(server.close)
+    assert all(duration > 1.5 for duration in durations[:2])
+    assert all(duration < 1 for duration in durations[2:])
+    assert rejected == 2
+
+
+def test_reload_endpoint_disabled(dns_exporter_asyncio_engine):
+    """Make sure the asyncio engine returns 404 for /-/reload when the reload endpoint is not enabled."""
+    r = requests.post("http://127.0.0.1:26353/-/reload")
+    assert r.status_code == 404